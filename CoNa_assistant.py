@@ -1,15 +1,2565 @@
 import tkinter as tk
-from tkinter import simpledialog, colorchooser, messagebox, filedialog, ttk
-from PIL import Image, ImageTk  # Pillow for image handling
-import json, os, datetime
+from tkinter import simpledialog, colorchooser, messagebox, filedialog, ttk, font as tkfont
+from PIL import Image, ImageColor, ImageDraw, ImageFont, ImageTk  # Pillow for image handling
+import json, math, os, sys, argparse, bisect, fnmatch, datetime, csv, hashlib, heapq, collections, contextlib, time, struct, zlib
+import collections.abc
+import concurrent.futures, queue, signal, socket, threading
+try:
+    import numpy as np  # optional; only the influence heatmap needs it
+except ImportError:
+    np = None
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
 
 # Constants
-GRID_SIZE = 999    # 999x999 grid
+GRID_SIZE = 999    # 999x999 grid unless map_config.json says otherwise
 CELL_SIZE = 10     # Default cell size
-DEFAULT_START_COORDINATE = (GRID_SIZE // 2, GRID_SIZE // 2)
+CHUNK_SIZE = 64    # objects and terrain are stored, looked up and drawn in 64x64-cell chunks
+SCHEDULE_EXPORT_HASHES = "schedule_export_hashes.json"
+
+Cell = Tuple[int, int]
+ObjectKey = Tuple  # (x, y) center of an object, or ("marker", name) for a placed marker
+ALLIANCE_RANKS = ["R1", "R2", "R3", "R4", "R5"]
+ALLIANCE_RANK_COLORS = {"R1": "#2C3E50", "R2": "#34495E", "R3": "#5D6D7E", "R4": "#2874A6", "R5": "#1F618D"}
+# Terrain textures. Where preset terrain lies comes from the map config: each zone covers
+# the grid rectangle [x1, x2) x [y1, y2) with one terrain.
+TERRAIN_TEXTURES = {"mud": "Mud.png", "dark_mud": "Darkmud.png"}
+DEFAULT_MAP_ZONES = [{"name": "PvP Mud Area", "terrain": "mud", "rect": [448, 446, 552, 550]},
+                     {"name": "Restricted Placement Area", "terrain": "dark_mud", "rect": [489, 486, 510, 508]}]
+MAX_EXPORT_CELL_PX = 20      # map image export: at most 20 pixels per cell (~20k x 20k for the whole map)
+EXPORT_BAND_PX = 256         # image rows rendered per task by the export workers
+MINIMAP_CELLS_PER_PX = 4     # the minimap shows each 4x4 block of cells as one pixel
+RESTRICTED_TERRAIN = ("dark_mud",)   # terrain nothing may be placed on
+# Overlay colors of the map validator, per kind of conflict.
+CONFLICT_COLORS = {"overlap": "#FF0000", "restricted": "#FF8C00", "out_of_bounds": "#8E44AD"}
+VALIDATION_DELAY_MS = 300    # the open validation list re-checks this long after the last change
+UNDO_LIMIT = 50              # batch edits kept for undo
+# Object categories for proximity queries; objects placed before categories were stored are
+# recognized by member ID or by their palette color.
+OBJECT_CATEGORIES = ("alliance", "friendly", "enemy", "other", "custom")
+# Influence heatmap: which side (0 = ours, 1 = enemy) and weight each category counts for,
+# the side colors, and how many cells of net presence give a fully opaque color.
+INFLUENCE_SIDES = {"alliance": (0, 1.0), "friendly": (0, 1.0), "enemy": (1, 1.0)}
+INFLUENCE_COLORS = ("#1F618D", "#C0392B")
+INFLUENCE_RADIUS = 15
+INFLUENCE_SATURATION = 27.0
+COLLAB_PORT = 8765           # default port of the collaboration hub
+COLLAB_POLL_MS = 50          # how often the app sends queued edits and applies incoming ones
+SCHEDULE_SYNC_FIELDS = ("conductor_assignments", "vs_tasks_by_weekday")   # saved schedule parts that are shared
+FILE_WATCH_INTERVAL_MS = 1000   # how often the state files are checked for changes made by other programs
+STATE_READ_RETRIES = 3          # checks autosave waits for an unreadable autosave.json before saving over it
+# Canvas layers from bottom to top, the canvas tags of each, and the ones listed in the Layers menu.
+MAP_LAYERS = ("terrain", "heatmap", "grid", "friendly", "enemy", "other", "alliance", "markers", "overlays")
+OBJECT_LAYERS = ("friendly", "enemy", "other", "alliance")
+LAYER_TAGS = {"terrain": ("terrain",), "heatmap": ("influence",), "grid": ("grid",),
+              "friendly": ("friendly",), "enemy": ("enemy",), "other": ("other",), "alliance": ("alliance",),
+              "markers": ("markers",), "overlays": ("validation", "proximity", "search_highlight")}
+LAYER_LABELS = {"terrain": "Terrain", "grid": "Grid Lines", "friendly": "Friendly Objects",
+                "enemy": "Enemy Objects", "other": "Other Objects", "alliance": "Alliance Members",
+                "markers": "Markers", "overlays": "Overlays"}
+STATE_FILE = "autosave.json"
+MAP_CONFIG_FILE = "map_config.json"
+ALLIANCE_MEMBERS_FILE = "alliance_members.txt"
+WEEKLY_SCHEDULE_FILE = "weekly_schedule.json"
+FORMATION_STAMPS_FILE = "formation_stamps.json"
+SCHEDULE_EXPORT_FILES = {"text": "train_conductor_list.txt", "csv": "weekly_schedule.csv", "ics": "weekly_schedule.ics"}
+AVATAR_DIRECTORIES = ("images", os.path.join("Images", "avatars"))
+AVATAR_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif")
+THUMBNAIL_CACHE_DIR = "thumbnail_cache"
+THUMBNAIL_MIP_SIZES = (16, 32, 64, 128, 256, 512)
+AVATAR_LOADER_THREADS = 4    # threads decoding avatars in the background
+AVATAR_POLL_MS = 30          # how often finished avatars are put on screen while some are loading
+AVATAR_RETRY_SECONDS = 30    # an avatar that failed to load is tried again after this long
+PERF_HUD_INTERVAL_MS = 250   # performance overlay refresh rate (4 Hz)
+TEXTURE_CACHE_SIZE = 8       # resized terrain textures kept for recent zoom levels
+# Object labels use a third of the cell size, rounded down to one of these font sizes;
+# below the smallest one labels are left out.
+LABEL_FONT_SIZES = (3, 4, 5, 6, 7, 8, 9, 10, 12, 14, 16, 18, 20, 24, 28, 32, 40, 48)
+LABEL_CACHE_SIZE = 20000     # fitted label texts remembered before the cache starts over
+TRACE_BUFFER_SIZE = 200000   # spans kept by the tracer (oldest are dropped first)
+TRACED_HANDLERS = ("draw_grid", "draw_layers", "redraw_terrain", "redraw_objects", "on_canvas_hover", "on_mouse_move",
+                   "on_left_button_motion", "zoom", "pan", "save_state")
+# Canvas events captured by the interaction recorder, and how each one is fed back on replay.
+# Tk cannot generate "B1-Motion" or "Double-1" directly; the recorded state and time make
+# a plain Motion or ButtonPress match them again.
+RECORDED_EVENTS = ("<ButtonPress-1>", "<B1-Motion>", "<ButtonRelease-1>", "<Double-1>",
+                   "<ButtonPress-2>", "<B2-Motion>", "<ButtonRelease-2>", "<ButtonPress-3>",
+                   "<Motion>", "<MouseWheel>")
+REPLAY_EVENTS = {"<B1-Motion>": "<Motion>", "<B2-Motion>": "<Motion>", "<Double-1>": "<ButtonPress-1>"}
+
+
+class AvatarIndex:
+    """Maps member names (case-insensitive) to avatar files found in the avatar folders.
+    Each folder is listed once and only listed again after its modification time changes."""
+
+    def __init__(self, directories=AVATAR_DIRECTORIES, extensions=AVATAR_EXTENSIONS):
+        self.directories = directories
+        self.extensions = extensions
+        self._scanned = {}   # real path of folder -> mtime_ns at scan time
+        self._index = {}
+
+    def refresh(self):
+        signatures = {}
+        folders = []
+        for directory in self.directories:
+            try:
+                real_dir = os.path.realpath(directory)
+                # The same folder may appear twice on case-insensitive file systems.
+                if real_dir not in signatures:
+                    signatures[real_dir] = os.stat(directory).st_mtime_ns
+                    folders.append(directory)
+            except OSError:
+                continue
+        if signatures == self._scanned:
+            return
+        index = {}
+        for folder_order, directory in enumerate(folders):
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    stem, ext = os.path.splitext(entry.name)
+                    if ext.lower() not in self.extensions or not entry.is_file():
+                        continue
+                    # Keep the first match per name, preferring the folder and extension order given.
+                    key = stem.casefold()
+                    rank = (folder_order, self.extensions.index(ext.lower()))
+                    if key not in index or rank < index[key][0]:
+                        index[key] = (rank, entry.path)
+        self._index = {key: path for key, (rank, path) in index.items()}
+        self._scanned = signatures
+
+    def lookup(self, name):
+        self.refresh()
+        return self._index.get((name or "").strip().casefold())
+
+
+def read_roster_file(path):
+    """Reads a roster from a .json (same format as 'alliance_members.txt') or .csv file.
+    CSV files need a Name column; Rank, Avatar and Size ("3x3") are optional."""
+    if path.lower().endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            rows = json.load(f)
+        if not isinstance(rows, list):
+            raise ValueError("A JSON roster must be a list of members.")
+        return rows
+    rows = []
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        for row in csv.DictReader(f):
+            member = {key.strip().capitalize(): (value or "").strip() for key, value in row.items() if key}
+            if member.get("Size"):
+                member["Size"] = member["Size"].lower().replace(",", "x").split("x")
+            rows.append(member)
+    return rows
+
+
+def write_roster_file(path, members):
+    """Writes members to a .json or .csv file, depending on the extension."""
+    if path.lower().endswith(".json"):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump([{k: v for k, v in m.items() if k != "Id"} for m in members], f, indent=4)
+        return
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Name", "Rank", "Avatar", "Size"])
+        for member in members:
+            size = member.get("Size")
+            writer.writerow([
+                member.get("Name", ""),
+                member.get("Rank", "R1"),
+                member.get("Avatar", ""),
+                f"{size[0]}x{size[1]}" if size else "",
+            ])
+
+
+def plan_roster_import(registry, rows, avatar_index):
+    """Validates imported rows against the registry without changing it.
+    Returns (new_members, updates, problems): updates maps existing member IDs to the
+    changed fields, and problems is a list of human-readable lines for the report."""
+    new_members = []
+    updates = {}
+    problems = []
+    seen = set()
+    for line_no, row in enumerate(rows, start=1):
+        name = str(row.get("Name") or "").strip()
+        rank = str(row.get("Rank") or "R1").strip().upper()
+        if not name:
+            problems.append(f"Entry {line_no}: missing name, skipped.")
+            continue
+        if rank not in ALLIANCE_RANKS:
+            problems.append(f"Entry {line_no}: '{name}' has unknown rank '{rank}', skipped.")
+            continue
+        if name.casefold() in seen:
+            problems.append(f"Entry {line_no}: '{name}' appears more than once, skipped.")
+            continue
+        seen.add(name.casefold())
+        member = {"Name": name, "Rank": rank}
+        avatar = str(row.get("Avatar") or "").strip()
+        if not avatar or (not avatar.startswith("#") and not os.path.exists(avatar)):
+            found = avatar_index.lookup(name)
+            if avatar and not found:
+                problems.append(f"Entry {line_no}: avatar '{avatar}' for '{name}' not found.")
+            avatar = found or ""
+        if avatar:
+            member["Avatar"] = avatar
+        if row.get("Size"):
+            try:
+                w, h = (int(v) for v in row["Size"])
+                if w < 1 or h < 1:
+                    raise ValueError
+                member["Size"] = [w, h]
+            except (TypeError, ValueError):
+                problems.append(f"Entry {line_no}: invalid size for '{name}', using default.")
+        existing = registry.find(name)
+        if existing is None:
+            new_members.append(member)
+            continue
+        changes = {k: v for k, v in member.items() if existing.get(k) != v}
+        if changes:
+            updates[existing["Id"]] = changes
+            described = ", ".join(f"{k}: {existing.get(k)} -> {v}" for k, v in changes.items())
+            problems.append(f"Entry {line_no}: '{existing['Name']}' already exists ({described}).")
+    return new_members, updates, problems
+
+
+def sync_member_objects(model, registry, rank_colors=ALLIANCE_RANK_COLORS):
+    """Gives every placed member base the current name, rank color and avatar of its member.
+    Returns the number of bases changed."""
+    changed = 0
+    for key, data in list(model.iter_objects()):
+        member = registry.get(data.get("member_id"))
+        if member is None:
+            continue
+        fields = {
+            "tag": member.get("Name"),
+            "color": rank_colors.get(member.get("Rank", "R1"), "#000000"),
+            "avatar": member.get("Avatar"),
+        }
+        if any(data.get(k) != v for k, v in fields.items()):
+            model.update_object(key, **fields)
+            changed += 1
+    return changed
+
+
+def member_object_data(member, rank_colors=ALLIANCE_RANK_COLORS):
+    """Placed-object data for a member's base, as placing it from the Alliance Members menu would create."""
+    return {
+        "tag": member.get("Name", "Unnamed"),
+        "color": rank_colors.get(member.get("Rank", "R1"), "#000000"),
+        "size": tuple(member.get("Size") or (3, 3)),
+        "avatar": member.get("Avatar"),
+        "member_id": member["Id"],
+    }
+
+
+def spiral_offsets(radius):
+    """Offsets (dx, dy) ring by ring out to a Chebyshev radius, each ring ordered by distance."""
+    yield 0, 0
+    for r in range(1, radius + 1):
+        ring = [(dx, -r) for dx in range(-r, r + 1)] + [(dx, r) for dx in range(-r, r + 1)]
+        ring += [(-r, dy) for dy in range(-r + 1, r)] + [(r, dy) for dy in range(-r + 1, r)]
+        ring.sort(key=lambda offset: offset[0] * offset[0] + offset[1] * offset[1])
+        yield from ring
+
+
+def plan_member_layout(model, members, anchor, region=None, spacing=0, rank_colors=ALLIANCE_RANK_COLORS,
+                       restricted_terrain=RESTRICTED_TERRAIN):
+    """Finds free spots for the given members' bases around an anchor cell, higher ranks first
+    so R5 and R4 end up closest. Bases of these members already on the map are moved, not
+    duplicated. region (x1, y1, x2, y2 grid corners) limits where bases may go; spacing keeps
+    that many free cells between a new base and anything else.
+
+    Free cells are tracked in an occupancy bitmap and candidate centers are tried in a spiral
+    from the anchor. Cells only ever fill up, so once a spot is blocked for one base size it
+    stays blocked and the next base of that size resumes the spiral where the last one stopped.
+    Returns ({new key: object data}, {old key of a moved base: None}, [members that did not fit])."""
+    grid_size = model.grid_size
+    if region is None:
+        x_min, y_min, x_max, y_max = 0, 0, grid_size, grid_size
+    else:
+        x_min, x_max = max(0, min(region[0], region[2])), min(grid_size, max(region[0], region[2]))
+        y_min, y_max = max(0, min(region[1], region[3])), min(grid_size, max(region[1], region[3]))
+    member_ids = {member["Id"] for member in members}
+
+    occupied = bytearray(grid_size * grid_size)
+    def fill(x_start, y_start, w, h):
+        x1, x2 = max(0, x_start), min(grid_size, x_start + w)
+        for y in range(max(0, y_start), min(grid_size, y_start + h)):
+            occupied[y * grid_size + x1:y * grid_size + x2] = b"\x01" * max(0, x2 - x1)
+
+    removed = {}
+    for key, data in model.iter_objects():
+        if data.get("member_id") in member_ids:
+            removed[key] = None
+        else:
+            fill(*model.object_rect(key, data))
+    for (x, y), terrain in model.terrain_cells.items():
+        if terrain in restricted_terrain and model.in_bounds(x, y):
+            occupied[y * grid_size + x] = 1
+
+    def is_free(x_start, y_start, w, h):
+        if x_start < x_min or y_start < y_min or x_start + w > x_max or y_start + h > y_max:
+            return False
+        x1, x2 = max(0, x_start - spacing), min(grid_size, x_start + w + spacing)
+        for y in range(max(0, y_start - spacing), min(grid_size, y_start + h + spacing)):
+            if any(occupied[y * grid_size + x1:y * grid_size + x2]):
+                return False
+        return True
+
+    rank_order = {rank: index for index, rank in enumerate(reversed(ALLIANCE_RANKS))}
+    ordered = sorted(members, key=lambda m: (rank_order.get(m.get("Rank", "R1"), len(ALLIANCE_RANKS)),
+                                             str(m.get("Name", "")).casefold()))
+    radius = max(anchor[0] - x_min, x_max - anchor[0], anchor[1] - y_min, y_max - anchor[1])
+    spiral = spiral_offsets(radius)
+    candidates = []      # spiral offsets generated so far
+    resume = {}          # base size -> index into candidates of the first spot not yet known to be blocked
+    added = {}
+    unplaced = []
+    for member in ordered:
+        data = member_object_data(member, rank_colors)
+        w, h = data["size"]
+        index = resume.get((w, h), 0)
+        while True:
+            if index == len(candidates):
+                offset = next(spiral, None)
+                if offset is None:
+                    break
+                candidates.append(offset)
+            x, y = anchor[0] + candidates[index][0], anchor[1] + candidates[index][1]
+            if (x, y) not in added and is_free(x - w // 2, y - h // 2, w, h):
+                break
+            index += 1
+        resume[(w, h)] = index
+        if index == len(candidates):
+            unplaced.append(member)
+            continue
+        added[(x, y)] = data
+        fill(x - w // 2, y - h // 2, w, h)
+    for key in added:
+        removed.pop(key, None)
+    return added, removed, unplaced
+
+
+class OccupancyGrid:
+    """How many objects cover each grid cell (placed markers don't count), kept current from
+    model events, so a whole group of rectangles can be tested against the map at once."""
+
+    def __init__(self, model):
+        self.model = model
+        self.rebuild()
+
+    def rebuild(self):
+        self.chunks = {}       # (chunk x, chunk y) -> CHUNK_SIZE * CHUNK_SIZE counts, only where something is
+        self.footprints = {}   # key -> clipped (x1, y1, x2, y2) counted in chunks
+        for key, data in self.model.iter_objects():
+            self._add(key, data)
+
+    def _cover(self, rect, delta):
+        x1, y1, x2, y2 = rect
+        for cy in range(y1 // CHUNK_SIZE, (y2 - 1) // CHUNK_SIZE + 1):
+            for cx in range(x1 // CHUNK_SIZE, (x2 - 1) // CHUNK_SIZE + 1):
+                chunk = self.chunks.get((cx, cy))
+                if chunk is None:
+                    chunk = self.chunks[(cx, cy)] = bytearray(CHUNK_SIZE * CHUNK_SIZE)
+                left = max(x1, cx * CHUNK_SIZE) - cx * CHUNK_SIZE
+                right = min(x2, (cx + 1) * CHUNK_SIZE) - cx * CHUNK_SIZE
+                for y in range(max(y1, cy * CHUNK_SIZE), min(y2, (cy + 1) * CHUNK_SIZE)):
+                    row = (y - cy * CHUNK_SIZE) * CHUNK_SIZE
+                    chunk[row + left:row + right] = bytes(min(255, max(0, c + delta)) for c in chunk[row + left:row + right])
+                if delta < 0 and not any(chunk):
+                    del self.chunks[(cx, cy)]
+
+    def window(self, x1, y1, x2, y2):
+        """Counts of the cells in [x1, x2) x [y1, y2) as one row-major bytearray."""
+        width = x2 - x1
+        counts = bytearray(width * (y2 - y1))
+        for (cx, cy), chunk in self.chunks.items():
+            left, right = max(x1, cx * CHUNK_SIZE), min(x2, (cx + 1) * CHUNK_SIZE)
+            if left >= right:
+                continue
+            for y in range(max(y1, cy * CHUNK_SIZE), min(y2, (cy + 1) * CHUNK_SIZE)):
+                row = (y - cy * CHUNK_SIZE) * CHUNK_SIZE - cx * CHUNK_SIZE
+                counts[(y - y1) * width + left - x1:(y - y1) * width + right - x1] = chunk[row + left:row + right]
+        return counts
+
+    def count(self, x, y):
+        chunk = self.chunks.get((x // CHUNK_SIZE, y // CHUNK_SIZE))
+        return chunk[(y % CHUNK_SIZE) * CHUNK_SIZE + x % CHUNK_SIZE] if chunk else 0
+
+    def _add(self, key, data):
+        if data.get("is_marker"):
+            return
+        x_start, y_start, w, h = self.model.object_rect(key, data)
+        size = self.model.grid_size
+        rect = (max(0, x_start), max(0, y_start), min(size, x_start + w), min(size, y_start + h))
+        if rect[0] < rect[2] and rect[1] < rect[3]:
+            self.footprints[key] = rect
+            self._cover(rect, 1)
+
+    def _remove(self, key):
+        rect = self.footprints.pop(key, None)
+        if rect is not None:
+            self._cover(rect, -1)
+
+    def apply(self, event, payload):
+        if event == "reset":
+            self.rebuild()
+        elif event == "object_added":
+            self._add(payload["key"], payload["data"])
+        elif event == "object_removed":
+            self._remove(payload["key"])
+        elif event == "object_changed":
+            if payload["data"].get("size") != payload["previous"].get("size"):
+                self._remove(payload["key"])
+                self._add(payload["key"], payload["data"])
+        elif event == "objects_moved":
+            moves = payload["moves"]
+            for old in moves:
+                self._remove(old)
+            for new in moves.values():
+                self._add(new, self.model.placed_objects[new])
+
+    def blocked(self, rects, ignore=()):
+        """Indices of the rectangles (x_start, y_start, w, h) that leave the grid or cover a cell
+        taken by an object other than those in ignore. The counts under the group are copied
+        out of the chunks once; with NumPy all rectangles of one size are then looked up in a
+        single gather."""
+        size = self.model.grid_size
+        inside = [index for index, (x, y, w, h) in enumerate(rects)
+                  if x >= 0 and y >= 0 and x + w <= size and y + h <= size]
+        found = sorted(set(range(len(rects))).difference(inside))
+        if inside:
+            x1 = min(rects[index][0] for index in inside)
+            y1 = min(rects[index][1] for index in inside)
+            x2 = max(rects[index][0] + rects[index][2] for index in inside)
+            y2 = max(rects[index][1] + rects[index][3] for index in inside)
+            width = x2 - x1
+            counts = self.window(x1, y1, x2, y2)
+            if np is not None:
+                boxes = np.asarray([rects[index] for index in inside], dtype=np.int64).reshape(-1, 4)
+                boxes[:, 0] -= x1
+                boxes[:, 1] -= y1
+                hits = np.zeros(len(boxes), dtype=bool)
+                counts = np.frombuffer(counts, dtype=np.uint8)
+                for w, h in {(int(w), int(h)) for w, h in boxes[:, 2:]}:
+                    rows = np.flatnonzero((boxes[:, 2] == w) & (boxes[:, 3] == h))
+                    dy, dx = np.divmod(np.arange(w * h), w)
+                    cells = (boxes[rows, 1:2] + dy) * width + boxes[rows, 0:1] + dx
+                    hits[rows] = counts[cells].any(axis=1)
+                found += [inside[row] for row in np.flatnonzero(hits).tolist()]
+            else:
+                for index in inside:
+                    x, y, w, h = rects[index]
+                    if any(any(counts[(row - y1) * width + x - x1:(row - y1) * width + x - x1 + w])
+                           for row in range(y, y + h)):
+                        found.append(index)
+            found.sort()
+        if found and ignore:
+            found = [index for index in found if self._blocked_without(rects[index], ignore)]
+        return found
+
+    def _blocked_without(self, rect, ignore):
+        size = self.model.grid_size
+        x, y, w, h = rect
+        if x < 0 or y < 0 or x + w > size or y + h > size:
+            return True
+        ignored = [self.footprints[key] for key in ignore if key in self.footprints]
+        for cy in range(y, y + h):
+            for cx in range(x, x + w):
+                count = self.count(cx, cy)
+                if count and count > sum(1 for x1, y1, x2, y2 in ignored if x1 <= cx < x2 and y1 <= cy < y2):
+                    return True
+        return False
+
+
+def copy_formation(model, keys):
+    """A formation of the given objects and placed markers, relative to the middle cell of
+    the group: {"objects": [[dx, dy, data], ...], "markers": [[name, [x1, y1, x2, y2], data], ...]}."""
+    objects = [(key, model.placed_objects[key]) for key in keys if key in model.placed_objects]
+    if not objects:
+        return None
+    corners = []
+    for key, data in objects:
+        if data.get("is_marker"):
+            x1, y1, x2, y2 = data["bbox"]
+            corners += [(x1, y1), (x2, y2)]
+        else:
+            x_start, y_start, w, h = model.object_rect(key, data)
+            corners += [(x_start, y_start), (x_start + w, y_start + h)]
+    anchor_x = int((min(x for x, _ in corners) + max(x for x, _ in corners)) // 2)
+    anchor_y = int((min(y for _, y in corners) + max(y for _, y in corners)) // 2)
+    formation = {"objects": [], "markers": []}
+    for key, data in sorted(objects, key=lambda item: str(item[0])):
+        data = json.loads(json.dumps(data))
+        if data.get("is_marker"):
+            x1, y1, x2, y2 = data.pop("bbox")
+            formation["markers"].append([key[1], [x1 - anchor_x, y1 - anchor_y, x2 - anchor_x, y2 - anchor_y], data])
+        else:
+            formation["objects"].append([key[0] - anchor_x, key[1] - anchor_y, data])
+    return formation
+
+
+def plan_formation(model, occupancy, formation, x, y):
+    """Object changes that paste a formation with its middle on cell (x, y), and the indices of
+    the formation's objects that would leave the grid or land on other objects. A member base
+    already on the map is moved rather than duplicated. Pasted markers get a free name."""
+    changes = {}
+    rects = []
+    replaced = set()
+    for dx, dy, data in formation["objects"]:
+        key = (x + dx, y + dy)
+        member_id = data.get("member_id")
+        if member_id is not None:
+            previous = model.find_object(member_id=member_id)
+            if previous is not None and previous not in changes:
+                changes[previous] = None
+                replaced.add(previous)
+        changes[key] = dict(data)
+        rects.append(model.object_rect(key, data))
+    for name, (x1, y1, x2, y2), data in formation["markers"]:
+        new_name, copy_number = name, 1
+        while ("marker", new_name) in model.placed_objects or ("marker", new_name) in changes:
+            copy_number += 1
+            new_name = f"{name} ({copy_number})"
+        changes[("marker", new_name)] = dict(data, tag=new_name, bbox=(x1 + x, y1 + y, x2 + x, y2 + y))
+    return changes, occupancy.blocked(rects, ignore=replaced)
+
+
+class MinimapRaster:
+    """A small overview image of the map with one pixel per block of cells, showing terrain
+    and object colors. Model events patch only the pixels they touch; a full render only
+    happens on a reset."""
+
+    def __init__(self, model, cells_per_px=MINIMAP_CELLS_PER_PX, terrain_colors=None, background="#FFFFFF"):
+        self.model = model
+        self.cells_per_px = cells_per_px
+        self.size = (model.grid_size + cells_per_px - 1) // cells_per_px
+        self.background = ImageColor.getrgb(background)
+        self.terrain_colors = {name: ImageColor.getrgb(color) for name, color in (terrain_colors or {}).items()}
+        self.rebuild()
+
+    def rebuild(self):
+        self.image = Image.new("RGB", (self.size, self.size), self.background)
+        self.pixels = self.image.load()
+        self.terrain = {}                            # pixel -> color of the last terrain set in its block
+        self.cover = collections.defaultdict(list)   # pixel -> keys of the objects on it, topmost last
+        self.object_pixels = {}                      # key -> pixels the object covers
+        self.object_colors = {}
+        for cell, terrain in self.model.terrain_cells.items():
+            self._set_terrain(cell, terrain)
+        for key, data in self.model.iter_objects():
+            self._add(key, data)
+
+    def pixel_of(self, x, y):
+        # Grid y grows upwards, image rows downwards.
+        return x // self.cells_per_px, (self.model.grid_size - 1 - y) // self.cells_per_px
+
+    def cell_at(self, px, py):
+        """The grid cell in the middle of minimap point (px, py)."""
+        x = (px + 0.5) * self.cells_per_px
+        y = self.model.grid_size - 1 - (py + 0.5) * self.cells_per_px
+        return x, y
+
+    def viewport(self, view_width, view_height):
+        """Minimap rectangle of the part of the map shown on a view_width x view_height canvas."""
+        scale = self.model.cell_px * self.cells_per_px
+        return (-self.model.pan_x / scale, -self.model.pan_y / scale,
+                (view_width - self.model.pan_x) / scale, (view_height - self.model.pan_y) / scale)
+
+    def _rect_pixels(self, key, data):
+        x_start, y_start, w, h = self.model.object_rect(key, data)
+        left, top = self.pixel_of(max(0, x_start), min(self.model.grid_size - 1, y_start + h - 1))
+        right, bottom = self.pixel_of(min(self.model.grid_size - 1, x_start + w - 1), max(0, y_start))
+        return [(px, py) for px in range(left, right + 1) for py in range(top, bottom + 1)]
+
+    def _repaint(self, pixel):
+        keys = self.cover.get(pixel)
+        if keys:
+            self.pixels[pixel] = self.object_colors[keys[-1]]
+        else:
+            self.pixels[pixel] = self.terrain.get(pixel, self.background)
+
+    def _set_terrain(self, cell, terrain):
+        pixel = self.pixel_of(*cell)
+        if not (0 <= pixel[0] < self.size and 0 <= pixel[1] < self.size):
+            return None
+        self.terrain[pixel] = self.terrain_colors.get(terrain, self.background)
+        self._repaint(pixel)
+        return pixel
+
+    def _add(self, key, data):
+        try:
+            color = ImageColor.getrgb(data.get("color", "#000000"))[:3]
+        except ValueError:
+            color = (0, 0, 0)
+        pixels = self._rect_pixels(key, data)
+        self.object_pixels[key] = pixels
+        self.object_colors[key] = color
+        for pixel in pixels:
+            self.cover[pixel].append(key)
+            self.pixels[pixel] = color
+        return pixels
+
+    def _remove(self, key):
+        pixels = self.object_pixels.pop(key, [])
+        self.object_colors.pop(key, None)
+        for pixel in pixels:
+            keys = self.cover[pixel]
+            keys.remove(key)
+            if not keys:
+                del self.cover[pixel]
+            self._repaint(pixel)
+        return pixels
+
+    def apply(self, event, payload):
+        """Patches the raster for a model event. Returns the set of changed pixels,
+        or None when the whole image was rendered again."""
+        dirty = set()
+        if event == "reset":
+            self.rebuild()
+            return None
+        if event == "object_added":
+            if not payload["data"].get("is_marker"):
+                dirty.update(self._add(payload["key"], payload["data"]))
+        elif event == "object_removed":
+            dirty.update(self._remove(payload["key"]))
+        elif event == "object_changed":
+            if payload["key"] in self.object_pixels:
+                dirty.update(self._remove(payload["key"]))
+                dirty.update(self._add(payload["key"], payload["data"]))
+        elif event == "objects_moved":
+            # Remove everything first so objects that swapped places end up right.
+            moves = payload["moves"]
+            for old in moves:
+                dirty.update(self._remove(old))
+            for new in moves.values():
+                dirty.update(self._add(new, self.model.placed_objects[new]))
+        elif event == "terrain_changed":
+            for cell, terrain in payload["cells"].items():
+                pixel = self._set_terrain(cell, terrain)
+                if pixel is not None:
+                    dirty.add(pixel)
+        return dirty
+
+
+class SearchIndex:
+    """Finds placed objects and markers by name. Every word of a name is a key in a sorted
+    list searched with bisect, so prefix lookups stay fast with thousands of entries;
+    names sharing enough trigrams with the query catch typos. Model events keep it current."""
+
+    def __init__(self, model):
+        self.model = model
+        self.rebuild()
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(str(text or "").casefold().split())
+
+    @staticmethod
+    def trigrams(text):
+        padded = f"  {text} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def rebuild(self):
+        self.ids = {}          # entry -> number used in the sorted list and trigram sets
+        self.entries = {}      # number -> (entry, label)
+        self.words = []        # sorted (text from a word start to the end, number)
+        self.grams = collections.defaultdict(set)
+        self.next_id = 0
+        for key, data in self.model.placed_objects.items():
+            self.add(("object", key), self.object_label(data))
+
+    @staticmethod
+    def object_label(data):
+        return data.get("tag") or data.get("name")
+
+    def _word_keys(self, text):
+        return [text[i:] for i in range(len(text)) if i == 0 or text[i - 1] == " "]
+
+    def add(self, entry, label):
+        text = self.normalize(label)
+        if not text or entry in self.ids:
+            return
+        number = self.next_id
+        self.next_id += 1
+        self.ids[entry] = number
+        self.entries[number] = (entry, label)
+        for word in self._word_keys(text):
+            bisect.insort(self.words, (word, number))
+        for gram in self.trigrams(text):
+            self.grams[gram].add(number)
+
+    def remove(self, entry):
+        number = self.ids.pop(entry, None)
+        if number is None:
+            return
+        _, label = self.entries.pop(number)
+        text = self.normalize(label)
+        for word in self._word_keys(text):
+            i = bisect.bisect_left(self.words, (word, number))
+            if i < len(self.words) and self.words[i] == (word, number):
+                del self.words[i]
+        for gram in self.trigrams(text):
+            self.grams[gram].discard(number)
+
+    def apply(self, event, payload):
+        if event == "reset":
+            self.rebuild()
+        elif event == "object_added":
+            self.add(("object", payload["key"]), self.object_label(payload["data"]))
+        elif event == "object_removed":
+            self.remove(("object", payload["key"]))
+        elif event == "object_changed":
+            self.remove(("object", payload["key"]))
+            self.add(("object", payload["key"]), self.object_label(payload["data"]))
+        elif event == "objects_moved":
+            moves = payload["moves"]
+            for old in moves:
+                self.remove(("object", old))
+            for new in moves.values():
+                self.add(("object", new), self.object_label(self.model.placed_objects[new]))
+
+    def search(self, query, limit=10):
+        """Returns up to limit (entry, label) pairs: names starting with the query first,
+        then names with a word starting with it, then close fuzzy matches."""
+        text = self.normalize(query)
+        if not text:
+            return []
+        starts, word_hits = [], []
+        seen = set()
+        i = bisect.bisect_left(self.words, (text, -1))
+        while i < len(self.words) and self.words[i][0].startswith(text) and len(starts) < limit:
+            number = self.words[i][1]
+            if number not in seen:
+                seen.add(number)
+                label_text = self.normalize(self.entries[number][1])
+                (starts if label_text.startswith(text) else word_hits).append(number)
+            i += 1
+        found = (starts + word_hits)[:limit]
+        if len(found) < limit and len(text) >= 3:
+            query_grams = self.trigrams(text)
+            scores = collections.Counter()
+            for gram in query_grams:
+                scores.update(self.grams.get(gram, ()))
+            needed = max(2, len(query_grams) // 2)
+            for number, score in scores.most_common():
+                if score < needed or len(found) >= limit:
+                    break
+                if number not in seen:
+                    found.append(number)
+        return [self.entries[number] for number in found]
+
+    def location(self, entry):
+        """Grid rectangle (x1, y1, x2, y2) of an entry, or None if it is gone."""
+        _, key = entry
+        data = self.model.placed_objects.get(key)
+        if data is None:
+            return None
+        if data.get("is_marker"):
+            return tuple(data["bbox"])
+        x_start, y_start, w, h = self.model.object_rect(key, data)
+        return x_start, y_start, x_start + w, y_start + h
+
+
+def object_category(data, palettes=None):
+    """Category of a placed object: the stored one, "alliance" for member bases, else the
+    palette (e.g. {"enemy": {"1": "#922B21", ...}}) whose colors include the object's color."""
+    if data.get("category"):
+        return data["category"]
+    if data.get("member_id") is not None:
+        return "alliance"
+    color = str(data.get("color", "")).upper()
+    for category, palette in (palettes or {}).items():
+        if any(str(c).upper() == color for c in palette.values()):
+            return category
+    return "other"
+
+
+class KDTree:
+    """Static 2-d tree over (x, y, key) points, stored implicitly in one list: the node of
+    a slice [lo, hi) is its middle element, split on x at even depths and on y at odd ones."""
+
+    def __init__(self, points):
+        self.points = list(points)
+        self._build(0, len(self.points), 0)
+
+    def _build(self, lo, hi, axis):
+        if hi - lo <= 1:
+            return
+        self.points[lo:hi] = sorted(self.points[lo:hi], key=lambda point: point[axis])
+        mid = (lo + hi) // 2
+        self._build(lo, mid, 1 - axis)
+        self._build(mid + 1, hi, 1 - axis)
+
+    def __len__(self):
+        return len(self.points)
+
+    def nearest(self, x, y, k=1, skip=()):
+        """The k points closest to (x, y) as (squared distance, key), nearest first."""
+        points = self.points
+        best = []   # max-heap of (-squared distance, index)
+
+        def visit(lo, hi, axis):
+            if lo >= hi:
+                return
+            mid = (lo + hi) // 2
+            px, py, key = points[mid]
+            d2 = (px - x) * (px - x) + (py - y) * (py - y)
+            if key not in skip:
+                if len(best) < k:
+                    heapq.heappush(best, (-d2, mid))
+                elif d2 < -best[0][0]:
+                    heapq.heapreplace(best, (-d2, mid))
+            diff = x - px if axis == 0 else y - py
+            if diff < 0:
+                visit(lo, mid, 1 - axis)
+                if len(best) < k or diff * diff < -best[0][0]:
+                    visit(mid + 1, hi, 1 - axis)
+            else:
+                visit(mid + 1, hi, 1 - axis)
+                if len(best) < k or diff * diff < -best[0][0]:
+                    visit(lo, mid, 1 - axis)
+
+        visit(0, len(points), 0)
+        return sorted((-d2, points[index][2]) for d2, index in best)
+
+    def within(self, x, y, radius, skip=()):
+        """Points no further than radius from (x, y) as (squared distance, key)."""
+        points = self.points
+        r2 = radius * radius
+        found = []
+        stack = [(0, len(points), 0)]
+        while stack:
+            lo, hi, axis = stack.pop()
+            if lo >= hi:
+                continue
+            mid = (lo + hi) // 2
+            px, py, key = points[mid]
+            d2 = (px - x) * (px - x) + (py - y) * (py - y)
+            if d2 <= r2 and key not in skip:
+                found.append((d2, key))
+            diff = x - px if axis == 0 else y - py
+            if diff <= radius:
+                stack.append((lo, mid, 1 - axis))
+            if diff >= -radius:
+                stack.append((mid + 1, hi, 1 - axis))
+        return found
+
+
+class ProximityIndex:
+    """k-nearest and radius queries over object centers, with one KD-tree per category.
+
+    Model events patch the index: new objects go to a small unsorted list that queries scan
+    directly, removed ones are skipped in the tree, and a category's tree is only rebuilt
+    when those patches grow past an eighth of its size. Distances are in grid cells."""
+
+    def __init__(self, model, categorize=object_category):
+        self.model = model
+        self.categorize = categorize
+        self.rebuild()
+
+    def rebuild(self):
+        self.positions = collections.defaultdict(dict)   # category -> key -> (x, y)
+        self.categories = {}                             # key -> category
+        self.trees = {}
+        self.tree_keys = {}                              # category -> keys in its tree
+        self.pending = collections.defaultdict(set)      # category -> keys added since the tree was built
+        self.removed = collections.defaultdict(set)      # category -> keys in the tree that are gone
+        for key, data in self.model.iter_objects():
+            self._add(key, data)
+
+    def _add(self, key, data):
+        category = self.categorize(data)
+        self.categories[key] = category
+        self.positions[category][key] = (key[0], key[1])
+        self.pending[category].add(key)
+
+    def _remove(self, key):
+        category = self.categories.pop(key, None)
+        if category is None:
+            return
+        del self.positions[category][key]
+        self.pending[category].discard(key)
+        if key in self.tree_keys.get(category, ()):
+            self.removed[category].add(key)
+
+    def apply(self, event, payload):
+        if event == "reset":
+            self.rebuild()
+        elif event == "object_added":
+            if not payload["data"].get("is_marker"):
+                self._add(payload["key"], payload["data"])
+        elif event == "object_removed":
+            self._remove(payload["key"])
+        elif event == "object_changed":
+            self._remove(payload["key"])
+            if not payload["data"].get("is_marker"):
+                self._add(payload["key"], payload["data"])
+        elif event == "objects_moved":
+            moves = payload["moves"]
+            for old in moves:
+                self._remove(old)
+            for new in moves.values():
+                self._add(new, self.model.placed_objects[new])
+
+    def _tree(self, category):
+        tree = self.trees.get(category)
+        patches = len(self.pending[category]) + len(self.removed[category])
+        if tree is None or patches > max(16, len(tree) // 8):
+            positions = self.positions[category]
+            tree = self.trees[category] = KDTree((x, y, key) for key, (x, y) in positions.items())
+            self.tree_keys[category] = set(positions)
+            self.pending[category].clear()
+            self.removed[category].clear()
+        return tree
+
+    def nearest(self, x, y, category, k=1, exclude=()):
+        """The k objects of a category closest to (x, y) as (distance, key), nearest first."""
+        tree = self._tree(category)
+        skip = self.removed[category] | set(exclude) if exclude else self.removed[category]
+        found = tree.nearest(x, y, k, skip)
+        positions = self.positions[category]
+        for key in self.pending[category]:
+            # An edited object is both removed from the tree and pending; only the tree copy is stale.
+            if key not in exclude:
+                px, py = positions[key]
+                found.append(((px - x) ** 2 + (py - y) ** 2, key))
+        found.sort()
+        return [(d2 ** 0.5, key) for d2, key in found[:k]]
+
+    def within(self, x, y, radius, category):
+        """Objects of a category within radius of (x, y) as (distance, key), nearest first."""
+        tree = self._tree(category)
+        found = tree.within(x, y, radius, self.removed[category])
+        positions = self.positions[category]
+        for key in self.pending[category]:
+            px, py = positions[key]
+            d2 = (px - x) ** 2 + (py - y) ** 2
+            if d2 <= radius * radius:
+                found.append((d2, key))
+        found.sort()
+        return [(d2 ** 0.5, key) for d2, key in found]
+
+    def nearest_pairs(self, sources, target, k=1):
+        """For every object in the source categories, its k nearest objects of the target
+        category: a list of (source key, [(distance, key), ...])."""
+        results = []
+        for category in sources:
+            for key in sorted(self.positions[category]):
+                results.append((key, self.nearest(key[0], key[1], target, k, exclude=(key,))))
+        return results
+
+
+class InfluenceMap:
+    """Which side controls each cell: the weighted footprint cells of our objects minus the
+    enemy's within a square radius, colored as an RGBA raster (top row = highest y).
+
+    Presence is kept as one NumPy array per side and the sums come from an integral image.
+    Edits only mark the rectangle they touch; update() recomputes that rectangle grown by
+    the radius, and nothing else. Needs NumPy."""
+
+    def __init__(self, model, radius=INFLUENCE_RADIUS, opacity=60, categorize=object_category,
+                 sides=INFLUENCE_SIDES, colors=INFLUENCE_COLORS, saturation=INFLUENCE_SATURATION):
+        self.model = model
+        self.radius = radius
+        self.opacity = opacity
+        self.categorize = categorize
+        self.sides = sides
+        self.colors = np.array([ImageColor.getrgb(color) for color in colors], dtype=np.uint8)
+        self.saturation = saturation
+        self.rebuild()
+
+    def rebuild(self):
+        size = self.model.grid_size
+        self.presence = np.zeros((size, size), dtype=np.float32)   # ours minus theirs, indexed [y, x]
+        self.balance = np.zeros((size, size), dtype=np.float32)
+        self.rgba = np.zeros((size, size, 4), dtype=np.uint8)
+        self.footprints = {}   # key -> (signed weight, x1, y1, x2, y2) added to presence
+        self.dirty = [(0, 0, size, size)]   # rectangles to recompute
+        for key, data in self.model.iter_objects():
+            self._add(key, data)
+
+    def _add(self, key, data):
+        side = self.sides.get(self.categorize(data))
+        if side is None:
+            return
+        x_start, y_start, w, h = self.model.object_rect(key, data)
+        weight = side[1] if side[0] == 0 else -side[1]
+        size = self.model.grid_size
+        rect = (max(0, x_start), max(0, y_start), min(size, x_start + w), min(size, y_start + h))
+        if rect[0] >= rect[2] or rect[1] >= rect[3]:
+            return
+        self.footprints[key] = (weight,) + rect
+        self.presence[rect[1]:rect[3], rect[0]:rect[2]] += weight
+        self._mark(rect)
+
+    def _remove(self, key):
+        footprint = self.footprints.pop(key, None)
+        if footprint is None:
+            return
+        weight, x1, y1, x2, y2 = footprint
+        self.presence[y1:y2, x1:x2] -= weight
+        self._mark((x1, y1, x2, y2))
+
+    def _mark(self, rect):
+        r = self.radius
+        self.dirty.append((rect[0] - r, rect[1] - r, rect[2] + r, rect[3] + r))
+        if len(self.dirty) > 32:
+            # Many scattered edits (e.g. an auto layout): one bounding window is cheaper by then.
+            self.dirty = [(min(d[0] for d in self.dirty), min(d[1] for d in self.dirty),
+                           max(d[2] for d in self.dirty), max(d[3] for d in self.dirty))]
+
+    def apply(self, event, payload):
+        if event == "reset":
+            self.rebuild()
+        elif event == "object_added":
+            if not payload["data"].get("is_marker"):
+                self._add(payload["key"], payload["data"])
+        elif event == "object_removed":
+            self._remove(payload["key"])
+        elif event == "object_changed":
+            self._remove(payload["key"])
+            if not payload["data"].get("is_marker"):
+                self._add(payload["key"], payload["data"])
+        elif event == "objects_moved":
+            moves = payload["moves"]
+            for old in moves:
+                self._remove(old)
+            for new in moves.values():
+                self._add(new, self.model.placed_objects[new])
+
+    def set_radius(self, radius):
+        self.radius = max(1, int(radius))
+        self.dirty = [(0, 0, self.model.grid_size, self.model.grid_size)]
+
+    def set_opacity(self, opacity):
+        self.opacity = opacity
+        self.dirty = [(0, 0, self.model.grid_size, self.model.grid_size)]
+
+    def update(self):
+        """Recomputes the rectangles touched since the last update and returns them."""
+        dirty, self.dirty = self.dirty, []
+        size = self.model.grid_size
+        done = []
+        for x1, y1, x2, y2 in dirty:
+            x1, y1, x2, y2 = max(0, x1), max(0, y1), min(size, x2), min(size, y2)
+            if x1 < x2 and y1 < y2:
+                self._recompute(x1, y1, x2, y2)
+                done.append((x1, y1, x2, y2))
+        return done
+
+    def _recompute(self, x1, y1, x2, y2):
+        size, r = self.model.grid_size, self.radius
+        # Integral image of the presence around the window; each box is clipped to the grid.
+        sx1, sy1, sx2, sy2 = max(0, x1 - r), max(0, y1 - r), min(size, x2 + r), min(size, y2 + r)
+        integral = np.zeros((sy2 - sy1 + 1, sx2 - sx1 + 1), dtype=np.float64)
+        integral[1:, 1:] = self.presence[sy1:sy2, sx1:sx2].cumsum(0).cumsum(1)
+        ys = np.arange(y1, y2) - sy1
+        xs = np.arange(x1, x2) - sx1
+        y_lo, y_hi = np.clip(ys - r, 0, sy2 - sy1), np.clip(ys + r + 1, 0, sy2 - sy1)
+        x_lo, x_hi = np.clip(xs - r, 0, sx2 - sx1), np.clip(xs + r + 1, 0, sx2 - sx1)
+        box = (integral[np.ix_(y_hi, x_hi)] - integral[np.ix_(y_lo, x_hi)]
+               - integral[np.ix_(y_hi, x_lo)] + integral[np.ix_(y_lo, x_lo)])
+        self.balance[y1:y2, x1:x2] = box
+        self._colorize(x1, y1, x2, y2)
+
+    def _colorize(self, x1, y1, x2, y2):
+        balance = self.balance[y1:y2, x1:x2]
+        strength = np.minimum(np.abs(balance) / self.saturation, 1.0)
+        # Same opacity scale as the grid lines: 0-100 percent, here scaled by how clear the lead is.
+        alpha = (strength * (self.opacity / 100.0) * 255).astype(np.uint8)
+        colors = np.where((balance < 0)[..., None], self.colors[1], self.colors[0])
+        size = self.model.grid_size
+        rows = slice(size - y2, size - y1)   # raster rows run from the top of the map down
+        self.rgba[rows, x1:x2, :3] = colors[::-1]
+        self.rgba[rows, x1:x2, 3] = alpha[::-1]
+
+    def image(self, x1, y1, x2, y2):
+        """RGBA image of the cells x1 <= x < x2, y1 <= y < y2, one pixel per cell."""
+        size = self.model.grid_size
+        return Image.fromarray(self.rgba[size - y2:size - y1, x1:x2], "RGBA")
+
+
+class PerfStats:
+    """Keeps the last few durations (in seconds) of each named stage, e.g. "draw_grid",
+    so the performance overlay can show the latest and rolling-average times."""
+
+    def __init__(self, window=30):
+        self.window = window
+        self.samples = {}
+
+    def record(self, name, seconds):
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = collections.deque(maxlen=self.window)
+        samples.append(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def last(self, name):
+        samples = self.samples.get(name)
+        return samples[-1] if samples else None
+
+    def average(self, name):
+        samples = self.samples.get(name)
+        return sum(samples) / len(samples) if samples else None
+
+
+class Tracer:
+    """Records how long instrumented methods take, for viewing as a Chrome trace in
+    Perfetto or about:tracing. Spans go into a fixed-size ring buffer; while tracing is
+    disabled a wrapped method costs one extra call and a flag check."""
+
+    def __init__(self, capacity=TRACE_BUFFER_SIZE, enabled=False):
+        self.enabled = enabled
+        self.spans = collections.deque(maxlen=capacity)   # (name, start_ns, duration_ns)
+        self.origin_ns = time.perf_counter_ns()
+
+    def wrap(self, func, name):
+        def traced(*args, **kwargs):
+            if not self.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.spans.append((name, start, time.perf_counter_ns() - start))
+        traced.__name__ = getattr(func, "__name__", name)
+        traced.__doc__ = getattr(func, "__doc__", None)
+        return traced
+
+    def instrument(self, obj, names):
+        """Replaces each named method on obj (the instance, not its class) with a traced
+        version. Must run before the methods are bound to Tk events."""
+        for name in names:
+            setattr(obj, name, self.wrap(getattr(obj, name), name))
+
+    def clear(self):
+        self.spans.clear()
+
+    def chrome_trace(self, last_seconds=None):
+        """The recorded spans as a Chrome Trace Event dict, optionally only those
+        that ended within the last last_seconds."""
+        cutoff = None
+        if last_seconds is not None:
+            cutoff = time.perf_counter_ns() - int(last_seconds * 1e9)
+        pid = os.getpid()
+        events = []
+        for name, start, duration in list(self.spans):
+            if cutoff is not None and start + duration < cutoff:
+                continue
+            events.append({
+                "name": name,
+                "cat": "ui",
+                "ph": "X",
+                "ts": (start - self.origin_ns) / 1000,
+                "dur": duration / 1000,
+                "pid": pid,
+                "tid": 0,
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def dump(self, path, last_seconds=None):
+        """Writes the trace to path and returns the number of spans written."""
+        trace = self.chrome_trace(last_seconds)
+        with open(path, "w") as f:
+            json.dump(trace, f)
+        return len(trace["traceEvents"])
+
+
+class InteractionRecorder:
+    """Writes the mouse events a canvas receives to a JSON-lines session file.
+    The first line holds the map state at the start of the recording and the last one
+    the map hash at the end, so a replay can start from and be checked against them.
+
+    Events are caught on a bind tag of their own placed in front of the canvas's, so
+    recording never replaces the app's bindings and still sees events whose handlers
+    return "break"."""
+
+    BIND_TAG = "InteractionRecorder"
+
+    def __init__(self, widget, model):
+        self.widget = widget
+        self.model = model
+        self.file = None
+        self.start_time = None
+        self.count = 0
+        self.bound = False
+
+    @property
+    def recording(self):
+        return self.file is not None
+
+    def start(self, path):
+        if not self.bound:
+            for sequence in RECORDED_EVENTS:
+                self.widget.bind_class(self.BIND_TAG, sequence,
+                                       lambda event, seq=sequence: self.record(seq, event))
+            self.bound = True
+        tags = self.widget.bindtags()
+        if self.BIND_TAG not in tags:
+            self.widget.bindtags((self.BIND_TAG,) + tags)
+        self.file = open(path, "w")
+        self.start_time = time.perf_counter()
+        self.count = 0
+        self.write({
+            "type": "header",
+            "version": 1,
+            "canvas": [self.widget.winfo_width(), self.widget.winfo_height()],
+            "state": self.model.to_state(),
+        })
+
+    def write(self, entry):
+        self.file.write(json.dumps(entry) + "\n")
+
+    def record(self, sequence, event):
+        if self.file is None:
+            return
+        self.write({
+            "type": "event",
+            "t": round(time.perf_counter() - self.start_time, 6),
+            "event": sequence,
+            "x": event.x,
+            "y": event.y,
+            "x_root": event.x_root,
+            "y_root": event.y_root,
+            "state": event.state if isinstance(event.state, int) else 0,
+            "time": event.time,
+            "delta": getattr(event, "delta", 0) or 0,
+        })
+        self.count += 1
+
+    def stop(self):
+        """Finishes the session file and returns the number of events recorded."""
+        if self.file is None:
+            return 0
+        self.write({"type": "end", "hash": self.model.content_hash()})
+        self.file.close()
+        self.file = None
+        self.widget.bindtags(tuple(tag for tag in self.widget.bindtags() if tag != self.BIND_TAG))
+        return self.count
+
+
+def read_session(path):
+    """Returns (header, events, end) from a session file written by InteractionRecorder."""
+    header, events, end = {}, [], {}
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if entry.get("type") == "header":
+                header = entry
+            elif entry.get("type") == "end":
+                end = entry
+            else:
+                events.append(entry)
+    return header, events, end
+
+
+def latency_summary(seconds):
+    """Mean, median, 95th percentile and max of a list of durations, in milliseconds."""
+    if not seconds:
+        return {"count": 0}
+    ordered = sorted(seconds)
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered) * 1000,
+        "p50": ordered[len(ordered) // 2] * 1000,
+        "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        "max": ordered[-1] * 1000,
+    }
+
+
+class InteractionReplayer:
+    """Feeds a recorded session back into a canvas with event_generate and times each
+    event, including the redraw it schedules. Handlers that open dialogs (double-click
+    edit, context menus) wait for input, so sessions meant as benchmarks should avoid them."""
+
+    def __init__(self, root, widget, model):
+        self.root = root
+        self.widget = widget
+        self.model = model
+
+    def replay(self, path, speed="max"):
+        """Replays a session at "max" speed or at its "original" pace and returns a report
+        with per-event latencies and whether the final map hash matches the recording."""
+        header, events, end = read_session(path)
+        if "state" in header:
+            self.model.load_state(header["state"])
+        self.root.update_idletasks()
+
+        latencies = []
+        by_event = {}
+        start = time.perf_counter()
+        for entry in events:
+            if speed == "original":
+                wait = start + entry["t"] - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+            options = {"x": entry["x"], "y": entry["y"], "rootx": entry.get("x_root", 0),
+                       "rooty": entry.get("y_root", 0), "state": entry.get("state", 0), "time": entry.get("time", 0)}
+            if entry["event"] == "<MouseWheel>":
+                options["delta"] = entry.get("delta", 0)
+            event_start = time.perf_counter()
+            self.widget.event_generate(REPLAY_EVENTS.get(entry["event"], entry["event"]), **options)
+            # Redraws are deferred to idle time; count them as part of the event that caused them.
+            self.root.update_idletasks()
+            latency = time.perf_counter() - event_start
+            latencies.append(latency)
+            by_event.setdefault(entry["event"], []).append(latency)
+        wall_time = time.perf_counter() - start
+
+        final_hash = self.model.content_hash()
+        canvas_size = [self.widget.winfo_width(), self.widget.winfo_height()]
+        return {
+            "session": path,
+            "events": len(events),
+            "speed": speed,
+            "wall_time": wall_time,
+            "latency_ms": latency_summary(latencies),
+            "by_event": {sequence: latency_summary(values) for sequence, values in by_event.items()},
+            "hash": final_hash,
+            "expected_hash": end.get("hash"),
+            "hash_matches": end.get("hash") == final_hash,
+            "canvas_size_matches": header.get("canvas") in (None, canvas_size),
+        }
+
+
+class LabelFonts:
+    """Named Tk fonts for object labels, one per size in LABEL_FONT_SIZES, and the part of a
+    label that fits a given box, remembered per (text, size, box). Measuring text goes
+    through Tk, so each label is measured once per zoom level rather than on every redraw."""
+
+    def __init__(self, root, family="Arial"):
+        self.root = root
+        self.family = family
+        self.fonts = {}
+        self.fitted = {}
+        self.hits = 0
+        self.misses = 0
+
+    def size_for(self, cell_px):
+        """Font size for labels at the given cell size, or None when labels would be too small."""
+        index = bisect.bisect_right(LABEL_FONT_SIZES, int(cell_px / 3)) - 1
+        return LABEL_FONT_SIZES[index] if index >= 0 else None
+
+    def font(self, size):
+        font = self.fonts.get(size)
+        if font is None:
+            font = tkfont.Font(self.root, family=self.family, size=size, name=f"cona_label_{size}", exists=False)
+            self.fonts[size] = font
+        return font
+
+    def fit(self, text, size, width, height):
+        """The label as drawn in a width x height pixel box: whole, cut short with an ellipsis,
+        or "" when not even one character fits."""
+        key = (text, size, int(width), int(height))
+        fitted = self.fitted.get(key)
+        if fitted is not None:
+            self.hits += 1
+            return fitted
+        self.misses += 1
+        font = self.font(size)
+        if not text or font.metrics("linespace") > height:
+            fitted = ""
+        elif font.measure(text) <= width:
+            fitted = text
+        else:
+            # Longest prefix that still fits with the ellipsis.
+            low, high = 0, len(text) - 1
+            while low < high:
+                middle = (low + high + 1) // 2
+                if font.measure(text[:middle] + "\u2026") <= width:
+                    low = middle
+                else:
+                    high = middle - 1
+            fitted = text[:low] + "\u2026" if low else ""
+        if len(self.fitted) >= LABEL_CACHE_SIZE:
+            self.fitted.clear()
+        self.fitted[key] = fitted
+        return fitted
+
+
+class ThumbnailCache:
+    """Avatar thumbnails stored on disk, keyed by the content hash of the source image.
+
+    The first request for an image decodes it once and writes every mip size as a
+    small PNG. Later requests, including after a restart, open only the smallest mip
+    that covers the requested size. Exact-size results are kept in a small in-memory
+    LRU, and mip files are evicted least-recently-used first once the cache
+    directory grows past max_bytes. get() may be called from several threads at once."""
+
+    def __init__(self, directory=THUMBNAIL_CACHE_DIR, max_bytes=64 * 1024 * 1024,
+                 mip_sizes=THUMBNAIL_MIP_SIZES, memory_items=256):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.mip_sizes = tuple(sorted(mip_sizes))
+        self.memory_items = memory_items
+        self._hashes = {}                            # path -> ((mtime_ns, size), digest)
+        self._memory = collections.OrderedDict()     # (digest, w, h) -> PIL image
+        self._disk_usage = None                      # bytes, computed on first write
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()                # guards the dicts, counters and disk usage
+        os.makedirs(self.directory, exist_ok=True)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def source_hash(self, path):
+        """Content hash of an image file. Re-read only when its mtime or size changes."""
+        st = os.stat(path)
+        signature = (st.st_mtime_ns, st.st_size)
+        cached = self._hashes.get(path)
+        if cached and cached[0] == signature:
+            return cached[1]
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 16), b""):
+                digest.update(block)
+        self._hashes[path] = (signature, digest.hexdigest())
+        return self._hashes[path][1]
+
+    def mip_path(self, digest, mip_size):
+        return os.path.join(self.directory, f"{digest}_{mip_size}.png")
+
+    def get(self, path, size):
+        """Returns a PIL image of the avatar at path resized to size (w, h), or None if it can't be read."""
+        w, h = int(size[0]), int(size[1])
+        if w < 1 or h < 1:
+            return None
+        try:
+            digest = self.source_hash(path)
+        except OSError:
+            return None
+        key = (digest, w, h)
+        with self._lock:
+            image = self._memory.get(key)
+            if image is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return image
+        needed = max(w, h)
+        mip_size = next((m for m in self.mip_sizes if m >= needed), self.mip_sizes[-1])
+        mip_path = self.mip_path(digest, mip_size)
+        try:
+            try:
+                image = self._open_mip(mip_path, w, h)
+                with self._lock:
+                    self.hits += 1
+            except FileNotFoundError:
+                # Not written yet, or evicted since; either way make the mips (again).
+                with self._lock:
+                    self.misses += 1
+                self._write_mips(path, digest)
+                image = self._open_mip(mip_path, w, h)
+        except Exception as e:
+            print("Error loading avatar thumbnail:", e)
+            return None
+        with self._lock:
+            self._memory[key] = image
+            if len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+        return image
+
+    def _open_mip(self, mip_path, w, h):
+        os.utime(mip_path)  # Mark as recently used for eviction.
+        # Image.open only reads the header; pixels are decoded by resize().
+        with Image.open(mip_path) as mip:
+            return mip.resize((w, h), Image.Resampling.LANCZOS)
+
+    def _write_mips(self, path, digest):
+        """Decodes the source image once and writes all mip sizes for it."""
+        with Image.open(path) as source:
+            # Let JPEG decoders skip detail we'll never show.
+            source.draft("RGB", (self.mip_sizes[-1], self.mip_sizes[-1]))
+            source = source.convert("RGBA")
+        for mip_size in self.mip_sizes:
+            mip_path = self.mip_path(digest, mip_size)
+            # Another thread may be reading or writing the same mip; only ever show it a whole file.
+            temp_path = f"{mip_path}.{threading.get_ident()}.tmp"
+            source.resize((mip_size, mip_size), Image.Resampling.LANCZOS).save(temp_path, "PNG")
+            os.replace(temp_path, mip_path)
+            self._track_write(os.path.getsize(mip_path))
+
+    def _track_write(self, nbytes):
+        with self._lock:
+            self._track_write_locked(nbytes)
+
+    def _track_write_locked(self, nbytes):
+        if self._disk_usage is None:
+            self._disk_usage = sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.is_file())
+        else:
+            self._disk_usage += nbytes
+        if self._disk_usage > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        entries = [entry for entry in os.scandir(self.directory) if entry.is_file()]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        # Shrink to 90% of the budget so we don't evict again on the very next write.
+        target = self.max_bytes * 0.9
+        for entry in entries:
+            if self._disk_usage <= target:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self._disk_usage -= size
+            except OSError:
+                pass
+
+
+class AvatarLoader:
+    """Decodes and resizes avatars on a thread pool, so the Tk thread never waits on image files.
+
+    request() returns at once. Finished images wait in a queue until the Tk thread calls
+    deliver(), which hands each one to the callbacks that asked for it as callback(key, image),
+    key being (path, w, h). Callbacks get the PIL image: PhotoImages have to be made on the Tk
+    thread."""
+
+    def __init__(self, thumbnail_cache, workers=AVATAR_LOADER_THREADS):
+        self.thumbnail_cache = thumbnail_cache
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="avatar")
+        self.finished = queue.Queue()   # (key, image or None) from the loader threads
+        self.pending = {}               # key -> (future, callbacks)
+        self.failed = {}                # key -> time it failed; not requested again for a while
+
+    def request(self, path, size, callback):
+        """Starts loading path at size (w, h) unless it is already loading. Returns False if the
+        avatar failed to load recently, in which case callback is never called."""
+        key = (path, int(size[0]), int(size[1]))
+        failed_at = self.failed.get(key)
+        if failed_at is not None:
+            if time.monotonic() - failed_at < AVATAR_RETRY_SECONDS:
+                return False
+            del self.failed[key]
+        entry = self.pending.get(key)
+        if entry is None:
+            entry = self.pending[key] = (self.executor.submit(self._load, key), [])
+        if callback not in entry[1]:
+            entry[1].append(callback)
+        return True
+
+    def cancel(self, key, callback):
+        """Withdraws callback's request; the load itself is dropped when nobody else wants it."""
+        entry = self.pending.get(key)
+        if entry is None or callback not in entry[1]:
+            return
+        entry[1].remove(callback)
+        if not entry[1]:
+            del self.pending[key]
+            entry[0].cancel()
+
+    def _load(self, key):
+        image = None
+        try:
+            image = self.thumbnail_cache.get(key[0], key[1:])
+        finally:
+            self.finished.put((key, image))
+
+    def deliver(self, budget=0.01):
+        """Runs the callbacks of finished avatars for at most budget seconds. Returns whether
+        requests are still outstanding."""
+        deadline = time.perf_counter() + budget
+        while time.perf_counter() < deadline:
+            try:
+                key, image = self.finished.get_nowait()
+            except queue.Empty:
+                break
+            entry = self.pending.pop(key, None)
+            if entry is None:
+                continue  # cancelled after it started
+            if image is None:
+                # Also covers files that were being written or moved; they get another try later.
+                self.failed[key] = time.monotonic()
+                continue
+            for callback in entry[1]:
+                callback(key, image)
+        return bool(self.pending)
+
+    def shutdown(self):
+        self.pending.clear()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class FileWatcher:
+    """Tells which files changed since they were last marked, by comparing the size and
+    modification time from os.stat; file contents are never read here."""
+
+    def __init__(self):
+        self.signatures = {}
+
+    @staticmethod
+    def signature(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def mark(self, path):
+        """Records the file as it is now, e.g. right after writing or reading it."""
+        self.signatures[path] = self.signature(path)
+
+    def changed(self):
+        return [path for path, signature in self.signatures.items() if self.signature(path) != signature]
+
+
+MISSING = object()   # stands for "no entry" in merge_changes
+
+
+def merge_changes(base, disk, local):
+    """Three-way comparison of two versions of a dict with the version both started from.
+    Returns (take, conflicts): take maps each key changed only on disk to its new value
+    (MISSING if it was deleted there); conflicts lists the keys changed differently on both
+    sides. Keys changed only locally are left alone."""
+    take, conflicts = {}, []
+    for key in set(base) | set(disk):
+        old, theirs = base.get(key, MISSING), disk.get(key, MISSING)
+        if theirs == old:
+            continue
+        ours = local.get(key, MISSING)
+        if ours == theirs:
+            continue
+        if ours == old:
+            take[key] = theirs
+        else:
+            conflicts.append(key)
+    return take, conflicts
+
+
+def members_by_id(members):
+    """Roster entries keyed by "Id", or by lower-case name for entries written without one."""
+    return {member.get("Id", ("name", str(member.get("Name", "")).casefold())): member for member in members}
+
+
+class AllianceRegistry:
+    """Alliance members indexed by stable ID, case-insensitive name and rank.
+
+    Members stay plain dicts ("Id", "Name", "Rank", "Avatar", optionally "Size") so
+    'alliance_members.txt' keeps its format. Listeners are called as
+    listener(event, member, previous) where event is "added", "updated", "removed"
+    or "reset"; for "updated", previous is a copy of the member before the change."""
+
+    def __init__(self, members=()):
+        self._listeners = []
+        self._batch_depth = 0
+        self._batch_changed = False
+        self.load(members)
+
+    def load(self, members):
+        """Replaces all members. Entries with a duplicate name or unknown rank are skipped."""
+        self._by_id = {}
+        self._by_name = {}
+        self._by_rank = {rank: {} for rank in ALLIANCE_RANKS}
+        self._next_id = 1
+        for member in members:
+            try:
+                self._insert(dict(member))
+            except ValueError as e:
+                print("Skipping alliance member:", e)
+        self._notify("reset", None)
+
+    # ------------------------------
+    # Lookups
+    # ------------------------------
+    def __iter__(self):
+        return iter(list(self._by_id.values()))
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __bool__(self):
+        return bool(self._by_id)
+
+    def __contains__(self, name):
+        return self._name_key(name) in self._by_name
+
+    def get(self, member_id):
+        return self._by_id.get(member_id)
+
+    def find(self, name):
+        """Returns the member with this name (case-insensitive), or None."""
+        return self._by_name.get(self._name_key(name))
+
+    def by_rank(self, rank):
+        return [self._by_id[member_id] for member_id in self._by_rank.get(rank, {})]
+
+    def to_list(self):
+        return [dict(member) for member in self._by_id.values()]
+
+    # ------------------------------
+    # Mutations
+    # ------------------------------
+    def add(self, member, keep_id=False):
+        """Adds a copy of member and returns it. Raises ValueError on a duplicate name or bad rank.
+        With keep_id, the member's "Id" is kept unless another member already has it."""
+        member = dict(member)
+        if not keep_id:
+            member.pop("Id", None)
+        self._insert(member)
+        self._notify("added", member)
+        return member
+
+    def update(self, member_id, **changes):
+        """Applies changes (e.g. Name=..., Rank=...) to a member and returns it."""
+        member = self._by_id[member_id]
+        previous = dict(member)
+        new_name = changes.get("Name", member.get("Name", ""))
+        new_rank = changes.get("Rank", member.get("Rank", "R1"))
+        self._validate(new_name, new_rank, member_id)
+        del self._by_name[self._name_key(previous.get("Name", ""))]
+        del self._by_rank[previous.get("Rank", "R1")][member_id]
+        member.update(changes)
+        self._by_name[self._name_key(new_name)] = member
+        self._by_rank[new_rank][member_id] = None
+        self._notify("updated", member, previous)
+        return member
+
+    def remove(self, member_id):
+        member = self._by_id.pop(member_id)
+        del self._by_name[self._name_key(member.get("Name", ""))]
+        del self._by_rank[member.get("Rank", "R1")][member_id]
+        self._notify("removed", member)
+        return member
+
+    def subscribe(self, listener):
+        self._listeners.append(listener)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Groups several changes into a single "reset" notification."""
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0 and self._batch_changed:
+                self._batch_changed = False
+                self._notify("reset", None)
+
+    # ------------------------------
+    # Internals
+    # ------------------------------
+    def _name_key(self, name):
+        return (name or "").strip().casefold()
+
+    def _validate(self, name, rank, member_id=None):
+        if not self._name_key(name):
+            raise ValueError("Name cannot be empty.")
+        if rank not in self._by_rank:
+            raise ValueError(f"Unknown rank '{rank}'.")
+        existing = self._by_name.get(self._name_key(name))
+        if existing is not None and existing["Id"] != member_id:
+            raise ValueError(f"A member named '{existing['Name']}' already exists.")
+
+    def _insert(self, member):
+        member.setdefault("Rank", "R1")
+        self._validate(member.get("Name", ""), member["Rank"])
+        member_id = member.get("Id")
+        if not isinstance(member_id, int) or member_id in self._by_id:
+            member_id = self._next_id
+        member["Id"] = member_id
+        self._next_id = max(self._next_id, member_id + 1)
+        self._by_id[member_id] = member
+        self._by_name[self._name_key(member["Name"])] = member
+        self._by_rank[member["Rank"]][member_id] = None
+
+    def _notify(self, event, member, previous=None):
+        if self._batch_depth:
+            self._batch_changed = True
+            return
+        for listener in self._listeners:
+            listener(event, member, previous)
+
+
+class ScheduleExporter:
+    """Exports the conductor list and VS tasks as text, CSV or iCalendar.
+    Output is produced line by line, and a file is only regenerated when the
+    hash of the schedule it was made from differs from the one recorded for
+    the last export."""
+
+    FORMATS = ("text", "csv", "ics")
+
+    def __init__(self, hash_file=SCHEDULE_EXPORT_HASHES):
+        self.hash_file = hash_file
+        self.hashes = {}
+        if os.path.exists(self.hash_file):
+            try:
+                with open(self.hash_file, "r") as f:
+                    self.hashes = json.load(f)
+            except Exception as e:
+                print("Error loading export hashes:", e)
+                self.hashes = {}
+
+    # ------------------------------
+    # Schedule walking
+    # ------------------------------
+    def iter_days(self, schedule):
+        """Yields (date, weekday, conductor, tasks) for every day between the first
+        and last dated entry that has a conductor or at least one VS task."""
+        conductors = schedule.get("conductor_assignments", {})
+        recurring = schedule.get("vs_tasks_by_weekday", {})
+        single = schedule.get("vs_tasks", {})
+        exceptions = schedule.get("vs_task_exceptions", {})
+        dates = []
+        for key in set(conductors) | set(single):
+            try:
+                dates.append(datetime.date.fromisoformat(key))
+            except ValueError:
+                print("Skipping invalid schedule date:", key)
+        if not dates:
+            return
+        day = min(dates)
+        last = max(dates)
+        while day <= last:
+            date_str = day.isoformat()
+            weekday = day.strftime("%A")
+            skipped = exceptions.get(date_str, [])
+            tasks = [task for task in recurring.get(weekday, []) if task not in skipped]
+            tasks += single.get(date_str, [])
+            conductor = conductors.get(date_str)
+            if conductor or tasks:
+                yield date_str, weekday, conductor, tasks
+            day += datetime.timedelta(days=1)
+
+    def iter_text(self, schedule):
+        yield "Train Conductor List:\n"
+        for date_str, weekday, conductor, tasks in self.iter_days(schedule):
+            if conductor:
+                yield f"{date_str}: {conductor}\n"
+        yield "\nVS Tasks:\n"
+        for date_str, weekday, conductor, tasks in self.iter_days(schedule):
+            if tasks:
+                yield f"{date_str} ({weekday}): {', '.join(tasks)}\n"
+
+    def iter_csv(self, schedule):
+        # csv.writer needs a file object; this one just hands back each formatted row.
+        class _Row:
+            def write(self, text):
+                return text
+        writer = csv.writer(_Row(), lineterminator="\n")
+        yield writer.writerow(["date", "weekday", "conductor", "vs_tasks"])
+        for date_str, weekday, conductor, tasks in self.iter_days(schedule):
+            yield writer.writerow([date_str, weekday, conductor or "", "; ".join(tasks)])
+
+    def iter_ics(self, schedule):
+        """Conductor duties and single tasks become all-day events; recurring VS tasks
+        become one weekly event each, with the per-day exceptions as EXDATEs."""
+        yield "BEGIN:VCALENDAR\r\n"
+        yield "VERSION:2.0\r\n"
+        yield "PRODID:-//CosaNation//Management Assistant//EN\r\n"
+        yield "CALSCALE:GREGORIAN\r\n"
+        first_day = None
+        single = schedule.get("vs_tasks", {})
+        for date_str, weekday, conductor, tasks in self.iter_days(schedule):
+            if first_day is None:
+                first_day = datetime.date.fromisoformat(date_str)
+            if conductor:
+                yield from self._ics_event(f"conductor-{date_str}", date_str, f"Train Conductor: {conductor}")
+            for task in single.get(date_str, []):
+                yield from self._ics_event(f"vs-{date_str}-{self._short_hash(task)}", date_str, f"VS: {task}")
+        if first_day is None:
+            first_day = datetime.date.today()
+        weekdays = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+        exceptions = schedule.get("vs_task_exceptions", {})
+        for weekday, tasks in schedule.get("vs_tasks_by_weekday", {}).items():
+            if weekday not in weekdays:
+                continue
+            offset = (weekdays.index(weekday) - first_day.weekday()) % 7
+            start = (first_day + datetime.timedelta(days=offset)).isoformat()
+            for task in tasks:
+                skipped = sorted(d for d, excluded in exceptions.items()
+                                 if task in excluded and self._weekday_of(d) == weekday)
+                yield from self._ics_event(
+                    f"vs-weekly-{weekday}-{self._short_hash(task)}", start, f"VS: {task}",
+                    rrule=f"FREQ=WEEKLY;BYDAY={weekday[:2].upper()}", exdates=skipped
+                )
+        yield "END:VCALENDAR\r\n"
+
+    def _ics_event(self, uid, date_str, summary, rrule=None, exdates=()):
+        day = date_str.replace("-", "")
+        yield "BEGIN:VEVENT\r\n"
+        yield f"UID:{uid}@cona-assistant\r\n"
+        # DTSTAMP is derived from the event date so unchanged schedules hash identically.
+        yield f"DTSTAMP:{day}T000000Z\r\n"
+        yield f"DTSTART;VALUE=DATE:{day}\r\n"
+        if rrule:
+            yield f"RRULE:{rrule}\r\n"
+        for exdate in exdates:
+            yield f"EXDATE;VALUE=DATE:{exdate.replace('-', '')}\r\n"
+        yield self._ics_fold(f"SUMMARY:{self._ics_escape(summary)}")
+        yield "END:VEVENT\r\n"
+
+    def _ics_escape(self, text):
+        return (text.replace("\\", "\\\\").replace(";", "\\;")
+                    .replace(",", "\\,").replace("\n", "\\n"))
+
+    def _ics_fold(self, line):
+        """Folds a content line to 75 octets as required by RFC 5545."""
+        data = line.encode("utf-8")
+        parts = []
+        while len(data) > 75:
+            cut = 75 if not parts else 74
+            # Don't split a multi-byte UTF-8 sequence.
+            while cut > 0 and (data[cut] & 0xC0) == 0x80:
+                cut -= 1
+            parts.append(data[:cut].decode("utf-8"))
+            data = data[cut:]
+        parts.append(data.decode("utf-8"))
+        return "\r\n ".join(parts) + "\r\n"
+
+    def _weekday_of(self, date_str):
+        try:
+            return datetime.date.fromisoformat(date_str).strftime("%A")
+        except ValueError:
+            return None
+
+    def _short_hash(self, text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()[:8]
+
+    # ------------------------------
+    # Writing
+    # ------------------------------
+    def iter_format(self, fmt, schedule):
+        if fmt == "text":
+            return self.iter_text(schedule)
+        if fmt == "csv":
+            return self.iter_csv(schedule)
+        if fmt == "ics":
+            return self.iter_ics(schedule)
+        raise ValueError(f"Unknown export format: {fmt}")
+
+    def content_hash(self, fmt, schedule):
+        """Hash of the format and the schedule data, so checking for changes never builds the output."""
+        text = json.dumps([fmt, schedule], sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def export(self, fmt, path, schedule):
+        """Writes the schedule to path in the given format.
+        Returns True if the file was (re)written, False if it was already up to date."""
+        new_hash = self.content_hash(fmt, schedule)
+        key = os.path.abspath(path)
+        if self.hashes.get(key) == new_hash and os.path.exists(path):
+            return False
+        tmp_path = path + ".tmp"
+        # newline="" so the CRLF line endings of the ICS output are kept as-is.
+        with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+            for chunk in self.iter_format(fmt, schedule):
+                f.write(chunk)
+        os.replace(tmp_path, path)
+        self.hashes[key] = new_hash
+        with open(self.hash_file, "w") as f:
+            json.dump(self.hashes, f, indent=4)
+        return True
+
+
+def load_map_config(path=MAP_CONFIG_FILE):
+    """Grid size and preset terrain zones of the map, from a JSON file like
+    {"grid_size": 1499, "zones": [{"name": ..., "terrain": "mud", "rect": [x1, y1, x2, y2]}]}.
+    Missing entries (or a missing file) fall back to the default 999x999 map."""
+    config = {"grid_size": GRID_SIZE, "zones": [dict(zone) for zone in DEFAULT_MAP_ZONES]}
+    if not os.path.exists(path):
+        return config
+    try:
+        with open(path, "r") as f:
+            loaded = json.load(f)
+        grid_size = int(loaded.get("grid_size", GRID_SIZE))
+        if grid_size <= 0:
+            raise ValueError(f"grid_size must be positive, not {grid_size}")
+        config["grid_size"] = grid_size
+        if "zones" in loaded:
+            config["zones"] = [{"name": str(zone.get("name", zone["terrain"])), "terrain": zone["terrain"],
+                                "rect": [int(v) for v in zone["rect"]]} for zone in loaded["zones"]]
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        print("Error loading map config:", e)
+    return config
+
+
+def chunks_of(x1, y1, x2, y2):
+    """Chunk coordinates touched by the cells [x1, x2) x [y1, y2)."""
+    for cy in range(y1 // CHUNK_SIZE, (y2 - 1) // CHUNK_SIZE + 1):
+        for cx in range(x1 // CHUNK_SIZE, (x2 - 1) // CHUNK_SIZE + 1):
+            yield cx, cy
+
+
+class ChunkedCells(collections.abc.MutableMapping):
+    """A {(x, y): value} mapping kept in CHUNK_SIZE x CHUNK_SIZE chunks that exist only where
+    some cell is set, so memory follows the painted area and a region is read by visiting
+    the few chunks it touches."""
+
+    def __init__(self, items=()):
+        self.chunks = {}   # (chunk x, chunk y) -> {(x, y): value}
+        self.size = 0
+        self.update(items)
+
+    def __getitem__(self, cell):
+        chunk = self.chunks.get((cell[0] // CHUNK_SIZE, cell[1] // CHUNK_SIZE))
+        if chunk is None:
+            raise KeyError(cell)
+        return chunk[cell]
+
+    def __setitem__(self, cell, value):
+        chunk = self.chunks.setdefault((cell[0] // CHUNK_SIZE, cell[1] // CHUNK_SIZE), {})
+        if cell not in chunk:
+            self.size += 1
+        chunk[cell] = value
+
+    def __delitem__(self, cell):
+        chunk_key = (cell[0] // CHUNK_SIZE, cell[1] // CHUNK_SIZE)
+        chunk = self.chunks.get(chunk_key)
+        if chunk is None:
+            raise KeyError(cell)
+        del chunk[cell]
+        self.size -= 1
+        if not chunk:
+            del self.chunks[chunk_key]
+
+    def __iter__(self):
+        for chunk in list(self.chunks.values()):
+            yield from chunk
+
+    def __len__(self):
+        return self.size
+
+    def items_in(self, x1, y1, x2, y2):
+        """(cell, value) pairs of the cells set in [x1, x2) x [y1, y2)."""
+        for chunk_key in chunks_of(x1, y1, x2, y2):
+            for (x, y), value in self.chunks.get(chunk_key, {}).items():
+                if x1 <= x < x2 and y1 <= y < y2:
+                    yield (x, y), value
+
+
+class ChunkIndex:
+    """Keys of grid rectangles [x1, x2) x [y1, y2) by the chunks they overlap. Each key
+    also keeps the order it was added in, so lookups return keys in placement order."""
+
+    def __init__(self):
+        self.chunks = collections.defaultdict(set)
+        self.rects = {}   # key -> (x1, y1, x2, y2, order)
+        self.counter = 0
+
+    def add(self, key, rect, order=None):
+        self.remove(key)
+        if order is None:
+            self.counter += 1
+            order = self.counter
+        x1, y1, x2, y2 = rect
+        x2, y2 = max(x2, x1 + 1), max(y2, y1 + 1)   # a flat marker still sits in a chunk
+        self.rects[key] = (x1, y1, x2, y2, order)
+        for chunk_key in chunks_of(x1, y1, x2, y2):
+            self.chunks[chunk_key].add(key)
+
+    def remove(self, key):
+        entry = self.rects.pop(key, None)
+        if entry is None:
+            return None
+        for chunk_key in chunks_of(*entry[:4]):
+            keys = self.chunks[chunk_key]
+            keys.discard(key)
+            if not keys:
+                del self.chunks[chunk_key]
+        return entry[4]
+
+    def query(self, x1, y1, x2, y2):
+        """Keys whose rectangle overlaps [x1, x2) x [y1, y2), in placement order."""
+        found = set()
+        for chunk_key in chunks_of(x1, y1, max(x2, x1 + 1), max(y2, y1 + 1)):
+            found.update(self.chunks.get(chunk_key, ()))
+        hits = []
+        for key in found:
+            r_x1, r_y1, r_x2, r_y2, order = self.rects[key]
+            if r_x1 < x2 and x1 < r_x2 and r_y1 < y2 and y1 < r_y2:
+                hits.append((order, key))
+        hits.sort(key=lambda hit: hit[0])
+        return [key for _, key in hits]
+
+
+def marker_data(name, bbox, color):
+    """A placed marker, stored under the key ("marker", name): the rectangle between the grid
+    corners (x1, y1) and (x2, y2) of bbox."""
+    return {"is_marker": True, "tag": name, "color": color, "bbox": tuple(bbox)}
+
+
+def migrate_legacy_markers(state):
+    """A copy of a saved state whose old-style markers ({"markers": {id: {"name", "x1", "y1",
+    "x2", "y2", "color"}}}) are placed markers in placed_objects. A placed marker that already
+    has the name is kept."""
+    legacy = state.get("markers")
+    if not legacy:
+        return state
+    state = dict(state)
+    objects = dict(state.get("placed_objects", {}))
+    for marker_id, marker in legacy.items():
+        try:
+            name = str(marker.get("name") or marker_id)
+            data = marker_data(name, [float(marker[corner]) for corner in ("x1", "y1", "x2", "y2")],
+                               marker.get("color", "red"))
+        except (AttributeError, KeyError, TypeError, ValueError):
+            print("Skipping invalid marker:", marker_id)
+            continue
+        objects.setdefault(f"marker,{name}", data)
+    state["placed_objects"] = objects
+    del state["markers"]
+    return state
+
+
+class MapModel:
+    """Map state without any Tk dependency: placed objects, terrain, markers, the
+    current selection and the view transform (pan and zoom) with the conversions
+    between grid cells and canvas pixels.
+
+    All changes go through the methods below, which notify listeners registered
+    with subscribe() as listener(event, payload). Events are "object_added",
+    "object_removed", "object_changed", "objects_moved", "terrain_changed",
+    "selection_changed", "view_changed" and "reset".
+
+    Markers are placed objects too, keyed ("marker", name) with the fields of marker_data()."""
+
+    def __init__(self, grid_size: int = GRID_SIZE, cell_size: int = CELL_SIZE,
+                 zones: Optional[List[dict]] = None) -> None:
+        self.grid_size = grid_size
+        self.cell_size = cell_size
+        self.zones = [dict(zone) for zone in (DEFAULT_MAP_ZONES if zones is None else zones)]
+        self.placed_objects: Dict[ObjectKey, dict] = {}
+        self.marker_count = 0   # placed markers among placed_objects
+        self.object_index = ChunkIndex()   # where each placed object and marker lies
+        self.marker_index = ChunkIndex()   # the markers alone, for hover and press lookups
+        self.terrain_cells: Dict[Cell, str] = ChunkedCells()
+        self.selected_objects: Set[ObjectKey] = set()
+        self.zoom_factor = 1.0
+        self.pan_x = 0.0
+        self.pan_y = 0.0
+        self._listeners: List[Callable[[str, dict], None]] = []
+        # Batch edits as (label, objects before, objects after); None stands for "no object".
+        # Other edits aren't recorded, so they drop the history of the keys they touch.
+        self.undo_stack: List[Tuple[str, dict, dict]] = []
+        self.redo_stack: List[Tuple[str, dict, dict]] = []
+        self._writing_edit = False
+
+    # ------------------------------
+    # Change events
+    # ------------------------------
+    def subscribe(self, listener: Callable[[str, dict], None]) -> None:
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener: Callable[[str, dict], None]) -> None:
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def _emit(self, event: str, **payload) -> None:
+        if not self._writing_edit and (self.undo_stack or self.redo_stack):
+            if event == "objects_moved":
+                self._forget_history(list(payload["moves"]) + list(payload["moves"].values()))
+            elif event in ("object_added", "object_removed", "object_changed"):
+                self._forget_history((payload["key"],))
+        for listener in list(self._listeners):
+            listener(event, payload)
+
+    def _forget_history(self, keys: Iterable[ObjectKey]) -> None:
+        """Drops undo and redo once an unrecorded edit touches a key they refer to: undoing
+        them afterwards would overwrite that edit."""
+        entries = self.undo_stack + self.redo_stack
+        if any(key in before for key in keys for _, before, _ in entries):
+            self.undo_stack.clear()
+            self.redo_stack.clear()
+
+    # ------------------------------
+    # View transform
+    # ------------------------------
+    @property
+    def cell_px(self) -> float:
+        """Size of one grid cell in canvas pixels at the current zoom."""
+        return self.cell_size * self.zoom_factor
+
+    def set_view(self, pan_x: float, pan_y: float, zoom_factor: Optional[float] = None) -> None:
+        self.pan_x = pan_x
+        self.pan_y = pan_y
+        if zoom_factor is not None:
+            self.zoom_factor = zoom_factor
+        self._emit("view_changed")
+
+    def pan_by(self, dx: float, dy: float) -> None:
+        self.set_view(self.pan_x + dx, self.pan_y + dy)
+
+    def zoom_at(self, canvas_x: float, canvas_y: float, scale: float) -> None:
+        """Zooms by scale while keeping the point under (canvas_x, canvas_y) in place."""
+        rel_x = (canvas_x - self.pan_x) / self.cell_px
+        rel_y = (canvas_y - self.pan_y) / self.cell_px
+        zoom_factor = self.zoom_factor * scale
+        cell_px = self.cell_size * zoom_factor
+        self.set_view(canvas_x - rel_x * cell_px, canvas_y - rel_y * cell_px, zoom_factor)
+
+    def set_start_position(self, x: int, y: int, offset: float = 400) -> None:
+        """Pans so that cell (x, y) sits offset pixels from the canvas' top-left corner."""
+        self.set_view(-x * self.cell_px + offset, -(self.grid_size - y - 1) * self.cell_px + offset)
+
+    def center_on(self, x: float, y: float, view_width: float, view_height: float) -> None:
+        """Pans so that cell (x, y) is in the middle of a view_width x view_height canvas."""
+        cell_px = self.cell_px
+        self.set_view(-x * cell_px + (view_width - cell_px) / 2,
+                      -(self.grid_size - y - 1) * cell_px + (view_height - cell_px) / 2)
+
+    def in_bounds(self, x: int, y: int) -> bool:
+        return 0 <= x < self.grid_size and 0 <= y < self.grid_size
+
+    def canvas_to_cell(self, canvas_x: float, canvas_y: float) -> Cell:
+        """The grid cell containing a canvas point."""
+        cell_px = self.cell_px
+        return (int((canvas_x - self.pan_x) / cell_px),
+                self.grid_size - int((canvas_y - self.pan_y) / cell_px) - 1)
+
+    def canvas_to_corner(self, canvas_x: float, canvas_y: float) -> Cell:
+        """The grid corner nearest to a canvas point (used to snap marker rectangles)."""
+        cell_px = self.cell_px
+        return (int(round((canvas_x - self.pan_x) / cell_px)),
+                int(round(self.grid_size - (canvas_y - self.pan_y) / cell_px - 1)))
+
+    def corner_to_canvas(self, x: float, y: float) -> Tuple[float, float]:
+        cell_px = self.cell_px
+        return x * cell_px + self.pan_x, (self.grid_size - y) * cell_px + self.pan_y
+
+    def object_rect(self, key: ObjectKey, data: dict) -> Tuple[int, int, int, int]:
+        """Grid rectangle (x_start, y_start, w, h) covered by an object centered on key."""
+        w, h = data.get("size", (3, 3))
+        return key[0] - w // 2, key[1] - h // 2, w, h
+
+    def item_cells(self, key: ObjectKey, data: dict) -> Tuple[int, int, int, int]:
+        """Cells [x1, x2) x [y1, y2) covered by an object or placed marker."""
+        if data.get("is_marker"):
+            # Marker corners can sit between cells after a drag; cover every cell they touch.
+            x1, y1, x2, y2 = data["bbox"]
+            return (math.floor(min(x1, x2)), math.floor(min(y1, y2)),
+                    math.ceil(max(x1, x2)), math.ceil(max(y1, y2)))
+        x_start, y_start, w, h = self.object_rect(key, data)
+        return x_start, y_start, x_start + w, y_start + h
+
+    def object_canvas_rect(self, key: ObjectKey, data: dict) -> Tuple[float, float, float, float]:
+        x_start, y_start, w, h = self.object_rect(key, data)
+        c_x1, c_y1 = self.corner_to_canvas(x_start, y_start + h)
+        return c_x1, c_y1, c_x1 + w * self.cell_px, c_y1 + h * self.cell_px
+
+    def bbox_canvas_rect(self, bbox: Tuple[float, float, float, float]) -> Tuple[float, float, float, float]:
+        """Canvas rectangle of a grid bounding box (x1, y1, x2, y2) as used by markers."""
+        c_x1, c_y1 = self.corner_to_canvas(bbox[0], bbox[1])
+        c_x2, c_y2 = self.corner_to_canvas(bbox[2], bbox[3])
+        return c_x1, c_y1, c_x2, c_y2
+
+    # ------------------------------
+    # Queries
+    # ------------------------------
+    def is_marker_key(self, key: ObjectKey) -> bool:
+        return self.placed_objects.get(key, {}).get("is_marker", False)
+
+    def iter_objects(self) -> Iterable[Tuple[ObjectKey, dict]]:
+        """Placed objects that are not markers."""
+        for key, data in self.placed_objects.items():
+            if not data.get("is_marker"):
+                yield key, data
+
+    def items_in(self, x1: int, y1: int, x2: int, y2: int) -> List[ObjectKey]:
+        """Keys of the objects and placed markers overlapping the cells [x1, x2) x [y1, y2),
+        in placement order. Only the chunks under the region are looked at."""
+        return self.object_index.query(x1, y1, x2, y2)
+
+    def object_at_cell(self, x: int, y: int) -> Optional[ObjectKey]:
+        for key in self.items_in(x, y, x + 1, y + 1):
+            if not self.placed_objects[key].get("is_marker"):
+                return key
+        return None
+
+    def item_at_canvas(self, canvas_x: float, canvas_y: float) -> Optional[ObjectKey]:
+        """Key of the object or placed marker under a canvas point."""
+        x, y = self.canvas_to_cell(canvas_x, canvas_y)
+        for key in self.items_in(x - 1, y - 1, x + 2, y + 2):
+            data = self.placed_objects[key]
+            if data.get("is_marker"):
+                c_x1, c_y1, c_x2, c_y2 = self.bbox_canvas_rect(data["bbox"])
+            else:
+                c_x1, c_y1, c_x2, c_y2 = self.object_canvas_rect(key, data)
+            if c_x1 <= canvas_x <= c_x2 and c_y1 <= canvas_y <= c_y2:
+                return key
+        return None
+
+    def keys_in_canvas_rect(self, x1: float, y1: float, x2: float, y2: float) -> List[ObjectKey]:
+        """Keys of everything lying entirely inside a canvas rectangle."""
+        x1, x2 = min(x1, x2), max(x1, x2)
+        y1, y2 = min(y1, y2), max(y1, y2)
+        left, top = self.canvas_to_cell(x1, y1)
+        right, bottom = self.canvas_to_cell(x2, y2)
+        keys = []
+        for key in self.items_in(left - 1, bottom - 1, right + 2, top + 2):
+            data = self.placed_objects[key]
+            if data.get("is_marker"):
+                c_x1, c_y1, c_x2, c_y2 = self.bbox_canvas_rect(data["bbox"])
+            else:
+                c_x1, c_y1, c_x2, c_y2 = self.object_canvas_rect(key, data)
+            if c_x1 >= x1 and c_y1 >= y1 and c_x2 <= x2 and c_y2 <= y2:
+                keys.append(key)
+        return keys
+
+    def iter_markers(self) -> Iterable[Tuple[ObjectKey, dict]]:
+        for key, data in self.placed_objects.items():
+            if data.get("is_marker"):
+                yield key, data
+
+    def markers_near_canvas(self, canvas_x: float, canvas_y: float, tolerance: float = 10) -> List[ObjectKey]:
+        """Keys of the markers whose rectangle comes within tolerance pixels of a canvas point,
+        in placement order. Only the markers indexed in the chunks around the point are checked."""
+        x, y = self.canvas_to_cell(canvas_x, canvas_y)
+        pad = int(tolerance / self.cell_px) + 1
+        keys = []
+        for key in self.marker_index.query(x - pad, y - pad, x + pad + 1, y + pad + 1):
+            c_x1, c_y1, c_x2, c_y2 = self.bbox_canvas_rect(self.placed_objects[key]["bbox"])
+            if min(c_x1, c_x2) - tolerance <= canvas_x <= max(c_x1, c_x2) + tolerance and \
+                    min(c_y1, c_y2) - tolerance <= canvas_y <= max(c_y1, c_y2) + tolerance:
+                keys.append(key)
+        return keys
+
+    def marker_near_canvas(self, canvas_x: float, canvas_y: float, tolerance: float = 10) -> Optional[ObjectKey]:
+        keys = self.markers_near_canvas(canvas_x, canvas_y, tolerance)
+        return keys[0] if keys else None
+
+    def collides(self, x: int, y: int, w: int, h: int) -> bool:
+        """Placement check used when dropping a new w x h object centered on (x, y)."""
+        x_start, y_start = x - w // 2, y - h // 2
+        return any(not self.placed_objects[key].get("is_marker")
+                   for key in self.items_in(x_start, y_start, x_start + w, y_start + h))
+
+    def find_object(self, tag: Optional[str] = None, member_id: Optional[int] = None) -> Optional[ObjectKey]:
+        for key, data in self.iter_objects():
+            if (member_id is not None and data.get("member_id") == member_id) or \
+                    (tag is not None and data.get("tag") == tag):
+                return key
+        return None
+
+    # ------------------------------
+    # Mutations
+    # ------------------------------
+    def _index(self, key: ObjectKey, data: dict, order: Optional[int] = None) -> None:
+        cells = self.item_cells(key, data)
+        self.object_index.add(key, cells, order)
+        if data.get("is_marker"):
+            self.marker_index.add(key, cells)
+
+    def _unindex(self, key: ObjectKey) -> Optional[int]:
+        """Drops a key from the indexes and returns its place in the drawing order."""
+        self.marker_index.remove(key)
+        return self.object_index.remove(key)
+
+    def place_object(self, key: ObjectKey, data: dict) -> None:
+        previous = self.placed_objects.get(key)
+        self.placed_objects[key] = data
+        self.marker_count += bool(data.get("is_marker")) - bool(previous and previous.get("is_marker"))
+        # A key that is already placed keeps its place in the drawing order, as in the dict.
+        self._index(key, data, order=self._unindex(key))
+        self._emit("object_added", key=key, data=data)
+
+    def remove_object(self, key: ObjectKey) -> Optional[dict]:
+        data = self.placed_objects.pop(key, None)
+        if data is None:
+            return None
+        self.marker_count -= bool(data.get("is_marker"))
+        self._unindex(key)
+        self.selected_objects.discard(key)
+        self._emit("object_removed", key=key, data=data)
+        return data
+
+    def update_object(self, key: ObjectKey, **fields) -> None:
+        data = self.placed_objects[key]
+        previous = dict(data)
+        data.update(fields)
+        self.marker_count += bool(data.get("is_marker")) - bool(previous.get("is_marker"))
+        if "size" in fields or "bbox" in fields:
+            self._index(key, data, order=self._unindex(key))
+        self._emit("object_changed", key=key, data=data, previous=previous)
+
+    def rekey_object(self, old_key: ObjectKey, new_key: ObjectKey) -> None:
+        """Gives an object a new key without moving it (e.g. a renamed placed marker).
+        Raises ValueError if another object already has new_key."""
+        if new_key != old_key and new_key in self.placed_objects:
+            raise ValueError(f"{new_key!r} is already taken")
+        data = self.placed_objects.pop(old_key)
+        self.placed_objects[new_key] = data
+        self._unindex(old_key)
+        self._index(new_key, data)
+        if old_key in self.selected_objects:
+            self.selected_objects.discard(old_key)
+            self.selected_objects.add(new_key)
+        self._emit("object_removed", key=old_key, data=data)
+        self._emit("object_added", key=new_key, data=data)
+
+    def move_objects(self, moves: Dict[ObjectKey, ObjectKey]) -> Dict[ObjectKey, ObjectKey]:
+        """Moves several objects to new center cells at once, so objects in the same
+        group can take each other's places. A move onto an object that is not part of
+        the group is skipped. Returns the moves actually made."""
+        moves = {old: new for old, new in moves.items() if old != new and old in self.placed_objects}
+        done = {}
+        for old, new in moves.items():
+            if new in self.placed_objects and new not in moves:
+                continue
+            done[old] = new
+        if not done:
+            return done
+        moving = {old: self.placed_objects.pop(old) for old in done}
+        for old in done:
+            self._unindex(old)
+        for old, new in done.items():
+            self.placed_objects[new] = moving[old]
+            self._index(new, moving[old])
+        selected_moves = [old for old in done if old in self.selected_objects]
+        self.selected_objects.difference_update(selected_moves)
+        self.selected_objects.update(done[old] for old in selected_moves)
+        self._emit("objects_moved", moves=done)
+        return done
+
+    def apply_edit(self, changes: Dict[ObjectKey, Optional[dict]], label: str = "Edit") -> None:
+        """Sets each key to new object data, or removes it for None, as one step that undo() reverts."""
+        # The history keeps copies: placed data is edited in place.
+        before = {key: self._copy(self.placed_objects.get(key)) for key in changes}
+        after = {key: self._copy(data) for key, data in changes.items()}
+        self._write_objects(after)
+        self.undo_stack.append((label, before, after))
+        del self.undo_stack[:-UNDO_LIMIT]
+        self.redo_stack.clear()
+
+    def undo(self) -> Optional[str]:
+        """Reverts the last batch edit and returns its label, or None if there is nothing to undo.
+        Raises ValueError, and forgets the history, if the objects no longer match the edit."""
+        if not self.undo_stack:
+            return None
+        label, before, after = self.undo_stack.pop()
+        self._check_unchanged(label, after)
+        self._write_objects(before)
+        self.redo_stack.append((label, before, after))
+        return label
+
+    def redo(self) -> Optional[str]:
+        if not self.redo_stack:
+            return None
+        label, before, after = self.redo_stack.pop()
+        self._check_unchanged(label, before)
+        self._write_objects(after)
+        self.undo_stack.append((label, before, after))
+        return label
+
+    @staticmethod
+    def _copy(data: Optional[dict]) -> Optional[dict]:
+        return None if data is None else dict(data)
+
+    def _check_unchanged(self, label: str, expected: Dict[ObjectKey, Optional[dict]]) -> None:
+        if any(self.placed_objects.get(key) != data for key, data in expected.items()):
+            self.undo_stack.clear()
+            self.redo_stack.clear()
+            raise ValueError(f"The map changed after '{label}', so it can't be reverted any more.")
+
+    def _write_objects(self, changes: Dict[ObjectKey, Optional[dict]]) -> None:
+        self._writing_edit = True
+        try:
+            # Removals first, so a key can be vacated and refilled within one edit.
+            for key in changes:
+                if key in self.placed_objects:
+                    self.remove_object(key)
+            for key, data in changes.items():
+                if data is not None:
+                    self.place_object(key, self._copy(data))
+        finally:
+            self._writing_edit = False
+
+    def set_terrain(self, cells: Dict[Cell, str]) -> None:
+        self.terrain_cells.update(cells)
+        self._emit("terrain_changed", cells=cells)
+
+    # ------------------------------
+    # Selection
+    # ------------------------------
+    def select(self, keys: Iterable[ObjectKey]) -> None:
+        self.selected_objects = {key for key in keys if key in self.placed_objects}
+        self._emit("selection_changed")
+
+    def clear_selection(self) -> None:
+        if self.selected_objects:
+            self.selected_objects = set()
+            self._emit("selection_changed")
+
+    # ------------------------------
+    # Persistence
+    # ------------------------------
+    def _key_to_str(self, key: ObjectKey) -> str:
+        return f"{key[0]},{key[1]}"
+
+    def _str_to_key(self, text: str) -> ObjectKey:
+        first, second = text.split(",", 1)
+        if first == "marker":
+            return ("marker", second)
+        return int(first), int(second)
+
+    def to_state(self) -> dict:
+        return {
+            "placed_objects": {self._key_to_str(key): data for key, data in self.placed_objects.items()},
+            "terrain_cells": {f"{x},{y}": terrain for (x, y), terrain in self.terrain_cells.items()},
+            "pan_x": self.pan_x,
+            "pan_y": self.pan_y,
+            "zoom_factor": self.zoom_factor
+        }
+
+    def load_state(self, state: dict) -> None:
+        state = migrate_legacy_markers(state)
+        self.placed_objects = {}
+        for key, data in state.get("placed_objects", {}).items():
+            try:
+                self.placed_objects[self._str_to_key(key)] = data
+            except ValueError:
+                print("Skipping invalid object key:", key)
+        self.marker_count = sum(1 for data in self.placed_objects.values() if data.get("is_marker"))
+        self.object_index = ChunkIndex()
+        self.marker_index = ChunkIndex()
+        for key, data in self.placed_objects.items():
+            self._index(key, data)
+        self.terrain_cells = ChunkedCells()
+        for key, terrain in state.get("terrain_cells", {}).items():
+            x, y = map(int, key.split(","))
+            self.terrain_cells[(x, y)] = terrain
+        self.selected_objects = set()
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.pan_x = state.get("pan_x", self.pan_x)
+        self.pan_y = state.get("pan_y", self.pan_y)
+        self.zoom_factor = state.get("zoom_factor", self.zoom_factor)
+        self._emit("reset")
+
+    def save(self, path: str = "autosave.json") -> str:
+        """Writes the state and returns the JSON text written."""
+        text = json.dumps(self.to_state())
+        with open(path, "w") as f:
+            f.write(text)
+        return text
+
+    def load(self, path: str = "autosave.json") -> bool:
+        """Loads a saved state. Returns False if the file doesn't exist."""
+        if not os.path.exists(path):
+            return False
+        with open(path, "r") as f:
+            self.load_state(json.load(f))
+        return True
+
+    def content_hash(self) -> str:
+        """Hash of the map content (objects, terrain and markers; not the view)."""
+        state = self.to_state()
+        for view_key in ("pan_x", "pan_y", "zoom_factor"):
+            del state[view_key]
+        return hashlib.sha1(json.dumps(state, sort_keys=True).encode("utf-8")).hexdigest()
+
 
 class GridApp:
-    def __init__(self, root, start_coordinate=DEFAULT_START_COORDINATE):
+    def __init__(self, root, start_coordinate=None):
         self.root = root
         self.set_window_title(self.root, "CosaNation's management assistant")
         
@@ -21,16 +2571,17 @@ class GridApp:
         self.major_opacity = 100
         self.dark_mode = False
 
+        # The text of each state file as last read or written, to tell other programs' changes from ours.
+        self.file_watcher = FileWatcher()
+        self.file_bases = {}
+        self.checking_files = False
+        self.state_read_failures = 0
+
         # Alliance members and defaults
-        self.alliance_members = []
-        self.alliance_default_colors = {
-            "R1": "#2C3E50",
-            "R2": "#34495E",
-            "R3": "#5D6D7E",
-            "R4": "#2874A6",
-            "R5": "#1F618D"
-        }
+        self.alliance_members = AllianceRegistry()
+        self.alliance_default_colors = dict(ALLIANCE_RANK_COLORS)
         self.alliance_members_changed = False
+        self.avatar_index = AvatarIndex()
         self.load_alliance_members()  # NEW: load alliance members from file
         self.predefined_vs_tasks = ["Daily Check", "System Update", "Report Generation"]
 
@@ -44,33 +2595,29 @@ class GridApp:
         self.vs_tasks_by_weekday = {}  # Keys are weekday names (e.g., "Monday")
         self.predefined_vs_tasks = ["Daily Check", "System Update", "Report Generation"]
         self.vs_task_exceptions = {}  # Keys: date (YYYY-MM-DD), value: list of recurring tasks to exclude for that day
+        self.schedule_exporter = ScheduleExporter()
       
-        # Canvas, zoom, panning, and grid objects
-        self.zoom_factor = 1.0
-        self.pan_x = 0
-        self.pan_y = 0
+        # Map state (objects, terrain, markers, selection, zoom and panning) lives in the model;
+        # this class only draws it and turns Tk events into model calls.
+        # Size and preset zones come from map_config.json, for servers whose map isn't 999x999.
+        map_config = load_map_config()
+        self.model = MapModel(map_config["grid_size"], zones=map_config["zones"])
+        self.model.subscribe(self.on_model_changed)
+        self.redraw_pending = None
         self.is_panning = False
-        self.placed_objects = {}
-        self.terrain_cells = {}
 
         # For multi-selection and moving:
-        self.selected_objects = set()          # Stores keys (e.g., (x,y)) of selected objects
-        self.selected_markers = set()          # NEW: For marker selection
-        self.marker_dragging = False           # NEW: To track if a marker is being dragged
         self.selection_rect = None             # Canvas item id for the rubberband rectangle
         self.selection_start = None            # Starting point for rectangle selection (canvas coords)
         self.moving_start = None               # Starting point for moving (canvas coords)
         self.original_positions = {}           # Dictionary mapping object keys to their original (x,y) positions when moving
         self.selected_tool = None
-        self.original_positions = {}  # Dictionary mapping object keys to their original positions when moving
-        
-        # For markers (a dictionary keyed by a unique marker ID, e.g. the marker's name)
-        self.markers = {}  # Each marker is a dict with keys: "name", "x1", "y1", "x2", "y2", "color"
 
         # For marker moving/resizing:
-        self.current_marker_id = None   # The marker (its key) currently being moved/resized
-        self.marker_move_start = None   # The canvas coordinate where the marker drag started
+        self.current_marker_id = None   # The marker (its key) currently being resized
+        self.marker_move_start = None   # The canvas coordinate where the resize started
         self.marker_resizing = False    # Flag: True if the user is resizing (dragging a corner)
+        self.marker_resize_bbox = None  # The marker's bbox when the resize started
         self.current_tool = None  # Normal, or "marker_draw" when drawing a marker
         self.marker_draw_start = None  # Canvas (pixel) coordinate where marker drawing starts
         self.marker_draw_rect = None   # The canvas item id for the temporary rectangle
@@ -79,17 +2626,85 @@ class GridApp:
         # Load textures for terrain
         self.load_textures()
 
-        self.start_coordinate = start_coordinate
+        # Resized avatars, cached on disk; object_images keeps the PhotoImages of the last redraw
+        # of each object layer alive.
+        self.thumbnail_cache = ThumbnailCache()
+        self.label_fonts = LabelFonts(self.root)
+        self.object_images = {layer: {} for layer in OBJECT_LAYERS}
+        # Avatars load in the background; until one arrives its objects show their colored
+        # rectangle, tagged so the avatar can take its place.
+        self.avatar_loader = AvatarLoader(self.thumbnail_cache)
+        self.avatar_after = None
+        self.avatar_wait_tags = {}    # (path, w, h) -> canvas tag of the placeholders waiting for it
+        self.avatar_wait_count = 0
+
+        # Each layer is redrawn only when something on it changed; panning moves what is drawn.
+        self.layer_visible = {layer: True for layer in MAP_LAYERS}
+        self.dirty_layers = set(MAP_LAYERS)
+        self.drawn_view = None        # (cell_px, pan_x, pan_y) the canvas items were drawn for
+        self.drawn_region = None      # chunk-aligned cells [x1, x2) x [y1, y2) the chunked layers cover
+        self.drawn_selection = set()  # selection the object layers were drawn with
+        self.dirty_markers = set()    # markers to redraw on their own, without the rest of the layer
+        self.marker_tags = {}         # marker key -> canvas tag of its items
+        self.marker_tag_count = 0
+
+        # Stage timings for the performance overlay; the overlay only refreshes while shown.
+        self.perf = PerfStats()
+        self.hud_visible = False
+        self.hud_after_id = None
+        self.hud_last_tick = None
+
+        # Conflicts found by the map validator; drawn on the map while the validation list is open.
+        self.validation_win = None
+        self.validation_conflicts = []
+        self.validation_after = None
+
+        # Proximity queries (Tools menu); the overlay shows the last query while its window is open.
+        self.proximity = ProximityIndex(self.model, self.categorize_object)
+        self.proximity_win = None
+        self.proximity_query = None
+        self.proximity_overlay = None
+        self.proximity_after = None
+
+        # Influence heatmap (Tools menu); only kept up to date while it is shown.
+        self.influence = None
+        self.influence_photo = None
+        self.influence_radius = INFLUENCE_RADIUS
+        self.influence_opacity = 60
+
+        # Copy/paste and formation stamps; pasting checks the whole group against the occupancy grid.
+        self.occupancy = OccupancyGrid(self.model)
+        self.clipboard = None
+        self.formation_stamps = self.load_formation_stamps()
+        self.ghost_anchor = None   # (cell, zoom, pan) the paste preview was drawn for
+
+        # Collaboration: this instance may host a hub, and joins one through collab_client.
+        self.collab_hub = None
+        self.collab_client = None
+        self.collab_after = None
+
+        # Opt-in tracing of the hot handlers (Settings menu, or CONA_TRACE=1 to trace from startup).
+        # The wrappers go on before create_ui so the event bindings pick them up.
+        self.tracer = Tracer(enabled=os.environ.get("CONA_TRACE") == "1")
+        self.tracer.instrument(self, TRACED_HANDLERS)
+
+        self.start_coordinate = start_coordinate or (self.model.grid_size // 2, self.model.grid_size // 2)
         self.set_start_position(*self.start_coordinate)
 
         # Create UI elements
         self.create_ui()
+        self.recorder = InteractionRecorder(self.canvas, self.model)
+        self.create_minimap()
+        self.create_search_box()
     
         # Marker-drawing bindings
         self.canvas.bind("<ButtonPress-1>", self.marker_draw_press, add="+")
         self.canvas.bind("<B1-Motion>", self.marker_draw_motion, add="+")
         self.canvas.bind("<ButtonRelease-1>", self.marker_draw_release, add="+")
 
+        # Keep menus, the member listbox and placed member objects in sync with the registry.
+        self.alliance_members.subscribe(self.on_alliance_member_changed)
+
         # Then bind the general handlers once.
         self.canvas.bind("<ButtonPress-1>", self.on_left_button_press)
         self.canvas.bind("<B1-Motion>", self.on_left_button_motion)
@@ -103,24 +2718,115 @@ class GridApp:
         self.load_weekly_schedule()
         self.draw_grid()
         self.autosave()
+        for path in (STATE_FILE, WEEKLY_SCHEDULE_FILE, ALLIANCE_MEMBERS_FILE):
+            if path not in self.file_watcher.signatures:
+                self.file_watcher.mark(path)   # not there yet; picked up once another program creates it
+        self.root.after(FILE_WATCH_INTERVAL_MS, self.watch_files)
 
         # Load preset terrain (if no saved state)
         self.initialize_preset_terrain()
 
+    # ------------------------------
+    # Model access
+    # ------------------------------
+    # Read-only views of the model so drawing code can keep using the familiar names;
+    # changes must go through self.model so listeners are notified.
+    placed_objects = property(lambda self: self.model.placed_objects)
+    terrain_cells = property(lambda self: self.model.terrain_cells)
+    selected_objects = property(lambda self: self.model.selected_objects)
+    zoom_factor = property(lambda self: self.model.zoom_factor)
+    pan_x = property(lambda self: self.model.pan_x)
+    pan_y = property(lambda self: self.model.pan_y)
+
+    def on_model_changed(self, event, payload):
+        if hasattr(self, "occupancy"):
+            self.occupancy.apply(event, payload)
+        if hasattr(self, "proximity"):
+            self.proximity.apply(event, payload)
+        if getattr(self, "influence", None) is not None:
+            self.influence.apply(event, payload)
+        if hasattr(self, "search_index"):
+            self.search_index.apply(event, payload)
+        if hasattr(self, "minimap"):
+            if event == "view_changed":
+                self.update_minimap_viewport()
+            else:
+                dirty = self.minimap.apply(event, payload)
+                if dirty is None:
+                    self.minimap_full_refresh = True
+                    self.request_minimap_flush()
+                elif dirty:
+                    self.minimap_dirty.update(dirty)
+                    self.request_minimap_flush()
+        if self.validation_win is not None and event not in ("view_changed", "selection_changed"):
+            self.request_validation()
+        if self.proximity_query is not None and event not in ("view_changed", "selection_changed"):
+            self.request_proximity_refresh()
+        self.request_redraw(*self.changed_layers(event, payload))
+
+    def object_layer(self, data):
+        if data.get("is_marker"):
+            return "markers"
+        category = self.categorize_object(data)
+        return category if category in OBJECT_LAYERS else "other"
+
+    def changed_layers(self, event, payload):
+        """Layers whose drawing is out of date after a model event."""
+        if event == "reset":
+            return MAP_LAYERS
+        if event == "view_changed":
+            return ()   # draw_layers moves or redraws everything as needed
+        if event == "terrain_changed":
+            return ("terrain",)
+        if event == "selection_changed":
+            changed = self.drawn_selection ^ self.selected_objects
+            touched = [(key, self.placed_objects[key]) for key in changed if key in self.placed_objects]
+        elif event == "objects_moved":
+            touched = [(key, self.placed_objects[new]) for old, new in payload["moves"].items() for key in (old, new)]
+        else:
+            touched = [(payload["key"], payload["data"])]
+            if event == "object_changed":
+                touched.append((payload["key"], payload["previous"]))
+        layers = set()
+        for key, data in touched:
+            if data.get("is_marker"):
+                self.dirty_markers.add(key)
+            else:
+                layers.add(self.object_layer(data))
+        if self.influence is not None and event != "selection_changed" and layers:
+            layers.add("heatmap")
+        return layers
+
+    def request_redraw(self, *layers):
+        """Marks layers for redrawing and schedules a single draw_layers once Tk is idle,
+        however many changes arrive before then."""
+        self.dirty_layers.update(layers)
+        if self.redraw_pending is None and hasattr(self, "canvas"):
+            self.redraw_pending = self.root.after_idle(self.flush_redraw)
+
+    def flush_redraw(self):
+        self.redraw_pending = None
+        self.draw_layers()
+
+    def event_cell(self, event):
+        """Grid cell under a mouse event."""
+        return self.model.canvas_to_cell(self.canvas.canvasx(event.x), self.canvas.canvasy(event.y))
+
     # ------------------------------
     # Alliance Members Loading
     # ------------------------------
     def load_alliance_members(self):
         """Loads alliance members from 'alliance_members.txt' if it exists."""
+        members = []
         if os.path.exists("alliance_members.txt"):
             with open("alliance_members.txt", "r") as f:
                 try:
-                    self.alliance_members = json.load(f)
+                    members = json.load(f)
                 except Exception as e:
                     print("Error loading alliance members:", e)
-                    self.alliance_members = []
-        else:
-            self.alliance_members = []
+                    members = []
+            self.remember_file(ALLIANCE_MEMBERS_FILE)
+        self.alliance_members.load(members)
 
     # ------------------------------
     # Standard Grid, Zoom, and Panning Functions
@@ -166,7 +2872,7 @@ class GridApp:
 
     def update_zoom_threshold(self, val):
         self.grid_zoom_threshold = float(val)
-        self.draw_grid()
+        self.request_redraw("grid")
 
     def choose_grid_color(self, type):
         color = colorchooser.askcolor(title=f"Choose {type.capitalize()} Grid Color")[1]
@@ -175,7 +2881,7 @@ class GridApp:
                 self.minor_grid_color = color
             elif type == "major":
                 self.major_grid_color = color
-            self.draw_grid()
+            self.request_redraw("grid")
 
     def update_grid_opacity(self, type, val):
         val = int(val)
@@ -183,7 +2889,7 @@ class GridApp:
             self.minor_opacity = val
         elif type == "major":
             self.major_opacity = val
-        self.draw_grid()
+        self.request_redraw("grid")
 
     def update_dark_mode(self, is_dark):
         self.dark_mode = is_dark
@@ -194,59 +2900,59 @@ class GridApp:
         self.draw_grid()
 
     def load_textures(self):
-        self.original_textures = {
-            "mud": Image.open("Mud.png"),
-            "dark_mud": Image.open("Darkmud.png"),
-        }
-        self.textures = {}
-        self.textures["mud"] = ImageTk.PhotoImage(
-            self.original_textures["mud"].resize(((552 - 448) * CELL_SIZE, (550 - 446) * CELL_SIZE), Image.Resampling.LANCZOS)
-        )
-        self.textures["dark_mud"] = ImageTk.PhotoImage(
-            self.original_textures["dark_mud"].resize(((510 - 489) * CELL_SIZE, (508 - 486) * CELL_SIZE), Image.Resampling.LANCZOS)
-        )
+        self.original_textures = {}
+        for name, path in TERRAIN_TEXTURES.items():
+            try:
+                self.original_textures[name] = Image.open(path)
+            except OSError as e:
+                print("Error loading texture:", e)
+        self.textures = []   # PhotoImages of the zones drawn last
+        # Resized textures keyed by (name, width, height), most recently used last.
+        self.texture_cache = collections.OrderedDict()
+        self.texture_cache_hits = 0
+        self.texture_cache_misses = 0
+
+    def scaled_texture(self, name, width, height):
+        """PhotoImage of a terrain texture at the given size. Resizing is slow, so the sizes
+        used by the last few zoom levels are kept."""
+        key = (name, int(width), int(height))
+        photo = self.texture_cache.get(key)
+        if photo is not None:
+            self.texture_cache_hits += 1
+            self.texture_cache.move_to_end(key)
+            return photo
+        self.texture_cache_misses += 1
+        photo = ImageTk.PhotoImage(self.original_textures[name].resize(key[1:], Image.Resampling.LANCZOS))
+        self.texture_cache[key] = photo
+        while len(self.texture_cache) > TEXTURE_CACHE_SIZE:
+            self.texture_cache.popitem(last=False)
+        return photo
 
     def blend_color(self, hex_color, opacity):
-        if not (hex_color.startswith("#") and len(hex_color) == 7):
-            return "#000000"
-        r = int(hex_color[1:3], 16)
-        g = int(hex_color[3:5], 16)
-        b = int(hex_color[5:7], 16)
-        a = opacity / 100.0
-        if self.dark_mode:
-            nr = int(a * r)
-            ng = int(a * g)
-            nb = int(a * b)
-        else:
-            nr = int(a * r + (1 - a) * 255)
-            ng = int(a * g + (1 - a) * 255)
-            nb = int(a * b + (1 - a) * 255)
-        return f"#{nr:02x}{ng:02x}{nb:02x}"
+        return blend_hex(hex_color, opacity, self.dark_mode)
+
+    def grid_style(self):
+        """The grid line settings, in the form export_map_image takes."""
+        return {
+            "minor_color": self.minor_grid_color,
+            "major_color": self.major_grid_color,
+            "minor_opacity": self.minor_opacity,
+            "major_opacity": self.major_opacity,
+            "zoom_threshold": self.grid_zoom_threshold,
+            "dark_mode": self.dark_mode,
+        }
 
     def on_mouse_move(self, event):
-        adjusted_cell_size = CELL_SIZE * self.zoom_factor
-        canvas_x = self.canvas.canvasx(event.x)
-        canvas_y = self.canvas.canvasy(event.y)
-        x = int((canvas_x - self.pan_x) / adjusted_cell_size)
-        y = GRID_SIZE - int((canvas_y - self.pan_y) / adjusted_cell_size) - 1
-        if 0 <= x < GRID_SIZE and 0 <= y < GRID_SIZE:
+        x, y = self.event_cell(event)
+        if self.model.in_bounds(x, y):
             self.coord_label.config(text=f"Coordinates: ({x}, {y})")
         else:
             self.coord_label.config(text="Coordinates: Out of Bounds")
         self.update_shadow(event)
         if self.current_tool == "marker_draw":
-            # Convert the cursor's canvas position → nearest grid corner
-            canvas_x = self.canvas.canvasx(event.x)
-            canvas_y = self.canvas.canvasy(event.y)
-            adjusted = CELL_SIZE * self.zoom_factor
-
-            # 1) Convert canvas → grid corner, rounding to nearest integer
-            grid_x = round((canvas_x - self.pan_x) / adjusted)
-            grid_y = round(GRID_SIZE - (canvas_y - self.pan_y) / adjusted - 1)
-
-            # 2) Convert that grid corner back → canvas coords
-            dot_cx = grid_x * adjusted + self.pan_x
-            dot_cy = (GRID_SIZE - grid_y) * adjusted + self.pan_y
+            # Snap the cursor's canvas position to the nearest grid corner and back.
+            grid_x, grid_y = self.model.canvas_to_corner(self.canvas.canvasx(event.x), self.canvas.canvasy(event.y))
+            dot_cx, dot_cy = self.model.corner_to_canvas(grid_x, grid_y)
 
             # If the dot doesn't exist yet, create it:
             if self.marker_snap_dot_id is None:
@@ -271,19 +2977,11 @@ class GridApp:
                 self.marker_snap_dot_id = None
             
     def set_start_position(self, x, y):
-        self.pan_x = -x * CELL_SIZE * self.zoom_factor + 400
-        self.pan_y = -(GRID_SIZE - y - 1) * CELL_SIZE * self.zoom_factor + 400
+        self.model.set_start_position(x, y)
 
     def zoom(self, event):
         scale_factor = 1.1 if event.delta > 0 else 0.9
-        cursor_x = self.canvas.canvasx(event.x)
-        cursor_y = self.canvas.canvasy(event.y)
-        rel_x = (cursor_x - self.pan_x) / (CELL_SIZE * self.zoom_factor)
-        rel_y = (cursor_y - self.pan_y) / (CELL_SIZE * self.zoom_factor)
-        self.zoom_factor *= scale_factor
-        self.pan_x = cursor_x - (rel_x * CELL_SIZE * self.zoom_factor)
-        self.pan_y = cursor_y - (rel_y * CELL_SIZE * self.zoom_factor)
-        self.draw_grid()
+        self.model.zoom_at(self.canvas.canvasx(event.x), self.canvas.canvasy(event.y), scale_factor)
 
     def start_pan(self, event):
         self.is_panning = True
@@ -296,46 +2994,27 @@ class GridApp:
         if self.is_panning:
             dx = event.x - self.start_x
             dy = event.y - self.start_y
-            self.pan_x += dx
-            self.pan_y += dy
             self.start_x = event.x
             self.start_y = event.y
-            self.draw_grid()
+            self.model.pan_by(dx, dy)
 
     def stop_pan(self, event):
         self.is_panning = False
 
     def save_state(self):
-        state = {
-            "placed_objects": {f"{x},{y}": data for (x, y), data in self.placed_objects.items()},
-            "terrain_cells": {f"{x},{y}": terrain for (x, y), terrain in self.terrain_cells.items()},
-            "markers": self.markers,  # <-- added markers
-            "pan_x": self.pan_x,
-            "pan_y": self.pan_y,
-            "zoom_factor": self.zoom_factor
-        }
-        with open("autosave.json", "w") as f:
-            json.dump(state, f)
+        self.file_bases[STATE_FILE] = self.model.save(STATE_FILE)
+        self.file_watcher.mark(STATE_FILE)
+        self.state_read_failures = 0
 
     def load_state(self):
-        if os.path.exists("autosave.json"):
-            with open("autosave.json", "r") as f:
-                state = json.load(f)
-            self.placed_objects = {}
-            for key, data in state.get("placed_objects", {}).items():
-                x, y = map(int, key.split(","))
-                self.placed_objects[(x, y)] = data
-            self.terrain_cells = {}
-            for key, terrain in state.get("terrain_cells", {}).items():
-                x, y = map(int, key.split(","))
-                self.terrain_cells[(x, y)] = terrain
-            self.markers = state.get("markers", {})  # <-- load markers
-            self.pan_x = state.get("pan_x", self.pan_x)
-            self.pan_y = state.get("pan_y", self.pan_y)
-            self.zoom_factor = state.get("zoom_factor", self.zoom_factor)
+        if self.model.load(STATE_FILE):
+            self.remember_file(STATE_FILE)
 
     def autosave(self):
-        self.save_state()
+        # Take in changes other programs made to the file first, so saving doesn't overwrite them.
+        if self.check_external_changes():
+            with self.perf.timer("autosave"):
+                self.save_state()
         self.root.after(5000, self.autosave)
 
     def load_weekly_schedule(self):
@@ -345,278 +3024,1515 @@ class GridApp:
                 data = json.load(f)
             self.conductor_assignments = data.get("conductor_assignments", {})
             self.vs_tasks_by_weekday = data.get("vs_tasks_by_weekday", {})
+            self.remember_file(WEEKLY_SCHEDULE_FILE)
         else:
             self.conductor_assignments = {}
             self.vs_tasks_by_weekday = {}
 
-    def update_train_conductor_file(self):
-        """Writes the current train conductor assignments to 'train_conductor_list.txt'."""
-        with open("train_conductor_list.txt", "w") as f:
-            f.write("Train Conductor List:\n")
-            for date in sorted(self.conductor_assignments.keys()):
-                f.write(f"{date}: {self.conductor_assignments[date]}\n")
+    def schedule_snapshot(self):
+        """Returns the schedule dictionaries in the shape ScheduleExporter expects."""
+        return {
+            "conductor_assignments": self.conductor_assignments,
+            "vs_tasks_by_weekday": self.vs_tasks_by_weekday,
+            "vs_tasks": self.vs_tasks,
+            "vs_task_exceptions": self.vs_task_exceptions,
+        }
+
+    def update_train_conductor_file(self):
+        """Writes the conductor list and VS tasks to 'train_conductor_list.txt' if they changed."""
+        self.schedule_exporter.export("text", "train_conductor_list.txt", self.schedule_snapshot())
+
+    def export_schedule(self):
+        """Exports the schedule as text, CSV and iCalendar files into a chosen folder."""
+        folder = filedialog.askdirectory(title="Export Schedule To")
+        if not folder:
+            return
+        written = []
+        unchanged = []
+        for fmt, filename in SCHEDULE_EXPORT_FILES.items():
+            try:
+                if self.schedule_exporter.export(fmt, os.path.join(folder, filename), self.schedule_snapshot()):
+                    written.append(filename)
+                else:
+                    unchanged.append(filename)
+            except OSError as e:
+                messagebox.showerror("Export Schedule", f"Could not write {filename}: {e}")
+                return
+        lines = []
+        if written:
+            lines.append("Updated: " + ", ".join(written))
+        if unchanged:
+            lines.append("Unchanged: " + ", ".join(unchanged))
+        messagebox.showinfo("Export Schedule", "\n".join(lines))
+
+
+    def place_element(self, event):
+        if not self.selected_tool:
+            return
+        x, y = self.event_cell(event)
+        if not self.model.in_bounds(x, y):
+            return
+
+        if self.selected_tool["type"] == "delete":
+            center = self.model.object_at_cell(x, y)
+            if center is not None:
+                self.model.remove_object(center)
+            return
+
+        elif self.selected_tool["type"] == "terrain":
+            self.model.set_terrain({(x, y): self.selected_tool["terrain"]})
+
+        elif self.selected_tool["type"] == "stamp":
+            self.paste_formation(self.selected_tool["formation"], x, y, self.selected_tool["tag"])
+
+        elif self.selected_tool["type"] == "object":
+            # If this is a unique object (for alliance members, for example), remove any previous instance.
+            if self.selected_tool.get("unique", False):
+                # Match on the member ID so renamed members are still found; fall back to the tag.
+                previous = self.model.find_object(self.selected_tool.get("tag"), self.selected_tool.get("member_id"))
+                if previous is not None:
+                    self.model.remove_object(previous)
+
+            obj_size = self.selected_tool.get("size", (3, 3))
+            w, h = obj_size
+            # Check for collision with any other object.
+            if self.model.collides(x, y, w, h):
+                print("Cannot place object: Space occupied!")
+                return
+
+            # Place the object at the clicked cell.
+            data = {
+                "tag": self.selected_tool["tag"],
+                "color": self.selected_tool["color"],
+                "size": obj_size,
+                "avatar": self.selected_tool.get("avatar")
+            }
+            if self.selected_tool.get("member_id") is not None:
+                data["member_id"] = self.selected_tool["member_id"]
+            if self.selected_tool.get("category"):
+                data["category"] = self.selected_tool["category"]
+            self.model.place_object((x, y), data)
+
+        self.canvas.delete("shadow")
+
+    def update_alliance_members_submenu(self):
+        """Rebuilds the Alliance Members submenu from scratch (used after loading members)."""
+        self.custom_alliance_submenu.delete(0, tk.END)
+        self.alliance_member_submenus = {}
+        self.alliance_member_menu_ids = {}   # rank -> member IDs, in menu order
+        self.alliance_member_images = {}     # member ID -> PhotoImage (kept alive for Tk)
+        for rank in ALLIANCE_RANKS:
+            submenu = tk.Menu(self.custom_alliance_submenu, tearoff=0)
+            self.custom_alliance_submenu.add_cascade(label=rank, menu=submenu)
+            self.alliance_member_submenus[rank] = submenu
+            self.alliance_member_menu_ids[rank] = []
+        for member in self.alliance_members:
+            self.add_alliance_member_menu_entry(member)
+
+    def alliance_member_icon(self, member):
+        """A rank-colored icon for the member's menu entry; their avatar replaces it once loaded."""
+        rank = member.get("Rank", "R1")
+        if member.get("Avatar"):
+            member_id, path = member["Id"], member["Avatar"]
+
+            def show_avatar(key, image):
+                current = self.alliance_members.get(member_id)
+                if current is None or current.get("Avatar") != path:
+                    return
+                ids = self.alliance_member_menu_ids.get(current.get("Rank", "R1"), [])
+                if member_id in ids:
+                    photo = ImageTk.PhotoImage(image)
+                    self.alliance_member_submenus[current.get("Rank", "R1")].entryconfigure(
+                        ids.index(member_id), image=photo)
+                    self.alliance_member_images[member_id] = photo
+
+            self.request_avatar(path, (16, 16), show_avatar)
+        default_color = self.alliance_default_colors.get(rank, "#000000")
+        return ImageTk.PhotoImage(Image.new("RGB", (16, 16), default_color))
+
+    def add_alliance_member_menu_entry(self, member):
+        rank = member.get("Rank", "R1")
+        submenu = self.alliance_member_submenus.get(rank)
+        if not submenu:
+            return
+        avatar_photo = self.alliance_member_icon(member)
+        submenu.add_command(
+            label=member.get("Name", "Unnamed"),
+            image=avatar_photo,
+            compound="left",
+            command=lambda member_id=member["Id"]: self.activate_alliance_member(member_id)
+        )
+        self.alliance_member_menu_ids[rank].append(member["Id"])
+        self.alliance_member_images[member["Id"]] = avatar_photo
+
+    def remove_alliance_member_menu_entry(self, member_id, rank):
+        ids = self.alliance_member_menu_ids.get(rank, [])
+        if member_id in ids:
+            index = ids.index(member_id)
+            self.alliance_member_submenus[rank].delete(index)
+            ids.pop(index)
+        self.alliance_member_images.pop(member_id, None)
+
+    def activate_alliance_member(self, member_id):
+        member = self.alliance_members.get(member_id)
+        if member is None:
+            return
+        self.activate_preset_object(
+            member.get("Name", "Unnamed"),
+            self.alliance_default_colors.get(member.get("Rank", "R1"), "#000000"),
+            member.get("Size", (3, 3)),
+            unique=True,
+            avatar=member.get("Avatar"),
+            member_id=member_id,
+            category="alliance"
+        )
+
+    def on_alliance_member_changed(self, event, member, previous=None):
+        """Applies a single registry change to the menus, the member listbox and the map."""
+        if event == "reset":
+            self.update_alliance_members_submenu()
+            if self.member_listbox_alive():
+                self.update_member_listbox()
+            self.sync_placed_member_objects()
+            return
+        if event == "added":
+            self.add_alliance_member_menu_entry(member)
+            if self.member_listbox_alive():
+                self.member_listbox.insert(tk.END, self.member_listbox_label(member))
+                self.member_listbox_ids.append(member["Id"])
+        elif event == "removed":
+            self.remove_alliance_member_menu_entry(member["Id"], member.get("Rank", "R1"))
+            if self.member_listbox_alive() and member["Id"] in self.member_listbox_ids:
+                index = self.member_listbox_ids.index(member["Id"])
+                self.member_listbox.delete(index)
+                self.member_listbox_ids.pop(index)
+        elif event == "updated":
+            old_rank = previous.get("Rank", "R1")
+            new_rank = member.get("Rank", "R1")
+            ids = self.alliance_member_menu_ids.get(old_rank, [])
+            if old_rank != new_rank or member["Id"] not in ids:
+                self.remove_alliance_member_menu_entry(member["Id"], old_rank)
+                self.add_alliance_member_menu_entry(member)
+            else:
+                avatar_photo = self.alliance_member_icon(member)
+                self.alliance_member_submenus[new_rank].entryconfigure(
+                    ids.index(member["Id"]), label=member.get("Name", "Unnamed"), image=avatar_photo
+                )
+                self.alliance_member_images[member["Id"]] = avatar_photo
+            if self.member_listbox_alive() and member["Id"] in self.member_listbox_ids:
+                index = self.member_listbox_ids.index(member["Id"])
+                self.member_listbox.delete(index)
+                self.member_listbox.insert(index, self.member_listbox_label(member))
+            self.update_placed_member_objects(member, previous)
+
+    def sync_placed_member_objects(self):
+        """Refreshes every placed member base from the registry after a batch change."""
+        sync_member_objects(self.model, self.alliance_members, self.alliance_default_colors)
+
+    def update_placed_member_objects(self, member, previous):
+        """Carries a member's new name, rank color and avatar over to their base on the map
+        and to their conductor assignments."""
+        old_name = previous.get("Name")
+        new_name = member.get("Name")
+        for key, data in list(self.model.iter_objects()):
+            if data.get("member_id") == member["Id"] or \
+                    (data.get("member_id") is None and old_name and data.get("tag") == old_name):
+                self.model.update_object(
+                    key,
+                    member_id=member["Id"],
+                    tag=new_name,
+                    color=self.alliance_default_colors.get(member.get("Rank", "R1"), "#000000"),
+                    avatar=member.get("Avatar")
+                )
+        if old_name != new_name:
+            for date, conductor in self.conductor_assignments.items():
+                if conductor == old_name:
+                    self.conductor_assignments[date] = new_name
+
+    def draw_grid(self):
+        """Redraws every layer."""
+        self.dirty_layers.update(MAP_LAYERS)
+        self.draw_layers()
+
+    def draw_layers(self):
+        """Redraws the layers marked dirty. A pan moves the items already on the canvas;
+        only a zoom redraws everything."""
+        start = time.perf_counter()
+        view = (self.model.cell_px, self.pan_x, self.pan_y)
+        zoomed = self.drawn_view is None or view[0] != self.drawn_view[0]
+        if self.drawn_view is not None and view != self.drawn_view:
+            if view[0] == self.drawn_view[0]:
+                self.canvas.move("layer", view[1] - self.drawn_view[1], view[2] - self.drawn_view[2])
+                if self.influence is not None:
+                    self.dirty_layers.add("heatmap")   # only the visible part of it is drawn
+            else:
+                self.dirty_layers.update(MAP_LAYERS)
+        self.drawn_view = view
+        # Grid lines, objects and markers are only drawn for the chunks around the view;
+        # once the view leaves them, the chunks around the new view are drawn instead.
+        x1, y1, x2, y2 = self.visible_cells()
+        region = self.drawn_region
+        if zoomed or region is None or x1 < region[0] or y1 < region[1] or x2 > region[2] or y2 > region[3]:
+            self.drawn_region = (max(0, (x1 // CHUNK_SIZE - 1) * CHUNK_SIZE),
+                                 max(0, (y1 // CHUNK_SIZE - 1) * CHUNK_SIZE),
+                                 min(self.model.grid_size, ((x2 - 1) // CHUNK_SIZE + 2) * CHUNK_SIZE),
+                                 min(self.model.grid_size, ((y2 - 1) // CHUNK_SIZE + 2) * CHUNK_SIZE))
+            self.dirty_layers.update(("grid", "markers") + OBJECT_LAYERS)
+        dirty, self.dirty_layers = self.dirty_layers, set()
+        for layer in MAP_LAYERS:
+            if layer not in dirty:
+                continue
+            for tag in LAYER_TAGS[layer]:
+                self.canvas.delete(tag)
+            self.draw_layer(layer)
+            for tag in LAYER_TAGS[layer]:
+                self.canvas.addtag_withtag("layer", tag)
+                if not self.layer_visible[layer]:
+                    self.canvas.itemconfigure(tag, state="hidden")
+        if "markers" in dirty:
+            self.dirty_markers.clear()
+        elif self.dirty_markers:
+            self.redraw_marker_items(self.dirty_markers)
+            self.dirty_markers = set()
+            if not dirty:
+                for tag in LAYER_TAGS["overlays"] + ("shadow", "hud"):
+                    self.canvas.tag_raise(tag)
+        if dirty:
+            # Items are created on top, so put the layers back in order.
+            for layer in MAP_LAYERS:
+                for tag in LAYER_TAGS[layer]:
+                    self.canvas.tag_raise(tag)
+            self.canvas.tag_raise("shadow")
+            self.canvas.tag_raise("hud")
+        self.drawn_selection = set(self.selected_objects)
+        self.perf.record("draw_grid", time.perf_counter() - start)
+        if self.hud_visible:
+            self.draw_perf_hud()
+
+    def draw_layer(self, layer):
+        if layer == "terrain":
+            with self.perf.timer("redraw_terrain"):
+                self.redraw_terrain()
+        elif layer == "heatmap":
+            if self.influence is not None:
+                with self.perf.timer("influence"):
+                    self.draw_influence_overlay()
+        elif layer == "grid":
+            self.draw_grid_lines()
+        elif layer == "markers":
+            self.redraw_markers()
+        elif layer == "overlays":
+            if self.validation_conflicts:
+                self.draw_validation_overlay()
+            if self.proximity_overlay is not None:
+                self.draw_proximity_overlay()
+            if self.search_highlight is not None:
+                self.draw_search_highlight()
+        else:
+            with self.perf.timer("redraw_objects"):
+                self.redraw_objects((layer,))
+
+    def visible_cells(self):
+        """Cells [x1, x2) x [y1, y2) in view, clipped to the grid."""
+        grid_size = self.model.grid_size
+        left, top = self.canvas.canvasx(0), self.canvas.canvasy(0)
+        x1, y2 = self.model.canvas_to_cell(left, top)
+        x2, y1 = self.model.canvas_to_cell(left + self.canvas.winfo_width(), top + self.canvas.winfo_height())
+        x1, y1 = min(grid_size - 1, max(0, x1)), min(grid_size - 1, max(0, y1))
+        return x1, y1, max(x1 + 1, min(grid_size, x2 + 1)), max(y1 + 1, min(grid_size, y2 + 1))
+
+    def draw_grid_lines(self):
+        """Draws the grid lines across the drawn region only."""
+        adjusted_cell_size = self.model.cell_px
+        x1, y1, x2, y2 = self.drawn_region
+        left, top = self.model.corner_to_canvas(x1, y2)
+        right, bottom = self.model.corner_to_canvas(x2, y1)
+        for i in range(x1, x2 + 1):
+            x = i * adjusted_cell_size + self.pan_x
+            if i % 9 == 0:
+                line_color = self.blend_color(self.major_grid_color, self.major_opacity)
+                self.canvas.create_line(x, top, x, bottom, fill=line_color, tags="grid")
+            elif adjusted_cell_size >= self.grid_zoom_threshold:
+                line_color = self.blend_color(self.minor_grid_color, self.minor_opacity)
+                self.canvas.create_line(x, top, x, bottom, fill=line_color, tags="grid")
+        for i in range(y1, y2 + 1):
+            y = (self.model.grid_size - i) * adjusted_cell_size + self.pan_y
+            if i % 9 == 0:
+                line_color = self.blend_color(self.major_grid_color, self.major_opacity)
+                self.canvas.create_line(left, y, right, y, fill=line_color, tags="grid")
+            elif adjusted_cell_size >= self.grid_zoom_threshold:
+                line_color = self.blend_color(self.minor_grid_color, self.minor_opacity)
+                self.canvas.create_line(left, y, right, y, fill=line_color, tags="grid")
+
+    def toggle_layer(self, layer):
+        """Shows or hides a layer's canvas items; nothing is redrawn."""
+        self.layer_visible[layer] = self.layer_vars[layer].get()
+        state = "normal" if self.layer_visible[layer] else "hidden"
+        for tag in LAYER_TAGS[layer]:
+            self.canvas.itemconfigure(tag, state=state)
+
+    # ------------------------------
+    # Performance Overlay
+    # ------------------------------
+    def toggle_perf_hud(self, event=None):
+        if event is not None:
+            # Called from the F3 binding rather than the menu checkbutton.
+            self.hud_var.set(not self.hud_var.get())
+        self.hud_visible = self.hud_var.get()
+        if self.hud_visible:
+            self.hud_last_tick = None
+            self.refresh_perf_hud()
+        else:
+            if self.hud_after_id is not None:
+                self.root.after_cancel(self.hud_after_id)
+                self.hud_after_id = None
+            self.canvas.delete("hud")
+
+    def refresh_perf_hud(self):
+        """Redraws the overlay at a fixed rate. How late each tick fires shows how far
+        behind the Tk event loop is."""
+        now = time.perf_counter()
+        if self.hud_last_tick is not None:
+            lag = now - self.hud_last_tick - PERF_HUD_INTERVAL_MS / 1000
+            self.perf.record("event_loop_lag", max(0.0, lag))
+        self.hud_last_tick = now
+        self.draw_perf_hud()
+        self.hud_after_id = self.root.after(PERF_HUD_INTERVAL_MS, self.refresh_perf_hud)
+
+    def perf_hud_lines(self):
+        def ms(name):
+            last = self.perf.last(name)
+            if last is None:
+                return "-"
+            return f"{last * 1000:.1f} ms (avg {self.perf.average(name) * 1000:.1f})"
+
+        def rate(hits, misses):
+            total = hits + misses
+            return f"{hits / total:.0%}" if total else "-"
+
+        placed_markers = self.model.marker_count
+        return [
+            f"draw_grid: {ms('draw_grid')}",
+            f"  terrain: {ms('redraw_terrain')}",
+            f"  objects: {ms('redraw_objects')}",
+            f"Canvas items: {len(self.canvas.find_all())}",
+            f"Objects: {len(self.placed_objects) - placed_markers}  Markers: {placed_markers}",
+            f"Texture cache: {rate(self.texture_cache_hits, self.texture_cache_misses)}"
+            f"  Avatar cache: {rate(self.thumbnail_cache.hits, self.thumbnail_cache.misses)}"
+            f" ({len(self.avatar_loader.pending)} loading)"
+            f"  Labels: {rate(self.label_fonts.hits, self.label_fonts.misses)}",
+            f"Autosave: {ms('autosave')}",
+            f"Event loop lag: {ms('event_loop_lag')}",
+        ]
+
+    def draw_perf_hud(self):
+        self.canvas.delete("hud")
+        x = self.canvas.canvasx(0) + 10
+        y = self.canvas.canvasy(0) + 40   # below the search box
+        # Disabled items ignore the mouse, so the overlay never gets in the way of clicks.
+        text = self.canvas.create_text(x + 6, y + 6, text="\n".join(self.perf_hud_lines()), anchor="nw",
+                                       fill="#00FF00", font=("Courier", 9), tags="hud", state="disabled")
+        x1, y1, x2, y2 = self.canvas.bbox(text)
+        background = self.canvas.create_rectangle(x, y, x2 + 6, y2 + 6, fill="black", outline="",
+                                                  stipple="gray75", tags="hud", state="disabled")
+        self.canvas.tag_lower(background, text)
+
+    # ------------------------------
+    # Tracing
+    # ------------------------------
+    def toggle_tracing(self):
+        self.tracer.enabled = self.trace_var.get()
+
+    def dump_trace(self):
+        """Saves the spans from the last N seconds as a Chrome trace (JSON)."""
+        if not self.tracer.spans:
+            messagebox.showinfo("Dump Trace", "No spans recorded. Enable tracing in the Settings menu first.")
+            return
+        seconds = simpledialog.askinteger("Dump Trace", "Dump the last how many seconds?",
+                                          initialvalue=30, minvalue=1, parent=self.root)
+        if seconds is None:
+            return
+        path = filedialog.asksaveasfilename(title="Save Trace", defaultextension=".json",
+                                            initialfile="cona_trace.json", filetypes=[("Chrome trace", "*.json")])
+        if not path:
+            return
+        try:
+            count = self.tracer.dump(path, last_seconds=seconds)
+        except OSError as e:
+            messagebox.showerror("Error", f"Could not write trace: {e}")
+            return
+        messagebox.showinfo("Dump Trace", f"Wrote {count} spans to {path}.\nOpen it in Perfetto or about:tracing.")
+
+    # ------------------------------
+    # Search
+    # ------------------------------
+    def create_search_box(self):
+        """Search field in the top-left corner of the map (Ctrl+F) for objects, members and markers."""
+        self.search_index = SearchIndex(self.model)
+        self.search_results = []
+        self.search_highlight = None         # grid rectangle outlined after a jump
+        self.search_highlight_after = None
+        self.search_frame = tk.Frame(self.root, bd=1, relief=tk.SOLID)
+        self.search_var = tk.StringVar()
+        self.search_entry = tk.Entry(self.search_frame, textvariable=self.search_var, width=28)
+        self.search_entry.pack(fill=tk.X)
+        self.search_listbox = tk.Listbox(self.search_frame, height=8, activestyle="dotbox")
+        self.search_frame.place(in_=self.canvas, x=5, y=5, anchor="nw")
+        self.search_var.trace_add("write", lambda *args: self.update_search_results())
+        self.search_entry.bind("<Return>", lambda event: self.jump_to_search_result(0))
+        self.search_entry.bind("<Down>", lambda event: self.focus_search_results())
+        self.search_entry.bind("<Escape>", lambda event: self.clear_search())
+        self.search_listbox.bind("<Return>", lambda event: self.jump_to_selected_result())
+        self.search_listbox.bind("<Double-1>", lambda event: self.jump_to_selected_result())
+        self.search_listbox.bind("<Escape>", lambda event: self.clear_search())
+        self.root.bind("<Control-f>", lambda event: self.search_entry.focus_set())
+
+    def update_search_results(self):
+        self.search_results = self.search_index.search(self.search_var.get())
+        self.search_listbox.delete(0, tk.END)
+        for (kind, key), label in self.search_results:
+            where = self.search_index.location((kind, key))
+            position = f" ({int(where[0])},{int(where[1])})" if where else ""
+            self.search_listbox.insert(tk.END, f"{label}{position}" if kind == "object" else f"[Marker] {label}{position}")
+        if self.search_results:
+            self.search_listbox.pack(fill=tk.X)
+        else:
+            self.search_listbox.pack_forget()
+
+    def focus_search_results(self):
+        if self.search_results:
+            self.search_listbox.focus_set()
+            self.search_listbox.selection_clear(0, tk.END)
+            self.search_listbox.selection_set(0)
+            self.search_listbox.activate(0)
+
+    def jump_to_selected_result(self):
+        selection = self.search_listbox.curselection()
+        if selection:
+            self.jump_to_search_result(selection[0])
+
+    def jump_to_search_result(self, index):
+        if index >= len(self.search_results):
+            return
+        entry, _ = self.search_results[index]
+        rect = self.search_index.location(entry)
+        if rect is None:
+            return
+        x1, y1, x2, y2 = rect
+        self.model.center_on((x1 + x2) / 2, (y1 + y2) / 2, self.canvas.winfo_width(), self.canvas.winfo_height())
+        if entry[0] == "object":
+            self.model.select([entry[1]])
+        self.search_highlight = rect
+        self.request_redraw("overlays")
+        if self.search_highlight_after is not None:
+            self.root.after_cancel(self.search_highlight_after)
+        self.search_highlight_after = self.root.after(2000, self.clear_search_highlight)
+        self.clear_search()
+        self.canvas.focus_set()
+
+    def clear_search(self):
+        self.search_var.set("")
+        self.search_listbox.pack_forget()
+
+    def draw_search_highlight(self):
+        c_x1, c_y1, c_x2, c_y2 = self.model.bbox_canvas_rect(self.search_highlight)
+        pad = 6
+        self.canvas.create_rectangle(min(c_x1, c_x2) - pad, min(c_y1, c_y2) - pad, max(c_x1, c_x2) + pad,
+                                     max(c_y1, c_y2) + pad, outline="#FF00FF", width=3, tags="search_highlight")
+
+    def clear_search_highlight(self):
+        self.search_highlight = None
+        self.search_highlight_after = None
+        self.canvas.delete("search_highlight")
+
+    # ------------------------------
+    # Map Validation
+    # ------------------------------
+    def validate_map(self):
+        """Lists overlapping objects, objects on restricted terrain and objects outside the grid,
+        and marks them on the map. The list re-checks itself while it stays open."""
+        if self.validation_win is not None and self.validation_win.winfo_exists():
+            self.validation_win.lift()
+            self.run_validation()
+            return
+        self.validation_win = tk.Toplevel(self.root)
+        self.set_window_title(self.validation_win, "Map Validation")
+        self.validation_summary = tk.Label(self.validation_win, anchor="w")
+        self.validation_summary.pack(fill=tk.X, padx=10, pady=(10, 0))
+        self.validation_listbox = tk.Listbox(self.validation_win, width=70, height=15)
+        self.validation_listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        self.validation_listbox.bind("<<ListboxSelect>>", lambda event: self.jump_to_conflict())
+        buttons = tk.Frame(self.validation_win)
+        buttons.pack(pady=(0, 10))
+        tk.Button(buttons, text="Re-check", command=self.run_validation).pack(side=tk.LEFT, padx=5)
+        tk.Button(buttons, text="Close", command=self.close_validation).pack(side=tk.LEFT, padx=5)
+        self.validation_win.protocol("WM_DELETE_WINDOW", self.close_validation)
+        self.run_validation()
+
+    def request_validation(self):
+        if self.validation_after is not None:
+            self.root.after_cancel(self.validation_after)
+        self.validation_after = self.root.after(VALIDATION_DELAY_MS, self.run_validation)
+
+    def run_validation(self):
+        self.validation_after = None
+        if self.validation_win is None:
+            return
+        with self.perf.timer("validate_map"):
+            self.validation_conflicts = find_map_conflicts(self.model)
+        self.validation_listbox.delete(0, tk.END)
+        for conflict in self.validation_conflicts:
+            self.validation_listbox.insert(tk.END, conflict["message"])
+            self.validation_listbox.itemconfig(tk.END, fg=CONFLICT_COLORS[conflict["kind"]])
+        count = len(self.validation_conflicts)
+        self.validation_summary.config(text=f"{count} problem(s) found." if count else "No problems found.")
+        self.request_redraw("overlays")
+
+    def jump_to_conflict(self):
+        selection = self.validation_listbox.curselection()
+        if not selection or selection[0] >= len(self.validation_conflicts):
+            return
+        conflict = self.validation_conflicts[selection[0]]
+        x1, y1, x2, y2 = conflict["rect"]
+        self.model.center_on((x1 + x2) / 2, (y1 + y2) / 2, self.canvas.winfo_width(), self.canvas.winfo_height())
+        self.model.select(key for key in conflict["keys"] if key in self.placed_objects)
+
+    def close_validation(self):
+        if self.validation_after is not None:
+            self.root.after_cancel(self.validation_after)
+            self.validation_after = None
+        if self.validation_win is not None:
+            self.validation_win.destroy()
+        self.validation_win = None
+        self.validation_conflicts = []
+        self.canvas.delete("validation")
+
+    def draw_validation_overlay(self):
+        for conflict in self.validation_conflicts:
+            color = CONFLICT_COLORS[conflict["kind"]]
+            c_x1, c_y1, c_x2, c_y2 = self.model.bbox_canvas_rect(conflict["rect"])
+            self.canvas.create_rectangle(min(c_x1, c_x2), min(c_y1, c_y2), max(c_x1, c_x2), max(c_y1, c_y2),
+                                         fill=color, stipple="gray50", outline=color, width=2, tags="validation")
+
+    # ------------------------------
+    # Auto Layout
+    # ------------------------------
+    def auto_layout_members(self):
+        """Places a chosen set of members around an anchor cell or inside a marker, highest ranks closest."""
+        win = tk.Toplevel(self.root)
+        self.set_window_title(win, "Auto Layout")
+        members = sorted(self.alliance_members, key=lambda m: (-ALLIANCE_RANKS.index(m.get("Rank", "R1")),
+                                                               m.get("Name", "").casefold()))
+        tk.Label(win, text="Members:").grid(row=0, column=0, columnspan=2, sticky="w", padx=10, pady=(10, 0))
+        member_list = tk.Listbox(win, selectmode=tk.EXTENDED, height=12, exportselection=False)
+        for member in members:
+            member_list.insert(tk.END, f"[{member.get('Rank', 'R1')}] {member.get('Name', 'Unnamed')}")
+        member_list.selection_set(0, tk.END)
+        member_list.grid(row=1, column=0, columnspan=2, sticky="nsew", padx=10, pady=5)
+
+        center_x, center_y = self.model.canvas_to_cell(self.canvas.canvasx(self.canvas.winfo_width() / 2),
+                                                       self.canvas.canvasy(self.canvas.winfo_height() / 2))
+        anchor_x = tk.IntVar(value=center_x)
+        anchor_y = tk.IntVar(value=center_y)
+        tk.Label(win, text="Anchor X:").grid(row=2, column=0, sticky="w", padx=10)
+        tk.Entry(win, textvariable=anchor_x, width=8).grid(row=2, column=1, sticky="w", padx=10)
+        tk.Label(win, text="Anchor Y:").grid(row=3, column=0, sticky="w", padx=10)
+        tk.Entry(win, textvariable=anchor_y, width=8).grid(row=3, column=1, sticky="w", padx=10)
+        marker_names = ["(anywhere)"] + sorted(key[1] for key, data in self.placed_objects.items()
+                                               if data.get("is_marker"))
+        region_var = tk.StringVar(value=marker_names[0])
+        tk.Label(win, text="Inside marker:").grid(row=4, column=0, sticky="w", padx=10)
+        ttk.Combobox(win, textvariable=region_var, values=marker_names, state="readonly",
+                     width=18).grid(row=4, column=1, sticky="w", padx=10)
+        spacing_var = tk.IntVar(value=0)
+        tk.Label(win, text="Free cells between bases:").grid(row=5, column=0, sticky="w", padx=10)
+        tk.Spinbox(win, from_=0, to=5, textvariable=spacing_var, width=6).grid(row=5, column=1, sticky="w", padx=10)
+
+        def apply_layout():
+            chosen = [members[i] for i in member_list.curselection()]
+            if not chosen:
+                messagebox.showerror("Error", "Select at least one member.")
+                return
+            try:
+                anchor = (anchor_x.get(), anchor_y.get())
+                spacing = max(0, spacing_var.get())
+            except tk.TclError:
+                messagebox.showerror("Error", "Anchor and spacing must be whole numbers.")
+                return
+            region = None
+            marker = self.placed_objects.get(("marker", region_var.get()))
+            if marker is not None:
+                x1, y1, x2, y2 = marker["bbox"]
+                region = (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+                anchor = ((region[0] + region[2]) // 2, (region[1] + region[3]) // 2)
+            if not self.model.in_bounds(*anchor):
+                messagebox.showerror("Error", "The anchor lies outside the grid.")
+                return
+            with self.perf.timer("auto_layout"):
+                added, removed, unplaced = plan_member_layout(self.model, chosen, anchor, region, spacing,
+                                                              self.alliance_default_colors)
+            if added:
+                self.model.apply_edit({**removed, **added}, label="Auto Layout")
+                self.model.select(added)
+            win.destroy()
+            self.status_bar.config(text=f"Laid out {len(added)} member(s). Ctrl+Z to undo.")
+            if unplaced:
+                names = ", ".join(m.get("Name", "Unnamed") for m in unplaced[:10])
+                more = f" and {len(unplaced) - 10} more" if len(unplaced) > 10 else ""
+                messagebox.showwarning("Auto Layout", f"No room for {len(unplaced)} member(s): {names}{more}.")
+
+        buttons = tk.Frame(win)
+        buttons.grid(row=6, column=0, columnspan=2, pady=10)
+        tk.Button(buttons, text="Lay Out", command=apply_layout).pack(side=tk.LEFT, padx=5)
+        tk.Button(buttons, text="Cancel", command=win.destroy).pack(side=tk.LEFT, padx=5)
+        win.columnconfigure(1, weight=1)
+        win.rowconfigure(1, weight=1)
+
+    def undo_edit(self, event=None):
+        if event is not None and isinstance(event.widget, tk.Entry):
+            return  # Let text fields handle their own undo.
+        try:
+            label = self.model.undo()
+        except ValueError as e:
+            messagebox.showwarning("Undo", str(e))
+            return
+        self.status_bar.config(text=f"Undid {label}" if label else "Nothing to undo")
+
+    def redo_edit(self, event=None):
+        if event is not None and isinstance(event.widget, tk.Entry):
+            return
+        try:
+            label = self.model.redo()
+        except ValueError as e:
+            messagebox.showwarning("Redo", str(e))
+            return
+        self.status_bar.config(text=f"Redid {label}" if label else "Nothing to redo")
+
+    # ------------------------------
+    # Proximity
+    # ------------------------------
+    def categorize_object(self, data):
+        return object_category(data, {"friendly": self.friendly_objects, "enemy": self.enemy_objects,
+                                      "other": self.other_objects})
+
+    def open_proximity_window(self):
+        """Nearest enemies of every member and friendly, or the friendlies within range of a cell,
+        listed and drawn on the map. The result follows map edits while the window is open."""
+        if self.proximity_win is not None and self.proximity_win.winfo_exists():
+            self.proximity_win.lift()
+            return
+        win = self.proximity_win = tk.Toplevel(self.root)
+        self.set_window_title(win, "Proximity")
+        win.protocol("WM_DELETE_WINDOW", self.close_proximity_window)
+
+        nearest_frame = tk.LabelFrame(win, text="Nearest enemies of our bases")
+        nearest_frame.pack(fill=tk.X, padx=10, pady=(10, 5))
+        count_var = tk.IntVar(value=1)
+        tk.Label(nearest_frame, text="Enemies per base:").pack(side=tk.LEFT, padx=5)
+        tk.Spinbox(nearest_frame, from_=1, to=5, textvariable=count_var, width=4).pack(side=tk.LEFT)
+        tk.Button(nearest_frame, text="Show",
+                  command=lambda: self.run_proximity_query(("nearest", self.spin_value(count_var, 1)))
+                  ).pack(side=tk.LEFT, padx=5, pady=5)
+
+        center_x, center_y = self.model.canvas_to_cell(self.canvas.canvasx(self.canvas.winfo_width() / 2),
+                                                       self.canvas.canvasy(self.canvas.winfo_height() / 2))
+        range_frame = tk.LabelFrame(win, text="Friendlies within range of a cell")
+        range_frame.pack(fill=tk.X, padx=10, pady=5)
+        x_var, y_var, radius_var = tk.IntVar(value=center_x), tk.IntVar(value=center_y), tk.IntVar(value=20)
+        for label, var in (("X:", x_var), ("Y:", y_var), ("Cells:", radius_var)):
+            tk.Label(range_frame, text=label).pack(side=tk.LEFT, padx=(5, 0))
+            tk.Entry(range_frame, textvariable=var, width=5).pack(side=tk.LEFT)
+        tk.Button(range_frame, text="Show",
+                  command=lambda: self.run_proximity_query(("within", self.spin_value(x_var, center_x),
+                                                            self.spin_value(y_var, center_y),
+                                                            self.spin_value(radius_var, 20)))
+                  ).pack(side=tk.LEFT, padx=5, pady=5)
+
+        self.proximity_listbox = tk.Listbox(win, width=60, height=14)
+        self.proximity_listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        self.proximity_listbox.bind("<<ListboxSelect>>", lambda event: self.jump_to_proximity_result())
+        self.proximity_rows = []
+        buttons = tk.Frame(win)
+        buttons.pack(pady=(0, 10))
+        tk.Button(buttons, text="Clear Overlay", command=self.clear_proximity_overlay).pack(side=tk.LEFT, padx=5)
+        tk.Button(buttons, text="Close", command=self.close_proximity_window).pack(side=tk.LEFT, padx=5)
+
+    @staticmethod
+    def spin_value(var, default):
+        try:
+            return var.get()
+        except tk.TclError:
+            return default
+
+    def run_proximity_query(self, query=None):
+        self.proximity_after = None
+        query = query or self.proximity_query
+        if query is None or self.proximity_win is None:
+            return
+        self.proximity_query = query
+        self.proximity_listbox.delete(0, tk.END)
+        self.proximity_rows = []
+        lines = []
+        with self.perf.timer("proximity"):
+            if query[0] == "nearest":
+                pairs = self.proximity.nearest_pairs(("alliance", "friendly"), "enemy", max(1, query[1]))
+                for source, hits in pairs:
+                    for distance, target in hits:
+                        lines.append((source, target, distance))
+                circle = None
+            else:
+                _, x, y, radius = query
+                hits = self.proximity.within(x, y, max(0, radius), "alliance") + \
+                    self.proximity.within(x, y, max(0, radius), "friendly")
+                hits.sort()
+                lines = [((x, y), target, distance) for distance, target in hits]
+                circle = (x, y, max(0, radius))
+        for source, target, distance in lines:
+            target_tag = self.placed_objects[target].get("tag", "Unnamed")
+            if query[0] == "nearest":
+                text = f"{describe_object(source, self.placed_objects[source])} -> '{target_tag}' ({distance:.1f} cells)"
+            else:
+                text = f"{describe_object(target, self.placed_objects[target])} ({distance:.1f} cells)"
+            self.proximity_listbox.insert(tk.END, text)
+            self.proximity_rows.append(target)
+        if not lines:
+            self.proximity_listbox.insert(tk.END, "No matching objects.")
+        self.proximity_overlay = {"lines": lines, "circle": circle}
+        self.request_redraw("overlays")
+
+    def request_proximity_refresh(self):
+        if self.proximity_after is not None:
+            self.root.after_cancel(self.proximity_after)
+        self.proximity_after = self.root.after(VALIDATION_DELAY_MS, self.run_proximity_query)
+
+    def jump_to_proximity_result(self):
+        selection = self.proximity_listbox.curselection()
+        if not selection or selection[0] >= len(self.proximity_rows):
+            return
+        key = self.proximity_rows[selection[0]]
+        if key in self.placed_objects:
+            self.model.center_on(key[0], key[1], self.canvas.winfo_width(), self.canvas.winfo_height())
+            self.model.select([key])
+
+    def clear_proximity_overlay(self):
+        if self.proximity_after is not None:
+            self.root.after_cancel(self.proximity_after)
+            self.proximity_after = None
+        self.proximity_query = None
+        self.proximity_overlay = None
+        self.canvas.delete("proximity")
+
+    def close_proximity_window(self):
+        self.clear_proximity_overlay()
+        if self.proximity_win is not None:
+            self.proximity_win.destroy()
+        self.proximity_win = None
+
+    def draw_proximity_overlay(self):
+        cell_px = self.model.cell_px
+
+        def center(key):
+            data = self.placed_objects.get(key)
+            if data is None:
+                return self.model.corner_to_canvas(key[0] + 0.5, key[1] + 0.5)
+            c_x1, c_y1, c_x2, c_y2 = self.model.object_canvas_rect(key, data)
+            return (c_x1 + c_x2) / 2, (c_y1 + c_y2) / 2
+
+        circle = self.proximity_overlay["circle"]
+        if circle is not None:
+            c_x, c_y = self.model.corner_to_canvas(circle[0] + 0.5, circle[1] + 0.5)
+            r = circle[2] * cell_px
+            self.canvas.create_oval(c_x - r, c_y - r, c_x + r, c_y + r, outline="#1F618D", width=2,
+                                    dash=(6, 3), tags="proximity")
+        for source, target, distance in self.proximity_overlay["lines"]:
+            s_x, s_y = center(source)
+            t_x, t_y = center(target)
+            self.canvas.create_line(s_x, s_y, t_x, t_y, fill="#C0392B", width=2, arrow=tk.LAST, tags="proximity")
+            if cell_px >= 6:
+                self.canvas.create_text((s_x + t_x) / 2, (s_y + t_y) / 2, text=f"{distance:.0f}",
+                                        fill="#C0392B", font=("Arial", 9, "bold"), tags="proximity")
+
+    # ------------------------------
+    # Influence Heatmap
+    # ------------------------------
+    def toggle_influence(self):
+        if not self.influence_var.get():
+            self.influence = None
+            self.influence_photo = None
+            self.canvas.delete("influence")
+            return
+        if np is None:
+            self.influence_var.set(False)
+            messagebox.showerror("Error", "The influence heatmap needs NumPy (pip install numpy).")
+            return
+        self.influence = InfluenceMap(self.model, self.influence_radius, self.influence_opacity,
+                                      self.categorize_object)
+        self.request_redraw("heatmap")
+
+    def edit_influence_settings(self):
+        win = tk.Toplevel(self.root)
+        self.set_window_title(win, "Heatmap Settings")
+
+        def set_radius(val):
+            self.influence_radius = int(val)
+            if self.influence is not None and self.influence.radius != self.influence_radius:
+                self.influence.set_radius(self.influence_radius)
+                self.request_redraw("heatmap")
+
+        def set_opacity(val):
+            self.influence_opacity = int(val)
+            if self.influence is not None and self.influence.opacity != self.influence_opacity:
+                self.influence.set_opacity(self.influence_opacity)
+                self.request_redraw("heatmap")
+
+        tk.Label(win, text="Radius (cells):").grid(row=0, column=0, sticky="w", padx=10)
+        radius_scale = tk.Scale(win, from_=1, to=60, orient="horizontal", command=set_radius)
+        radius_scale.set(self.influence_radius)
+        radius_scale.grid(row=0, column=1, sticky="ew", padx=5, pady=5)
+        tk.Label(win, text="Opacity:").grid(row=1, column=0, sticky="w", padx=10)
+        opacity_scale = tk.Scale(win, from_=0, to=100, orient="horizontal", command=set_opacity)
+        opacity_scale.set(self.influence_opacity)
+        opacity_scale.grid(row=1, column=1, sticky="ew", padx=5, pady=5)
+        tk.Button(win, text="Close", command=win.destroy).grid(row=2, column=0, columnspan=2, pady=10)
+
+    def draw_influence_overlay(self):
+        """Draws the visible part of the heatmap as a single image item, one canvas pixel
+        block per cell, above the terrain."""
+        self.influence.update()
+        grid_size = self.model.grid_size
+        left, top = self.canvas.canvasx(0), self.canvas.canvasy(0)
+        x1, y2 = self.model.canvas_to_cell(left, top)
+        x2, y1 = self.model.canvas_to_cell(left + self.canvas.winfo_width(), top + self.canvas.winfo_height())
+        x1, y1 = max(0, x1), max(0, y1)
+        x2, y2 = min(grid_size, x2 + 1), min(grid_size, y2 + 1)
+        if x1 >= x2 or y1 >= y2:
+            return
+        cell_px = self.model.cell_px
+        width, height = max(1, round((x2 - x1) * cell_px)), max(1, round((y2 - y1) * cell_px))
+        image = self.influence.image(x1, y1, x2, y2).resize((width, height), Image.Resampling.NEAREST)
+        self.influence_photo = ImageTk.PhotoImage(image)
+        c_x, c_y = self.model.corner_to_canvas(x1, y2)
+        self.canvas.create_image(c_x, c_y, image=self.influence_photo, anchor="nw", tags="influence")
+
+    # ------------------------------
+    # Collaboration
+    # ------------------------------
+    def parse_address(self, text):
+        host, _, port = (text or "").strip().rpartition(":")
+        return host or "127.0.0.1", int(port)
+
+    def host_collaboration(self):
+        """Starts a hub seeded with this map and joins it; other officers then join this address."""
+        if self.collab_client is not None:
+            messagebox.showinfo("Collaboration", "Leave the current session first.")
+            return
+        address = simpledialog.askstring(
+            "Host Collaboration", "Listen on (host:port). Use 0.0.0.0 to accept other computers:",
+            initialvalue=f"127.0.0.1:{COLLAB_PORT}", parent=self.root)
+        if not address:
+            return
+        try:
+            host, port = self.parse_address(address)
+            self.collab_hub = CollabHub(self.model.to_state(), self.schedule_snapshot(), host, port,
+                                        grid_size=self.model.grid_size).start()
+        except (ValueError, OSError) as e:
+            self.collab_hub = None
+            messagebox.showerror("Error", f"Could not start the hub: {e}")
+            return
+        self.connect_collaboration("127.0.0.1" if host == "0.0.0.0" else host, self.collab_hub.address[1], "Host")
+
+    def join_collaboration(self):
+        if self.collab_client is not None:
+            messagebox.showinfo("Collaboration", "Leave the current session first.")
+            return
+        address = simpledialog.askstring("Join Collaboration", "Hub address (host:port):",
+                                         initialvalue=f"127.0.0.1:{COLLAB_PORT}", parent=self.root)
+        if not address:
+            return
+        name = simpledialog.askstring("Join Collaboration", "Your name:", parent=self.root) or ""
+        if not messagebox.askyesno("Join Collaboration", "Joining replaces the map on screen with the shared one. Continue?"):
+            return
+        try:
+            host, port = self.parse_address(address)
+        except ValueError:
+            messagebox.showerror("Error", "Enter the address as host:port.")
+            return
+        self.connect_collaboration(host, port, name)
+
+    def connect_collaboration(self, host, port, name):
+        try:
+            self.collab_client = CollabClient(self.model, host, port, name, on_schedule=self.on_collab_schedule)
+        except (OSError, ValueError, ConnectionError) as e:
+            messagebox.showerror("Error", f"Could not join {host}:{port}: {e}")
+            self.stop_collab_hub()
+            return
+        self.status_bar.config(text=f"Collaborating via {host}:{port}")
+        self.poll_collaboration()
+
+    def poll_collaboration(self):
+        self.collab_after = None
+        client = self.collab_client
+        if client is None:
+            return
+        if not client.process_incoming():
+            self.leave_collaboration()
+            messagebox.showwarning("Collaboration", "The connection to the hub was lost. Your map keeps the last shared state.")
+            return
+        if client.rejected:
+            reasons = ", ".join(sorted({reason for _, reason in client.rejected}))
+            client.rejected.clear()
+            self.status_bar.config(text=f"An edit was undone because another officer changed the map first ({reasons}).")
+        self.collab_after = self.root.after(COLLAB_POLL_MS, self.poll_collaboration)
+
+    def on_collab_schedule(self, schedule):
+        self.conductor_assignments = dict(schedule.get("conductor_assignments", {}))
+        self.vs_tasks_by_weekday = dict(schedule.get("vs_tasks_by_weekday", {}))
+        try:
+            self.update_schedule_display()
+        except (AttributeError, tk.TclError):
+            pass  # The schedule window is not open.
+
+    def leave_collaboration(self):
+        if self.collab_after is not None:
+            self.root.after_cancel(self.collab_after)
+            self.collab_after = None
+        if self.collab_client is not None:
+            self.collab_client.close()
+            self.collab_client = None
+        self.stop_collab_hub()
+        self.status_bar.config(text="Tool: None")
+
+    def stop_collab_hub(self):
+        if self.collab_hub is not None:
+            self.collab_hub.stop()
+            self.collab_hub = None
+
+    # ------------------------------
+    # External Changes
+    # ------------------------------
+    def remember_file(self, path):
+        """Records a state file's current text as the version this app last read or wrote."""
+        try:
+            with open(path, "r") as f:
+                self.file_bases[path] = f.read()
+        except OSError:
+            self.file_bases.pop(path, None)
+        self.file_watcher.mark(path)
+
+    def watch_files(self):
+        self.check_external_changes()
+        self.root.after(FILE_WATCH_INTERVAL_MS, self.watch_files)
+
+    def check_external_changes(self):
+        """Merges changes other programs made to the state files into what is on screen.
+        Only entries changed on disk alone are applied; entries also changed here are
+        conflicts and the user chooses which version to keep. A file that can't be read is
+        skipped until the next check. Returns False while the map's own file can't be read
+        (e.g. it is still being written), so autosave waits a few checks before writing it."""
+        if self.checking_files:
+            return False
+        handlers = {STATE_FILE: self.merge_state_file, WEEKLY_SCHEDULE_FILE: self.merge_schedule_file,
+                    ALLIANCE_MEMBERS_FILE: self.merge_members_file}
+        self.checking_files = True
+        waiting = False
+        try:
+            for path in self.file_watcher.changed():
+                if FileWatcher.signature(path) is None:
+                    # Deleted or moved away: there is nothing to merge, and saving writes it again.
+                    self.file_watcher.mark(path)
+                    continue
+                try:
+                    with open(path, "r") as f:
+                        text = f.read()
+                    disk = json.loads(text)
+                except (OSError, ValueError) as e:
+                    # Try this file again on the next check; the others are still merged.
+                    if path == STATE_FILE:
+                        self.state_read_failures += 1
+                        waiting = self.state_read_failures <= STATE_READ_RETRIES
+                        if self.state_read_failures == STATE_READ_RETRIES + 1:
+                            print(f"Can't read {path} ({e}); saving over it.")
+                    continue
+                if path == STATE_FILE:
+                    self.state_read_failures = 0
+                if text != self.file_bases.get(path) and path in handlers:
+                    base = json.loads(self.file_bases[path]) if self.file_bases.get(path) else None
+                    handlers[path](base, disk)
+                self.file_bases[path] = text
+                self.file_watcher.mark(path)
+        finally:
+            self.checking_files = False
+        return not waiting
+
+    def resolve_conflicts(self, path, conflicts):
+        """Asks whether to keep this app's version of the conflicting entries. Returns True to keep them."""
+        listed = "\n".join(f"  {name}" for name in conflicts[:10])
+        more = f"\n  ...and {len(conflicts) - 10} more" if len(conflicts) > 10 else ""
+        return messagebox.askyesno(
+            "File Changed", f"{path} was changed by another program, and these entries were also changed here:\n"
+                            f"{listed}{more}\n\nKeep your versions? Choose No to use the file's versions.")
+
+    def merge_state_file(self, base, disk):
+        base = migrate_legacy_markers(base or {})
+        disk = migrate_legacy_markers(disk)
+        local = json.loads(json.dumps(self.model.to_state()))
+        sections = ("placed_objects", "terrain_cells")
+        merged = {section: merge_changes(base.get(section, {}), disk.get(section, {}), local.get(section, {}))
+                  for section in sections}
+        clashes = [(section, name) for section in sections for name in merged[section][1]]
+        if clashes and not self.resolve_conflicts(STATE_FILE, [f"{section}: {name}" for section, name in clashes]):
+            for section, name in clashes:
+                merged[section][0][name] = disk.get(section, {}).get(name, MISSING)
+        changes, terrain = {}, {}
+        for section in sections:
+            for name, value in merged[section][0].items():
+                if section == "placed_objects":
+                    changes[self.model._str_to_key(name)] = None if value is MISSING else value
+                elif section == "terrain_cells" and value is not MISSING:
+                    # Terrain can only be painted, not erased, so cells cleared in the file stay.
+                    x, y = map(int, name.split(","))
+                    terrain[(x, y)] = value
+        if changes:
+            # One batch, so Ctrl+Z takes the whole reload back.
+            self.model.apply_edit(changes, label="Changes from disk")
+        if terrain:
+            self.model.set_terrain(terrain)
+        count = len(changes) + len(terrain)
+        if count:
+            self.status_bar.config(text=f"Reloaded {count} change(s) from {STATE_FILE}.")
+
+    def merge_schedule_file(self, base, disk):
+        base = base or {}
+        applied = 0
+        for field in SCHEDULE_SYNC_FIELDS:
+            local = getattr(self, field)
+            take, clashes = merge_changes(base.get(field, {}), disk.get(field, {}), json.loads(json.dumps(local)))
+            if clashes and not self.resolve_conflicts(WEEKLY_SCHEDULE_FILE, [f"{field}: {name}" for name in clashes]):
+                take.update({name: disk.get(field, {}).get(name, MISSING) for name in clashes})
+            for name, value in take.items():
+                if value is MISSING:
+                    local.pop(name, None)
+                else:
+                    local[name] = value
+            applied += len(take)
+        if applied:
+            try:
+                self.update_schedule_display()
+            except (AttributeError, tk.TclError):
+                pass  # The schedule window is not open.
+            self.status_bar.config(text=f"Reloaded {applied} change(s) from {WEEKLY_SCHEDULE_FILE}.")
+
+    def merge_members_file(self, base, disk):
+        if not isinstance(disk, list):
+            return
+        local = members_by_id(json.loads(json.dumps(self.alliance_members.to_list())))
+        take, clashes = merge_changes(members_by_id(base or []), members_by_id(disk), local)
+        if clashes:
+            names = [str(local.get(key, {}).get("Name", key)) for key in clashes]
+            if not self.resolve_conflicts(ALLIANCE_MEMBERS_FILE, names):
+                disk_members = members_by_id(disk)
+                take.update({key: disk_members.get(key, MISSING) for key in clashes})
+        problems = []
+        with self.alliance_members.batch():
+            for key, member in take.items():
+                try:
+                    if member is MISSING:
+                        if self.alliance_members.get(key) is not None:
+                            self.alliance_members.remove(key)
+                    elif self.alliance_members.get(member.get("Id")) is not None:
+                        changes = {name: value for name, value in member.items() if name != "Id"}
+                        self.alliance_members.update(member["Id"], **changes)
+                    else:
+                        self.alliance_members.add(member, keep_id=True)
+                except ValueError as e:
+                    problems.append(f"{member.get('Name', key) if member is not MISSING else key}: {e}")
+        if problems:
+            messagebox.showwarning("Alliance Members", "Some changes from the file were skipped:\n" + "\n".join(problems))
+        if take:
+            self.status_bar.config(text=f"Reloaded {len(take)} change(s) from {ALLIANCE_MEMBERS_FILE}.")
+
+    # ------------------------------
+    # Copy, Paste and Formation Stamps
+    # ------------------------------
+    def copy_selection(self, event=None):
+        if event is not None and isinstance(event.widget, tk.Entry):
+            return
+        formation = copy_formation(self.model, self.selected_objects)
+        if formation is None:
+            self.status_bar.config(text="Nothing selected to copy.")
+            return
+        self.clipboard = formation
+        self.status_bar.config(text=f"Copied {len(formation['objects'])} object(s) and {len(formation['markers'])} marker(s).")
+
+    def cut_selection(self, event=None):
+        if event is not None and isinstance(event.widget, tk.Entry):
+            return
+        keys = [key for key in self.selected_objects if key in self.placed_objects]
+        formation = copy_formation(self.model, keys)
+        if formation is None:
+            return
+        self.clipboard = formation
+        self.model.apply_edit({key: None for key in keys}, label="Cut")
+        self.status_bar.config(text=f"Cut {len(keys)} item(s). Ctrl+V to paste.")
+
+    def start_paste(self, event=None):
+        if event is not None and isinstance(event.widget, tk.Entry):
+            return
+        if self.clipboard is None:
+            self.status_bar.config(text="The clipboard is empty.")
+            return
+        self.activate_stamp("Clipboard", self.clipboard)
 
+    def activate_stamp(self, name, formation):
+        """Turns the cursor into a preview of the formation; a left click pastes it there."""
+        self.selected_tool = {"type": "stamp", "tag": name, "formation": formation}
+        self.canvas.delete("shadow")
+        self.ghost_anchor = None
+        self.status_bar.config(text=f"Tool: Paste {name} (Esc to cancel)")
 
-    def place_element(self, event):
-        if not self.selected_tool:
+    def paste_formation(self, formation, x, y, name):
+        changes, blocked = plan_formation(self.model, self.occupancy, formation, x, y)
+        if blocked:
+            self.status_bar.config(text=f"Cannot paste here: {len(blocked)} object(s) would overlap or leave the grid.")
             return
-        adjusted_cell_size = CELL_SIZE * self.zoom_factor
-        x = int((self.canvas.canvasx(event.x) - self.pan_x) / adjusted_cell_size)
-        y = GRID_SIZE - int((self.canvas.canvasy(event.y) - self.pan_y) / adjusted_cell_size) - 1
-        if not (0 <= x < GRID_SIZE and 0 <= y < GRID_SIZE):
+        self.model.apply_edit(changes, label=f"Paste {name}")
+        self.model.select(key for key, data in changes.items() if data is not None)
+        self.status_bar.config(text=f"Pasted {name}. Ctrl+Z to undo.")
+
+    def update_stamp_ghost(self, event):
+        """Previews the formation under the cursor, red where it can't go. The outlines are drawn
+        once and then moved as a group while the cursor moves."""
+        formation = self.selected_tool["formation"]
+        x, y = self.event_cell(event)
+        view = (self.model.cell_px, self.pan_x, self.pan_y)
+        if self.ghost_anchor is not None and self.ghost_anchor[0] == (x, y):
             return
+        if self.ghost_anchor is not None and self.ghost_anchor[1] == view and self.canvas.find_withtag("shadow"):
+            (old_x, old_y), _ = self.ghost_anchor
+            cell_px = self.model.cell_px
+            self.canvas.move("shadow", (x - old_x) * cell_px, (old_y - y) * cell_px)
+        else:
+            self.canvas.delete("shadow")
+            for dx, dy, data in formation["objects"]:
+                c_x1, c_y1, c_x2, c_y2 = self.model.object_canvas_rect((x + dx, y + dy), data)
+                self.canvas.create_rectangle(c_x1, c_y1, c_x2, c_y2, fill=data.get("color", "gray"),
+                                             outline="black", stipple="gray50", tags=("shadow", "ghost_object"))
+            for _, (x1, y1, x2, y2), data in formation["markers"]:
+                c_x1, c_y1, c_x2, c_y2 = self.model.bbox_canvas_rect((x1 + x, y1 + y, x2 + x, y2 + y))
+                self.canvas.create_rectangle(c_x1, c_y1, c_x2, c_y2, outline=data.get("color", "gray"),
+                                             width=2, dash=(4, 2), tags="shadow")
+        self.ghost_anchor = ((x, y), view)
+        _, blocked = plan_formation(self.model, self.occupancy, formation, x, y)
+        self.canvas.itemconfig("ghost_object", outline="red" if blocked else "black", width=2 if blocked else 1)
+
+    def load_formation_stamps(self):
+        if os.path.exists(FORMATION_STAMPS_FILE):
+            try:
+                with open(FORMATION_STAMPS_FILE, "r") as f:
+                    return json.load(f)
+            except Exception as e:
+                print("Error loading formation stamps:", e)
+        return {}
 
-        if self.selected_tool["type"] == "delete":
-            for center, data in list(self.placed_objects.items()):
-                obj_size = data.get("size", (3, 3))
-                w, h = obj_size
-                cx, cy = center
-                x_start = cx - w // 2
-                y_start = cy - h // 2
-                if x_start <= x < x_start + w and y_start <= y < y_start + h:
-                    del self.placed_objects[center]
-                    self.draw_grid()
-                    return
+    def save_formation_stamps(self):
+        try:
+            write_json_file(FORMATION_STAMPS_FILE, self.formation_stamps)
+        except OSError as e:
+            messagebox.showerror("Error", f"Could not save formation stamps: {e}")
+
+    def save_selection_as_stamp(self):
+        formation = copy_formation(self.model, self.selected_objects)
+        if formation is None:
+            messagebox.showerror("Error", "Select the objects of the formation first.")
+            return
+        name = simpledialog.askstring("Save Stamp", "Name of this formation:", parent=self.root)
+        if not name:
             return
+        if name in self.formation_stamps and not messagebox.askyesno("Save Stamp", f"Replace the stamp '{name}'?"):
+            return
+        self.formation_stamps[name] = formation
+        self.save_formation_stamps()
+        self.update_stamps_submenu()
+
+    def delete_stamp(self, name):
+        if messagebox.askyesno("Delete Stamp", f"Delete the stamp '{name}'?"):
+            self.formation_stamps.pop(name, None)
+            self.save_formation_stamps()
+            self.update_stamps_submenu()
+
+    def update_stamps_submenu(self):
+        self.stamps_submenu.delete(0, tk.END)
+        if not self.formation_stamps:
+            self.stamps_submenu.add_command(label="(none saved)", state=tk.DISABLED)
+            return
+        delete_menu = tk.Menu(self.stamps_submenu, tearoff=0)
+        for name in sorted(self.formation_stamps, key=str.casefold):
+            self.stamps_submenu.add_command(
+                label=name, command=lambda n=name: self.activate_stamp(n, self.formation_stamps[n]))
+            delete_menu.add_command(label=name, command=lambda n=name: self.delete_stamp(n))
+        self.stamps_submenu.add_separator()
+        self.stamps_submenu.add_cascade(label="Delete", menu=delete_menu)
 
-        elif self.selected_tool["type"] == "terrain":
-            self.terrain_cells[(x, y)] = self.selected_tool["terrain"]
+    # ------------------------------
+    # Minimap
+    # ------------------------------
+    def create_minimap(self):
+        """Overview of the whole map in the bottom-left corner of the canvas; click or drag on it to move the view."""
+        terrain_colors = {}
+        for name, texture in self.original_textures.items():
+            r, g, b = texture.convert("RGB").resize((1, 1), Image.Resampling.BOX).getpixel((0, 0))
+            terrain_colors[name] = f"#{r:02x}{g:02x}{b:02x}"
+        self.minimap = MinimapRaster(self.model, terrain_colors=terrain_colors)
+        self.minimap_dirty = set()
+        self.minimap_full_refresh = False
+        self.minimap_flush_pending = None
+        size = self.minimap.size
+        self.minimap_canvas = tk.Canvas(self.root, width=size, height=size, bg="white", cursor="crosshair",
+                                        highlightthickness=1, highlightbackground="gray")
+        self.minimap_photo = ImageTk.PhotoImage(self.minimap.image)
+        self.minimap_image_item = self.minimap_canvas.create_image(0, 0, image=self.minimap_photo, anchor="nw")
+        self.minimap_view_item = self.minimap_canvas.create_rectangle(0, 0, 0, 0, outline="red", width=2)
+        self.minimap_canvas.bind("<Button-1>", self.minimap_jump)
+        self.minimap_canvas.bind("<B1-Motion>", self.minimap_jump)
+        self.canvas.bind("<Configure>", lambda event: self.update_minimap_viewport(), add="+")
+        self.show_minimap()
+
+    def show_minimap(self):
+        self.minimap_canvas.place(in_=self.canvas, relx=0.0, rely=1.0, anchor="sw", x=5, y=-5)
+        self.minimap_full_refresh = True
+        self.flush_minimap()
+        self.update_minimap_viewport()
+
+    def toggle_minimap(self):
+        if self.minimap_var.get():
+            self.show_minimap()
+        else:
+            self.minimap_canvas.place_forget()
+
+    def request_minimap_flush(self):
+        if self.minimap_flush_pending is None:
+            self.minimap_flush_pending = self.root.after_idle(self.flush_minimap)
+
+    def flush_minimap(self):
+        """Copies the changed pixels of the minimap raster into its Tk image."""
+        self.minimap_flush_pending = None
+        if not self.minimap_var.get():
+            return   # Picked up by show_minimap's full refresh.
+        if self.minimap_full_refresh or len(self.minimap_dirty) > 4096:
+            self.minimap_photo.paste(self.minimap.image)
+        else:
+            photo_name = str(self.minimap_photo)
+            image = self.minimap.image
+            for pixel in self.minimap_dirty:
+                r, g, b = image.getpixel(pixel)
+                self.root.tk.call(photo_name, "put", f"#{r:02x}{g:02x}{b:02x}", "-to", pixel[0], pixel[1])
+        self.minimap_dirty.clear()
+        self.minimap_full_refresh = False
+
+    def update_minimap_viewport(self):
+        if not hasattr(self, "minimap_canvas"):
+            return
+        self.minimap_canvas.coords(self.minimap_view_item,
+                                   *self.minimap.viewport(self.canvas.winfo_width(), self.canvas.winfo_height()))
 
-        elif self.selected_tool["type"] == "object":
-            # If this is a unique object (for alliance members, for example), remove any previous instance.
-            if self.selected_tool.get("unique", False):
-                for center, data in list(self.placed_objects.items()):
-                    # Compare tags—ensure the tag is set uniquely for alliance member objects.
-                    if data.get("tag") == self.selected_tool.get("tag"):
-                        del self.placed_objects[center]
-                        break
+    def minimap_jump(self, event):
+        x, y = self.minimap.cell_at(event.x, event.y)
+        self.model.center_on(x, y, self.canvas.winfo_width(), self.canvas.winfo_height())
 
-            obj_size = self.selected_tool.get("size", (3, 3))
-            w, h = obj_size
-            # Check for collision with any other object.
-            for (obj_x, obj_y), existing_obj in self.placed_objects.items():
-                if abs(obj_x - x) < w and abs(obj_y - y) < h:
-                    print("Cannot place object: Space occupied!")
-                    return
+    # ------------------------------
+    # Map Image Export
+    # ------------------------------
+    def save_map_image(self):
+        """Saves the whole map, or a region of it, as a PNG for posting in alliance chat."""
+        cell_px = simpledialog.askinteger("Export Map Image", f"Pixels per cell (1-{MAX_EXPORT_CELL_PX}):",
+                                          initialvalue=10, minvalue=1, maxvalue=MAX_EXPORT_CELL_PX, parent=self.root)
+        if cell_px is None:
+            return
+        region_text = simpledialog.askstring("Export Map Image",
+                                             "Region as x1,y1,x2,y2 (leave empty for the whole map):", parent=self.root)
+        if region_text is None:
+            return
+        region = None
+        if region_text.strip():
+            try:
+                region = tuple(int(v) for v in region_text.split(","))
+                if len(region) != 4:
+                    raise ValueError
+            except ValueError:
+                messagebox.showerror("Error", "Region must be four numbers: x1,y1,x2,y2.")
+                return
+        path = filedialog.asksaveasfilename(title="Export Map Image", defaultextension=".png",
+                                            initialfile="alliance_map.png", filetypes=[("PNG", "*.png")])
+        if not path:
+            return
 
-            # Place the object at the clicked cell.
-            self.placed_objects[(x, y)] = {
-                "tag": self.selected_tool["tag"],
-                "color": self.selected_tool["color"],
-                "size": obj_size,
-                "avatar": self.selected_tool.get("avatar")
-            }
+        def progress(done, total):
+            self.status_bar.config(text=f"Exporting map image... {done * 100 // total}%")
+            self.root.update_idletasks()
 
-        self.draw_grid()
-        self.canvas.delete("shadow")
+        self.root.config(cursor="watch")
+        try:
+            width, height = export_map_image(self.model, path, cell_px, region, grid_style=self.grid_style(),
+                                             thumbnail_cache=self.thumbnail_cache, progress=progress)
+        except (ValueError, OSError) as e:
+            messagebox.showerror("Error", f"Could not export the map: {e}")
+            return
+        finally:
+            self.root.config(cursor="")
+            self.status_bar.config(text="Tool: None")
+        messagebox.showinfo("Export Map Image", f"Saved {width}x{height} image to {path}.")
 
-    def update_alliance_members_submenu(self):
-        self.custom_alliance_submenu.delete(0, tk.END)
-        rank_list = ["R1", "R2", "R3", "R4", "R5"]
-        self.alliance_member_submenus = {}
-        for rank in rank_list:
-            submenu = tk.Menu(self.custom_alliance_submenu, tearoff=0)
-            self.custom_alliance_submenu.add_cascade(label=rank, menu=submenu)
-            self.alliance_member_submenus[rank] = submenu
-        for member in self.alliance_members:
-            rank = member.get("Rank", "R1")
-            name = member.get("Name", "Unnamed")
-            if member.get("Avatar") and os.path.exists(member["Avatar"]):
-                try:
-                    avatar_img = Image.open(member["Avatar"])
-                    avatar_img = avatar_img.resize((16, 16), Image.Resampling.LANCZOS)
-                    avatar_photo = ImageTk.PhotoImage(avatar_img)
-                except Exception:
-                    avatar_photo = None
-            else:
-                avatar_photo = None
-            if avatar_photo is None:
-                default_color = self.alliance_default_colors.get(rank, "#000000")
-                from PIL import Image as PILImage
-                img = PILImage.new("RGB", (16, 16), default_color)
-                avatar_photo = ImageTk.PhotoImage(img)
-            submenu = self.alliance_member_submenus.get(rank)
-            if submenu:
-                submenu.add_command(
-                    label=name,
-                    image=avatar_photo,
-                    compound="left",
-                    command=lambda m=member: self.activate_preset_object(
-                        m.get("Name", "Unnamed"),
-                        self.alliance_default_colors.get(m.get("Rank", "R1"), "#000000"),
-                        m.get("Size", (3, 3)),
-                        unique=True,
-                        avatar=m.get("Avatar")
-                    )
-                )
-                if not hasattr(self, "alliance_member_images"):
-                    self.alliance_member_images = []
-                self.alliance_member_images.append(avatar_photo)
-                
-    def draw_grid(self):
-        # Clear the entire canvas.
-        self.canvas.delete("all")
-        
-        # Redraw terrain (unchanged)
-        self.redraw_terrain()
-        
-        # Draw grid lines.
-        adjusted_cell_size = CELL_SIZE * self.zoom_factor
-        for i in range(GRID_SIZE + 1):
-            x = i * adjusted_cell_size + self.pan_x
-            y = (GRID_SIZE - i) * adjusted_cell_size + self.pan_y
-            if i % 9 == 0:
-                line_color = self.blend_color(self.major_grid_color, self.major_opacity)
-                self.canvas.create_line(x, self.pan_y, x, GRID_SIZE * adjusted_cell_size + self.pan_y, fill=line_color, tags="grid")
-                self.canvas.create_line(self.pan_x, y, GRID_SIZE * adjusted_cell_size + self.pan_x, y, fill=line_color, tags="grid")
-            else:
-                if adjusted_cell_size >= self.grid_zoom_threshold:
-                    line_color = self.blend_color(self.minor_grid_color, self.minor_opacity)
-                    self.canvas.create_line(x, self.pan_y, x, GRID_SIZE * adjusted_cell_size + self.pan_y, fill=line_color, tags="grid")
-                    self.canvas.create_line(self.pan_x, y, GRID_SIZE * adjusted_cell_size + self.pan_x, y, fill=line_color, tags="grid")
-        
-        # Draw both normal objects and markers in one unified call.
-        self.redraw_objects()
+    # ------------------------------
+    # Interaction Record / Replay
+    # ------------------------------
+    def toggle_recording(self):
+        if self.recorder.recording:
+            count = self.recorder.stop()
+            self.status_bar.config(text=f"Recorded {count} events")
+            return
+        path = filedialog.asksaveasfilename(title="Record Interaction To", defaultextension=".jsonl",
+                                            initialfile="session.jsonl", filetypes=[("Session", "*.jsonl")])
+        if not path:
+            self.record_var.set(False)
+            return
+        try:
+            self.recorder.start(path)
+        except OSError as e:
+            self.record_var.set(False)
+            messagebox.showerror("Error", f"Could not start recording: {e}")
+            return
+        self.status_bar.config(text="Recording interaction...")
 
+    def replay_interaction(self):
+        if self.recorder.recording:
+            messagebox.showerror("Error", "Stop recording before replaying a session.")
+            return
+        path = filedialog.askopenfilename(title="Replay Interaction", filetypes=[("Session", "*.jsonl")])
+        if not path:
+            return
+        original = messagebox.askyesno("Replay Interaction", "Replay at the original speed?\n"
+                                       "(No replays as fast as possible.)")
+        # The session starts from its own recorded map; the current one is put back afterwards.
+        saved_state = json.loads(json.dumps(self.model.to_state()))
+        try:
+            report = InteractionReplayer(self.root, self.canvas, self.model).replay(
+                path, speed="original" if original else "max")
+        except (OSError, ValueError, KeyError) as e:
+            messagebox.showerror("Error", f"Could not replay session: {e}")
+            return
+        finally:
+            self.model.load_state(saved_state)
+        latency = report["latency_ms"]
+        lines = [
+            f"Events: {report['events']} in {report['wall_time']:.2f} s",
+            f"Latency: mean {latency.get('mean', 0):.1f} ms, p95 {latency.get('p95', 0):.1f} ms, max {latency.get('max', 0):.1f} ms",
+            f"Final map hash: {report['hash'][:12]}",
+            "Matches the recording." if report["hash_matches"] else "Does NOT match the recording!",
+        ]
+        if not report["canvas_size_matches"]:
+            lines.append("The canvas size differs from the recording, so clicks may land elsewhere.")
+        messagebox.showinfo("Replay Interaction", "\n".join(lines))
+
+    def marker_corner_at(self, canvas_x, canvas_y, tolerance=8):
+        """Key of the marker whose bottom-right corner is under a canvas point, or None."""
+        for key in self.model.markers_near_canvas(canvas_x, canvas_y, tolerance):
+            c_x1, c_y1, c_x2, c_y2 = self.model.bbox_canvas_rect(self.placed_objects[key]["bbox"])
+            if abs(canvas_x - max(c_x1, c_x2)) < tolerance and abs(canvas_y - max(c_y1, c_y2)) < tolerance:
+                return key
+        return None
 
     def on_marker_press(self, event):
-        items = self.canvas.find_withtag("marker")
-        for item in items:
-            coords = self.canvas.coords(item)  # [x1, y1, x2, y2]
-            if coords and coords[0] <= event.x <= coords[2] and coords[1] <= event.y <= coords[3]:
-                self.current_marker_id = None
-                for key, marker in self.markers.items():
-                    adjusted = CELL_SIZE * self.zoom_factor
-                    mx1 = marker["x1"] * adjusted + self.pan_x
-                    my1 = (GRID_SIZE - marker["y1"]) * adjusted + self.pan_y
-                    mx2 = marker["x2"] * adjusted + self.pan_x
-                    my2 = (GRID_SIZE - marker["y2"]) * adjusted + self.pan_y
-                    if abs(mx1 - coords[0]) < 5 and abs(my1 - coords[1]) < 5 and abs(mx2 - coords[2]) < 5 and abs(my2 - coords[3]) < 5:
-                        self.current_marker_id = key
-                        break
-                self.marker_move_start = (event.x, event.y)
-                if self.current_marker_id is not None:
-                    marker = self.markers[self.current_marker_id]
-                    x2 = marker["x2"] * adjusted + self.pan_x
-                    y2 = (GRID_SIZE - marker["y2"]) * adjusted + self.pan_y
-                    if abs(event.x - x2) < 10 and abs(event.y - y2) < 10:
-                        self.marker_resizing = True
-                    else:
-                        self.marker_resizing = False
-                # Prevent further propagation so that on_left_button_press doesn't run:
-                return "break"
+        """Starts resizing when the press is on a marker's bottom-right corner."""
+        x, y = self.canvas.canvasx(event.x), self.canvas.canvasy(event.y)
+        key = self.marker_corner_at(x, y)
+        if key is None:
+            return False
+        self.current_marker_id = key
+        self.marker_move_start = (x, y)
+        self.marker_resize_bbox = tuple(self.placed_objects[key]["bbox"])
+        self.marker_resizing = True
+        self.model.select([key])
+        return True
 
     def on_marker_motion(self, event):
-        if self.current_marker_id is None:
-            return
-        # A movement indicates dragging.
-        self.marker_dragging = True
-        dx = event.x - self.marker_move_start[0]
-        dy = event.y - self.marker_move_start[1]
-        adjusted = CELL_SIZE * self.zoom_factor
-        marker = self.markers[self.current_marker_id]
-        # Convert the pixel delta to grid units.
-        grid_dx = dx / adjusted
-        grid_dy = dy / adjusted
-        if self.marker_resizing:
-            # Resize the marker (update bottom-right corner).
-            marker["x2"] += grid_dx
-            marker["y2"] -= grid_dy  # Remember: grid y increases upward.
+        if self.current_marker_id not in self.placed_objects:
+            return
+        # Offsets are measured from the press point, in grid units; grid y increases upward.
+        grid_dx = (self.canvas.canvasx(event.x) - self.marker_move_start[0]) / self.model.cell_px
+        grid_dy = (self.canvas.canvasy(event.y) - self.marker_move_start[1]) / self.model.cell_px
+        x1, y1, x2, y2 = self.marker_resize_bbox
+        # Move whichever corner is the bottom-right one on screen.
+        if x2 >= x1:
+            x2 += grid_dx
         else:
-            # Move the entire marker.
-            marker["x1"] += grid_dx
-            marker["y1"] -= grid_dy
-            marker["x2"] += grid_dx
-            marker["y2"] -= grid_dy
-        self.marker_move_start = (event.x, event.y)
-        self.draw_markers()
-
+            x1 += grid_dx
+        if y2 <= y1:
+            y2 -= grid_dy
+        else:
+            y1 -= grid_dy
+        self.model.update_object(self.current_marker_id, bbox=(x1, y1, x2, y2))
 
+    def on_marker_release(self, event):
+        self.current_marker_id = None
+        self.marker_move_start = None
+        self.marker_resize_bbox = None
+        self.marker_resizing = False
 
     def redraw_terrain(self):
         self.canvas.delete("terrain")
-        adjusted_cell_size = CELL_SIZE * self.zoom_factor
-        mud_width = (552 - 448) * adjusted_cell_size
-        mud_height = (550 - 446) * adjusted_cell_size
-        dark_mud_width = (510 - 489) * adjusted_cell_size
-        dark_mud_height = (508 - 486) * adjusted_cell_size
-        mud_texture = self.original_textures["mud"].resize((int(mud_width), int(mud_height)), Image.Resampling.LANCZOS)
-        dark_mud_texture = self.original_textures["dark_mud"].resize((int(dark_mud_width), int(dark_mud_height)), Image.Resampling.LANCZOS)
-        self.textures["mud"] = ImageTk.PhotoImage(mud_texture)
-        self.textures["dark_mud"] = ImageTk.PhotoImage(dark_mud_texture)
-        mud_x = 448 * adjusted_cell_size + self.pan_x
-        mud_y = (GRID_SIZE - 550) * adjusted_cell_size + self.pan_y
-        dark_mud_x = 489 * adjusted_cell_size + self.pan_x
-        dark_mud_y = (GRID_SIZE - 508) * adjusted_cell_size + self.pan_y
-        self.canvas.create_image(mud_x, mud_y, image=self.textures["mud"], anchor="nw", tags="terrain")
-        self.canvas.create_image(dark_mud_x, dark_mud_y, image=self.textures["dark_mud"], anchor="nw", tags="terrain")
+        adjusted_cell_size = self.model.cell_px
+        self.textures = []
+        for zone in self.model.zones:
+            if zone["terrain"] not in self.original_textures:
+                continue
+            x1, y1, x2, y2 = zone["rect"]
+            texture = self.scaled_texture(zone["terrain"], (x2 - x1) * adjusted_cell_size, (y2 - y1) * adjusted_cell_size)
+            self.textures.append(texture)
+            x, y = self.model.corner_to_canvas(x1, y2)
+            self.canvas.create_image(x, y, image=texture, anchor="nw", tags="terrain")
 
     def get_item_at(self, event):
         """
         Returns the key of the placed_objects entry under the mouse, or None if none.
         This single function checks both normal objects (center-based) and markers (bbox-based).
         """
-        adjusted_cell_size = CELL_SIZE * self.zoom_factor
-        canvas_x = self.canvas.canvasx(event.x)
-        canvas_y = self.canvas.canvasy(event.y)
-
-        for key, data in self.placed_objects.items():
-            if data.get("is_marker"):
-                # This is a marker, stored as a bounding box (x1, y1, x2, y2) in the grid.
-                x1, y1, x2, y2 = data["bbox"]
-                # Convert marker’s bounding box from grid coords to canvas coords.
-                c_x1 = x1 * adjusted_cell_size + self.pan_x
-                c_y1 = (GRID_SIZE - y1) * adjusted_cell_size + self.pan_y
-                c_x2 = x2 * adjusted_cell_size + self.pan_x
-                c_y2 = (GRID_SIZE - y2) * adjusted_cell_size + self.pan_y
-                # Check if mouse is within these canvas coords.
-                if c_x1 <= canvas_x <= c_x2 and c_y1 <= canvas_y <= c_y2:
-                    return key
-            else:
-                # This is a normal object, stored with a center (x, y) in the key and a size in data.
-                (obj_x, obj_y) = key  # The grid center
-                w, h = data.get("size", (3, 3))
-                # Compute the bounding box in grid coords
-                x_start = obj_x - w // 2
-                y_start = obj_y - h // 2
-                # Convert to canvas coords
-                c_x1 = x_start * adjusted_cell_size + self.pan_x
-                c_y1 = (GRID_SIZE - (y_start + h)) * adjusted_cell_size + self.pan_y
-                c_x2 = c_x1 + w * adjusted_cell_size
-                c_y2 = c_y1 + h * adjusted_cell_size
-                if c_x1 <= canvas_x <= c_x2 and c_y1 <= canvas_y <= c_y2:
-                    return key
-
-        return None  # No item found under the mouse
+        key = self.model.item_at_canvas(self.canvas.canvasx(event.x), self.canvas.canvasy(event.y))
+        if key is not None and not self.layer_visible[self.object_layer(self.placed_objects[key])]:
+            return None
+        return key
 
     def update_shadow(self, event):
         if self.selected_tool is None or "type" not in self.selected_tool:
             self.canvas.delete("shadow")
             return
+        if self.selected_tool["type"] == "stamp":
+            self.update_stamp_ghost(event)
+            return
         if self.selected_tool["type"] != "object":
             self.canvas.delete("shadow")
             return
-        adjusted_cell_size = CELL_SIZE * self.zoom_factor
-        x = int((self.canvas.canvasx(event.x) - self.pan_x) / adjusted_cell_size)
-        y = GRID_SIZE - int((self.canvas.canvasy(event.y) - self.pan_y) / adjusted_cell_size) - 1
-        if not (0 <= x < GRID_SIZE and 0 <= y < GRID_SIZE):
+        adjusted_cell_size = self.model.cell_px
+        x, y = self.event_cell(event)
+        if not self.model.in_bounds(x, y):
             self.canvas.delete("shadow")
             return
         obj_size = self.selected_tool.get("size", (3, 3))
         w, h = obj_size
-        x_start = x - w // 2
-        y_start = y - h // 2
-        x_pos = x_start * adjusted_cell_size + self.pan_x
-        y_pos = (GRID_SIZE - (y_start + h)) * adjusted_cell_size + self.pan_y
+        x_pos, y_pos, _, _ = self.model.object_canvas_rect((x, y), {"size": obj_size})
         self.canvas.delete("shadow")
         self.canvas.create_rectangle(
             x_pos, y_pos, x_pos + w * adjusted_cell_size, y_pos + h * adjusted_cell_size,
             fill=self.selected_tool["color"], outline="black", stipple="gray50", tags="shadow"
         )
-        self.canvas.create_text(
-            x_pos + (w * adjusted_cell_size) / 2, y_pos + (h * adjusted_cell_size) / 2,
-            text=self.selected_tool["tag"], fill="black", font=("Arial", int(adjusted_cell_size / 3)), tags="shadow"
-        )
+        label_size = self.label_fonts.size_for(adjusted_cell_size)
+        if label_size:
+            text = self.label_fonts.fit(self.selected_tool["tag"], label_size,
+                                        w * adjusted_cell_size - 2, h * adjusted_cell_size)
+            if text:
+                self.canvas.create_text(
+                    x_pos + (w * adjusted_cell_size) / 2, y_pos + (h * adjusted_cell_size) / 2,
+                    text=text, fill="black", font=self.label_fonts.font(label_size), tags="shadow"
+                )
 
     def add_custom_object(self):
         tag = simpledialog.askstring("Custom Object", "Enter object tag:")
@@ -639,7 +4555,7 @@ class GridApp:
         for tag, data in self.custom_objects.items():
             self.custom_submenu.add_command(
                 label=tag,
-                command=lambda t=tag, d=data: self.activate_preset_object(t, d["color"], d["size"])
+                command=lambda t=tag, d=data: self.activate_preset_object(t, d["color"], d["size"], category="custom")
             )
 
     def edit_object_properties(self, old_name, category, current_color):
@@ -729,51 +4645,33 @@ class GridApp:
         tk.Button(win, text="Add Object", command=save_new).grid(row=2, column=0, columnspan=3, pady=10)
         win.wait_window(win)
 
-        def save_properties():
-            new_tag = tag_entry.get().strip()
-            new_color = color_display.cget("text")
-            if not new_tag:
-                messagebox.showerror("Error", "Name cannot be empty.")
-                return
-            # Update the object properties
-            self.placed_objects[obj_center]["tag"] = new_tag
-            self.placed_objects[obj_center]["color"] = new_color
-            self.draw_grid()  # Redraw grid to update the object
-            win.destroy()
-        
-        tk.Button(win, text="Save", command=save_properties).grid(row=2, column=0, columnspan=3, pady=10)
-
     def update_friendly_submenu(self):
         self.friendly_submenu.delete(0, tk.END)
         for name, color in self.friendly_objects.items():
-            self.friendly_submenu.add_command(label=name, command=lambda n=name, c=color: self.activate_preset_object(n, c))
+            self.friendly_submenu.add_command(
+                label=name, command=lambda n=name, c=color: self.activate_preset_object(n, c, category="friendly"))
 
     def update_enemy_submenu(self):
         self.enemy_submenu.delete(0, tk.END)
         for name, color in self.enemy_objects.items():
-            self.enemy_submenu.add_command(label=name, command=lambda n=name, c=color: self.activate_preset_object(n, c))
+            self.enemy_submenu.add_command(
+                label=name, command=lambda n=name, c=color: self.activate_preset_object(n, c, category="enemy"))
 
     def update_other_submenu(self):
         self.other_submenu.delete(0, tk.END)
         for name, color in self.other_objects.items():
-            self.other_submenu.add_command(label=name, command=lambda n=name, c=color: self.activate_preset_object(n, c))
+            self.other_submenu.add_command(
+                label=name, command=lambda n=name, c=color: self.activate_preset_object(n, c, category="other"))
 
 
 
     def edit_object_text(self, event):
-        adjusted_cell_size = CELL_SIZE * self.zoom_factor
-        x = int((self.canvas.canvasx(event.x) - self.pan_x) / adjusted_cell_size)
-        y = GRID_SIZE - int((self.canvas.canvasy(event.y) - self.pan_y) / adjusted_cell_size) - 1
+        x, y = self.event_cell(event)
         if (x, y) in self.placed_objects:
             current_text = self.placed_objects[(x, y)]["tag"]
             new_text = simpledialog.askstring("Edit Object", "Enter new text:", initialvalue=current_text)
             if new_text is not None:
-                self.placed_objects[(x, y)]["tag"] = new_text
-                self.draw_grid()
-
-    def deselect_tool(self, event=None):
-        self.selected_tool = None
-        self.status_bar.config(text="Tool: None")
+                self.model.update_object((x, y), tag=new_text)
 
     def show_object_context_menu(self, event, obj_center):
         """Opens a context menu for a placed object with options to edit, change type, or delete it."""
@@ -782,9 +4680,7 @@ class GridApp:
         tk.Label(context_win, text="Select an action:").pack(padx=10, pady=10)
         
         def delete_object():
-            if obj_center in self.placed_objects:
-                del self.placed_objects[obj_center]
-                self.draw_grid()
+            self.model.remove_object(obj_center)
             context_win.destroy()
                 
         def edit_properties():
@@ -845,13 +4741,10 @@ class GridApp:
                 return
             # Use a key like ("marker", name) and store a bounding box.
             key = ("marker", name)
-            self.placed_objects[key] = {
-                "is_marker": True,
-                "tag": name,
-                "color": color,    # This must be a valid hex color.
-                "bbox": (x1, y1, x2, y2)
-            }
-            self.draw_grid()
+            if key in self.placed_objects:
+                messagebox.showerror("Error", f"A marker named '{name}' already exists.")
+                return
+            self.model.place_object(key, marker_data(name, (x1, y1, x2, y2), color or "red"))
             win.destroy()
         
         tk.Button(win, text="Save Marker", command=save_marker).grid(row=6, column=0, columnspan=3, pady=10)
@@ -914,17 +4807,16 @@ class GridApp:
             new_color = color_label.cget("text")
             if not new_name:
                 new_name = marker["tag"]
+            new_key = ("marker", new_name)
+            if new_key != marker_key and new_key in self.placed_objects:
+                messagebox.showerror("Error", f"A marker named '{new_name}' already exists.")
+                return
             # Update marker data.
-            marker["tag"] = new_name
-            marker["color"] = new_color
-            marker["bbox"] = (new_x1, new_y1, new_x2, new_y2)
+            self.model.update_object(marker_key, tag=new_name, color=new_color,
+                                     bbox=(new_x1, new_y1, new_x2, new_y2))
             # If the marker name changed, update the key in placed_objects.
-            old_key = marker_key
-            new_key = ("marker", new_name)
-            if new_key != old_key:
-                del self.placed_objects[old_key]
-                self.placed_objects[new_key] = marker
-            self.draw_grid()
+            if new_key != marker_key:
+                self.model.rekey_object(marker_key, new_key)
             win.destroy()
         
         tk.Button(win, text="Save", command=save_changes).grid(row=6, column=0, columnspan=3, pady=10)
@@ -979,8 +4871,7 @@ class GridApp:
                 marker_name = marker_listbox.get(sel[0])
                 key = ("marker", marker_name)
                 if key in self.placed_objects:
-                    del self.placed_objects[key]
-                    self.draw_grid()
+                    self.model.remove_object(key)
                     win.destroy()
         tk.Button(win, text="Remove Selected Marker", command=delete_marker).pack(pady=5)
         win.wait_window(win)
@@ -1013,28 +4904,12 @@ class GridApp:
         if self.marker_draw_rect is None:
             return
         
-        # Current mouse position in canvas coords
-        current_x = self.canvas.canvasx(event.x)
-        current_y = self.canvas.canvasy(event.y)
-        
-        # Convert both 'start' and 'current' canvas coords -> snapped grid coords
-        adjusted = CELL_SIZE * self.zoom_factor
-        
-        # Convert the start point
-        start_cx, start_cy = self.marker_draw_start
-        start_grid_x = int(round((start_cx - self.pan_x) / adjusted))
-        start_grid_y = int(round(GRID_SIZE - (start_cy - self.pan_y) / adjusted - 1))
-
-        # Convert the current drag point
-        current_grid_x = int(round((current_x - self.pan_x) / adjusted))
-        current_grid_y = int(round(GRID_SIZE - (current_y - self.pan_y) / adjusted - 1))
-        
-        # Now convert those grid coords back to canvas coords, so the rectangle
-        # is drawn exactly on integer cell boundaries.
-        c_x1 = start_grid_x * adjusted + self.pan_x
-        c_y1 = (GRID_SIZE - start_grid_y) * adjusted + self.pan_y
-        c_x2 = current_grid_x * adjusted + self.pan_x
-        c_y2 = (GRID_SIZE - current_grid_y) * adjusted + self.pan_y
+        # Snap both the start point and the current drag point to grid corners, then
+        # convert back so the rectangle is drawn exactly on integer cell boundaries.
+        start_grid = self.model.canvas_to_corner(*self.marker_draw_start)
+        current_grid = self.model.canvas_to_corner(self.canvas.canvasx(event.x), self.canvas.canvasy(event.y))
+        c_x1, c_y1 = self.model.corner_to_canvas(*start_grid)
+        c_x2, c_y2 = self.model.corner_to_canvas(*current_grid)
         
         # Update the rectangle's coords to reflect snapped positions
         self.canvas.coords(self.marker_draw_rect, c_x1, c_y1, c_x2, c_y2)
@@ -1050,18 +4925,9 @@ class GridApp:
         self.canvas.delete(self.marker_draw_rect)
         self.marker_draw_rect = None
 
-        # Convert the canvas coordinates to grid coordinates
-        adjusted = CELL_SIZE * self.zoom_factor
-        raw_x1 = (coords[0] - self.pan_x) / adjusted
-        raw_y1 = (coords[1] - self.pan_y) / adjusted
-        raw_x2 = (coords[2] - self.pan_x) / adjusted
-        raw_y2 = (coords[3] - self.pan_y) / adjusted
-
-        # Round and flip Y (since your grid uses (GRID_SIZE - y) in the code)
-        x1 = int(round(raw_x1))
-        y1 = int(round(GRID_SIZE - raw_y1 - 1))
-        x2 = int(round(raw_x2))
-        y2 = int(round(GRID_SIZE - raw_y2 - 1))
+        # Convert the canvas coordinates to (snapped) grid coordinates
+        x1, y1 = self.model.canvas_to_corner(coords[0], coords[1])
+        x2, y2 = self.model.canvas_to_corner(coords[2], coords[3])
 
         # Ensure x1 <= x2 and y1 <= y2
         if x2 < x1:
@@ -1069,28 +4935,13 @@ class GridApp:
         if y2 < y1:
             y1, y2 = y2, y1
 
-        # Compute width and height in grid cells
-        width = x2 - x1 + 1
-        height = y2 - y1 + 1
-
-        # Compute the center where to store the object
-        center_x = x1 + (width // 2)
-        center_y = y1 + (height // 2)
-
-        # Create a new normal object (instead of a "marker")
-        tag = f"Rect_{center_x}_{center_y}"
-        self.placed_objects[(center_x, center_y)] = {
-            "tag": tag,
-            "color": "gray",
-            "size": (width, height)
-        }
-
-        self.draw_grid()
-
         # Optionally reset tool
         self.current_tool = None
         self.top_right_status.config(text="Tool: None")
 
+        if x1 != x2 and y1 != y2:
+            self.prompt_marker_details(x1, y1, x2, y2)
+
     def prompt_marker_details(self, x1, y1, x2, y2):
         win = tk.Toplevel(self.root)
         win.title("Define Marker")
@@ -1115,9 +4966,10 @@ class GridApp:
             if not name:
                 messagebox.showerror("Error", "Name cannot be empty.")
                 return
-            marker = {"name": name, "x1": x1, "y1": y1, "x2": x2, "y2": y2, "color": color_label.cget("text")}
-            self.placed_objects[("marker", name)] = marker
-            self.draw_markers()
+            if ("marker", name) in self.placed_objects:
+                messagebox.showerror("Error", f"A marker named '{name}' already exists.")
+                return
+            self.model.place_object(("marker", name), marker_data(name, (x1, y1, x2, y2), color_label.cget("text")))
             win.destroy()
         tk.Button(win, text="Save Marker", command=save_marker).grid(row=2, column=0, columnspan=3, pady=10)
         win.wait_window(win)
@@ -1332,6 +5184,10 @@ class GridApp:
         }
         with open("weekly_schedule.json", "w") as f:
             json.dump(data, f, indent=4)
+        self.remember_file(WEEKLY_SCHEDULE_FILE)
+        self.update_train_conductor_file()
+        if self.collab_client is not None:
+            self.collab_client.send_schedule(data)
         messagebox.showinfo("Weekly Schedule", "Schedule saved successfully.")
 
     def on_schedule_item_double_click(self, event):
@@ -1412,124 +5268,175 @@ class GridApp:
 
 
     def initialize_preset_terrain(self):
-        """Sets up preset mud terrain areas (PvP & restricted zones) by coloring the original grid cells."""
-        # PvP Mud Area
-        for x in range(448, 552):  # x: 448-551
-            for y in range(446, 550):  # y: 446-549
-                self.terrain_cells[(x, y)] = "mud"
-
-        # Dark Mud (Restricted Placement Area)
-        for x in range(489, 510):  # x: 489-509
-            for y in range(486, 508):  # y: 486-507
-                self.terrain_cells[(x, y)] = "dark_mud"
-
-        # Force terrain to be drawn after grid
-        self.redraw_terrain()
-
-    def redraw_objects(self):
-        adjusted = CELL_SIZE * self.zoom_factor
-        
-        # Iterate over every placed object
-        for key, data in self.placed_objects.items():
+        """Sets up the preset terrain zones of the map config (e.g. the PvP mud and the restricted
+        dark mud) by coloring their grid cells. Later zones are painted over earlier ones."""
+        cells = {}
+        for zone in self.model.zones:
+            x1, y1, x2, y2 = zone["rect"]
+            for x in range(max(0, x1), min(self.model.grid_size, x2)):
+                for y in range(max(0, y1), min(self.model.grid_size, y2)):
+                    cells[(x, y)] = zone["terrain"]
+
+        self.model.set_terrain(cells)
+
+    def drawn_items(self):
+        """(key, data) of the objects and placed markers in the drawn region, or of all of them
+        before the first draw."""
+        if self.drawn_region is None:
+            return list(self.placed_objects.items())
+        return [(key, self.placed_objects[key]) for key in self.model.items_in(*self.drawn_region)]
+
+    def redraw_markers(self):
+        self.marker_tags = {}
+        for key, data in self.drawn_items():
             if data.get("is_marker"):
-                # It's a marker. It stores its geometry as a bounding box.
-                x1, y1, x2, y2 = data["bbox"]
-                # Convert grid coordinates to canvas coordinates.
-                c_x1 = x1 * adjusted + self.pan_x
-                c_y1 = (GRID_SIZE - y1) * adjusted + self.pan_y
-                c_x2 = x2 * adjusted + self.pan_x
-                c_y2 = (GRID_SIZE - y2) * adjusted + self.pan_y
-                
-                # Use a blue outline if selected, otherwise use its defined color.
-                if key in self.selected_objects:
-                    outline_color = "blue"
-                    width = 4
-                    dash = (4, 2)
-                else:
-                    outline_color = data["color"]
-                    width = 4
-                    dash = None
-                
-                self.canvas.create_rectangle(c_x1, c_y1, c_x2, c_y2,
-                                             outline=outline_color, width=width, dash=dash, fill="")
-                # Optionally, display the marker's name when zoomed out.
-                if adjusted < self.grid_zoom_threshold:
-                    mid_x = (c_x1 + c_x2) / 2
-                    mid_y = (c_y1 + c_y2) / 2
-                    self.canvas.create_text(mid_x, mid_y, text=data["tag"], fill=data["color"])
-            else:
-                # It's a normal object. Its key is a tuple (x, y) indicating its center, and it stores a "size".
-                (obj_x, obj_y) = key
-                w, h = data.get("size", (3, 3))
-                x_start = obj_x - w // 2
-                y_start = obj_y - h // 2
-                c_x1 = x_start * adjusted + self.pan_x
-                c_y1 = (GRID_SIZE - (y_start + h)) * adjusted + self.pan_y
-                
-                # Draw selection outline if selected.
-                if key in self.selected_objects:
-                    self.canvas.create_rectangle(c_x1, c_y1, c_x1 + w * adjusted, c_y1 + h * adjusted,
-                                                 outline="red", width=3, dash=(4, 2))
-                # If an avatar exists, attempt to draw it; otherwise draw a filled rectangle.
-                if data.get("avatar") and os.path.exists(data["avatar"]):
-                    try:
-                        img = Image.open(data["avatar"])
-                        img = img.resize((int(w * adjusted), int(h * adjusted)), Image.Resampling.LANCZOS)
-                        photo = ImageTk.PhotoImage(img)
-                        self.canvas.create_image(c_x1, c_y1, image=photo, anchor="nw")
-                        if not hasattr(self, "object_images"):
-                            self.object_images = []
-                        self.object_images.append(photo)
-                    except Exception as e:
-                        # Fall back to a colored rectangle if the image fails.
-                        self.canvas.create_rectangle(c_x1, c_y1, c_x1 + w * adjusted, c_y1 + h * adjusted,
-                                                     fill=data["color"], outline="black")
-                        self.canvas.create_text(c_x1 + (w * adjusted) / 2, c_y1 + (h * adjusted) / 2,
-                                                 text=data["tag"], fill="white",
-                                                 font=("Arial", int(adjusted / 3)))
-                else:
-                    self.canvas.create_rectangle(c_x1, c_y1, c_x1 + w * adjusted, c_y1 + h * adjusted,
-                                                 fill=data["color"], outline="black")
-                    self.canvas.create_text(c_x1 + (w * adjusted) / 2, c_y1 + (h * adjusted) / 2,
-                                             text=data["tag"], fill="white",
-                                             font=("Arial", int(adjusted / 3)))
-
-    def delete_selected_objects(self, event):
-        for key in list(self.selected_objects):
-            if key in self.placed_objects:
-                del self.placed_objects[key]
-        self.selected_objects.clear()
-        self.draw_grid()
-
+                self.draw_marker(key, data)
+
+    def draw_marker(self, key, data):
+        tag = self.marker_tags.get(key)
+        if tag is None:
+            # Marker names can't be canvas tags themselves: Tk reads "!", "&&" and such as tag expressions.
+            self.marker_tag_count += 1
+            tag = self.marker_tags[key] = f"marker_item_{self.marker_tag_count}"
+        c_x1, c_y1, c_x2, c_y2 = self.model.bbox_canvas_rect(data["bbox"])
+        
+        # Use a blue outline if selected, otherwise use its defined color.
+        if key in self.selected_objects:
+            outline_color = "blue"
+            width = 4
+            dash = (4, 2)
+        else:
+            outline_color = data["color"]
+            width = 4
+            dash = None
+        
+        self.canvas.create_rectangle(c_x1, c_y1, c_x2, c_y2,
+                                     outline=outline_color, width=width, dash=dash, fill="", tags=("markers", tag))
+        # Optionally, display the marker's name when zoomed out.
+        if self.model.cell_px < self.grid_zoom_threshold:
+            mid_x = (c_x1 + c_x2) / 2
+            mid_y = (c_y1 + c_y2) / 2
+            self.canvas.create_text(mid_x, mid_y, text=data["tag"], fill=data["color"], tags=("markers", tag))
+        return tag
+
+    def redraw_marker_items(self, keys):
+        """Redraws just these markers, e.g. the one being dragged, leaving the rest of the layer alone."""
+        drawn = set(self.model.marker_index.query(*self.drawn_region)) if self.drawn_region else set()
+        state = "normal" if self.layer_visible["markers"] else "hidden"
+        for key in keys:
+            tag = self.marker_tags.get(key)
+            if tag is not None:
+                self.canvas.delete(tag)
+            data = self.placed_objects.get(key)
+            if data is None or key not in drawn:
+                self.marker_tags.pop(key, None)
+                continue
+            tag = self.draw_marker(key, data)
+            self.canvas.addtag_withtag("layer", tag)
+            self.canvas.itemconfigure(tag, state=state)
+
+    def redraw_objects(self, layers=OBJECT_LAYERS):
+        """Draws the objects of the given object layers, each item tagged with its layer."""
+        adjusted = self.model.cell_px
+        # PhotoImages used by this redraw; ones from the previous redraw are reused when the size matches.
+        previous_images = {layer: self.object_images[layer] for layer in layers}
+        for layer in layers:
+            self.object_images[layer] = {}
+        
+        label_size = self.label_fonts.size_for(adjusted)
+        label_font = self.label_fonts.font(label_size) if label_size else None
 
-    def handle_right_click(self, event):
-            """If right-click is on a placed object, open context menu; otherwise, deselect tool."""
-            adjusted_cell_size = CELL_SIZE * self.zoom_factor
-            x = int((self.canvas.canvasx(event.x) - self.pan_x) / adjusted_cell_size)
-            y = GRID_SIZE - int((self.canvas.canvasy(event.y) - self.pan_y) / adjusted_cell_size) - 1
-
-            found_obj = None
-            for center, data in self.placed_objects.items():
-                obj_size = data.get("size", (3, 3))
-                w, h = obj_size
-                cx, cy = center
-                x_start = cx - w // 2
-                y_start = cy - h // 2
-                if x_start <= x < x_start + w and y_start <= y < y_start + h:
-                    found_obj = center
-                    break
+        def draw_label(c_x1, c_y1, w, h, text, tags):
+            if label_font is None:
+                return
+            text = self.label_fonts.fit(text, label_size, w * adjusted - 2, h * adjusted)
+            if text:
+                self.canvas.create_text(c_x1 + (w * adjusted) / 2, c_y1 + (h * adjusted) / 2,
+                                        text=text, fill="white", font=label_font, tags=tags)
 
-            if found_obj is not None:
-                self.show_object_context_menu(event, found_obj)
+        # Iterate over the objects in the drawn chunks
+        for key, data in self.drawn_items():
+            if data.get("is_marker"):
+                continue
+            layer = self.object_layer(data)
+            if layer not in layers:
+                continue
+            images = self.object_images[layer]
+            # Its key is a tuple (x, y) indicating its center, and it stores a "size".
+            w, h = data.get("size", (3, 3))
+            c_x1, c_y1, _, _ = self.model.object_canvas_rect(key, data)
+            
+            # Draw selection outline if selected.
+            if key in self.selected_objects:
+                self.canvas.create_rectangle(c_x1, c_y1, c_x1 + w * adjusted, c_y1 + h * adjusted,
+                                             outline="red", width=3, dash=(4, 2), tags=layer)
+            # Draw the avatar if it is loaded; otherwise draw a filled rectangle, which the
+            # avatar replaces when it arrives.
+            image_key = (data["avatar"], int(w * adjusted), int(h * adjusted)) if data.get("avatar") else None
+            photo = image_key and (previous_images[layer].get(image_key) or images.get(image_key))
+            if photo:
+                self.canvas.create_image(c_x1, c_y1, image=photo, anchor="nw", tags=layer)
+                images[image_key] = photo
             else:
-                self.deselect_tool(event)
+                tags = layer
+                if image_key and self.request_avatar(data["avatar"], image_key[1:], self.swap_avatar_placeholders):
+                    tags = (layer, self.avatar_wait_tag(image_key))
+                self.canvas.create_rectangle(c_x1, c_y1, c_x1 + w * adjusted, c_y1 + h * adjusted,
+                                             fill=data["color"], outline="black", tags=tags)
+                draw_label(c_x1, c_y1, w, h, data["tag"], tags)
+        self.cancel_offscreen_avatars()
+
+    def request_avatar(self, path, size, callback):
+        """Asks the avatar loader for an image and makes sure finished ones get delivered."""
+        if not self.avatar_loader.request(path, size, callback):
+            return False
+        if self.avatar_after is None:
+            self.avatar_after = self.root.after(AVATAR_POLL_MS, self.deliver_avatars)
+        return True
+
+    def deliver_avatars(self):
+        self.avatar_after = None
+        if self.avatar_loader.deliver():
+            self.avatar_after = self.root.after(AVATAR_POLL_MS, self.deliver_avatars)
+
+    def avatar_wait_tag(self, image_key):
+        tag = self.avatar_wait_tags.get(image_key)
+        if tag is None:
+            self.avatar_wait_count += 1
+            tag = self.avatar_wait_tags[image_key] = f"avatar_wait_{self.avatar_wait_count}"
+        return tag
+
+    def swap_avatar_placeholders(self, image_key, image):
+        """Puts a loaded avatar where its placeholder rectangles are, keeping their place in the stacking order."""
+        tag = self.avatar_wait_tags.pop(image_key, None)
+        if tag is None:
+            return
+        photo = None
+        for item in self.canvas.find_withtag(tag):
+            if self.canvas.type(item) != "rectangle":
+                continue
+            layer = next(t for t in self.canvas.gettags(item) if t in OBJECT_LAYERS)
+            photo = photo or ImageTk.PhotoImage(image)
+            c_x1, c_y1 = self.canvas.coords(item)[:2]
+            avatar_item = self.canvas.create_image(c_x1, c_y1, image=photo, anchor="nw", tags=(layer, "layer"),
+                                                   state=self.canvas.itemcget(item, "state"))
+            self.canvas.tag_raise(avatar_item, item)
+            self.object_images[layer][image_key] = photo
+        self.canvas.delete(tag)
+
+    def cancel_offscreen_avatars(self):
+        """Drops avatar requests whose placeholders are gone, e.g. scrolled out of the drawn region."""
+        for image_key, tag in list(self.avatar_wait_tags.items()):
+            if not self.canvas.find_withtag(tag):
+                del self.avatar_wait_tags[image_key]
+                self.avatar_loader.cancel(image_key, self.swap_avatar_placeholders)
 
     def open_conductor_assignment_dialog(self, lb):
         day_date = lb.day_date
         win = tk.Toplevel(self.root)
         win.title(f"Assign Conductor for {day_date}")
         # Create checkbuttons for each rank.
-        ranks = ["R1", "R2", "R3", "R4", "R5"]
+        ranks = ALLIANCE_RANKS
         rank_vars = {rank: tk.BooleanVar(value=True) for rank in ranks}
         row = 0
         tk.Label(win, text="Filter by Rank:").grid(row=row, column=0, columnspan=2)
@@ -1544,10 +5451,10 @@ class GridApp:
         
         def update_member_list():
             member_listbox.delete(0, tk.END)
-            for member in self.alliance_members:
-                member_rank = member.get("Rank", "R1")
-                if rank_vars[member_rank].get():
-                    member_listbox.insert(tk.END, member.get("Name", "Unnamed"))
+            for rank in ranks:
+                if rank_vars[rank].get():
+                    for member in self.alliance_members.by_rank(rank):
+                        member_listbox.insert(tk.END, member.get("Name", "Unnamed"))
         
         tk.Button(win, text="Filter", command=update_member_list).grid(row=row, column=0, columnspan=3, pady=5)
         update_member_list()  # Initial population
@@ -1623,12 +5530,29 @@ class GridApp:
         tk.Button(btn_frame, text="Edit Member", command=self.edit_alliance_member).pack(side=tk.LEFT, padx=5)
         tk.Button(btn_frame, text="Remove Member", command=self.remove_alliance_member).pack(side=tk.LEFT, padx=5)
         tk.Button(btn_frame, text="Save Changes", command=self.save_alliance_members).pack(side=tk.LEFT, padx=5)
+        io_frame = tk.Frame(self.alliance_win)
+        io_frame.pack(pady=5)
+        tk.Button(io_frame, text="Import Roster...", command=self.import_alliance_roster).pack(side=tk.LEFT, padx=5)
+        tk.Button(io_frame, text="Export Roster...", command=self.export_alliance_roster).pack(side=tk.LEFT, padx=5)
+
+    def member_listbox_label(self, member):
+        return f"{member.get('Name', 'Unnamed')} - {member.get('Rank', 'N/A')}"
+
+    def member_listbox_alive(self):
+        return hasattr(self, "member_listbox") and self.member_listbox.winfo_exists()
 
     def update_member_listbox(self):
         self.member_listbox.delete(0, tk.END)
+        self.member_listbox_ids = []  # member ID for each listbox row
         for member in self.alliance_members:
-            display = f"{member.get('Name', 'Unnamed')} - {member.get('Rank', 'N/A')}"
-            self.member_listbox.insert(tk.END, display)
+            self.member_listbox.insert(tk.END, self.member_listbox_label(member))
+            self.member_listbox_ids.append(member["Id"])
+
+    def selected_member_id(self):
+        idxs = self.member_listbox.curselection()
+        if not idxs:
+            return None
+        return self.member_listbox_ids[idxs[0]]
 
     def add_alliance_member(self):
         add_win = tk.Toplevel(self.root)
@@ -1638,8 +5562,7 @@ class GridApp:
         tk.Entry(add_win, textvariable=name_var).grid(row=0, column=1, padx=5, pady=5)
         tk.Label(add_win, text="Rank:").grid(row=1, column=0, sticky="w", padx=5, pady=5)
         rank_var = tk.StringVar(value="R1")
-        ranks = ["R1", "R2", "R3", "R4", "R5"]
-        tk.OptionMenu(add_win, rank_var, *ranks).grid(row=1, column=1, padx=5, pady=5)
+        tk.OptionMenu(add_win, rank_var, *ALLIANCE_RANKS).grid(row=1, column=1, padx=5, pady=5)
         
         def on_add():
             name = name_var.get().strip()
@@ -1653,10 +5576,12 @@ class GridApp:
                 "Rank": rank_var.get(),
                 "Avatar": avatar_path if avatar_path is not None else self.alliance_default_colors.get(rank_var.get(), "#000000")
             }
-            self.alliance_members.append(new_member)
+            try:
+                self.alliance_members.add(new_member)
+            except ValueError as e:
+                tk.messagebox.showerror("Error", str(e))
+                return
             self.alliance_members_changed = True
-            self.update_member_listbox()
-            self.update_alliance_members_submenu()
             add_win.destroy()
         
         tk.Button(add_win, text="Add Member", command=on_add).grid(row=2, column=0, columnspan=2, pady=10)
@@ -1665,12 +5590,11 @@ class GridApp:
         if not self.alliance_members:
             tk.messagebox.showerror("Error", "No members available to edit.")
             return
-        idxs = self.member_listbox.curselection()
-        if not idxs:
+        member_id = self.selected_member_id()
+        if member_id is None:
             tk.messagebox.showerror("Error", "No member selected.")
             return
-        idx = idxs[0]
-        member = self.alliance_members[idx]
+        member = self.alliance_members.get(member_id)
         edit_win = tk.Toplevel(self.root)
         edit_win.title("Edit Alliance Member")
         tk.Label(edit_win, text="Name:").grid(row=0, column=0, sticky="w", padx=5, pady=5)
@@ -1678,8 +5602,7 @@ class GridApp:
         tk.Entry(edit_win, textvariable=name_var).grid(row=0, column=1, padx=5, pady=5)
         tk.Label(edit_win, text="Rank:").grid(row=1, column=0, sticky="w", padx=5, pady=5)
         rank_var = tk.StringVar(value=member.get("Rank", "R1"))
-        ranks = ["R1", "R2", "R3", "R4", "R5"]
-        tk.OptionMenu(edit_win, rank_var, *ranks).grid(row=1, column=1, padx=5, pady=5)
+        tk.OptionMenu(edit_win, rank_var, *ALLIANCE_RANKS).grid(row=1, column=1, padx=5, pady=5)
         tk.Label(edit_win, text="Avatar:").grid(row=2, column=0, sticky="w", padx=5, pady=5)
         avatar_var = tk.StringVar(value=member.get("Avatar", ""))
         def choose_avatar():
@@ -1693,13 +5616,21 @@ class GridApp:
             if not new_name:
                 tk.messagebox.showerror("Error", "Name cannot be empty.")
                 return
-            member["Name"] = new_name
-            member["Rank"] = rank_var.get()
-            member["Avatar"] = avatar_var.get() if avatar_var.get() else self.alliance_default_colors.get(rank_var.get(), "#000000")
-            self.alliance_members[idx] = member
+            if self.alliance_members.get(member_id) is None:
+                tk.messagebox.showerror("Error", "This member has been removed.")
+                edit_win.destroy()
+                return
+            try:
+                self.alliance_members.update(
+                    member_id,
+                    Name=new_name,
+                    Rank=rank_var.get(),
+                    Avatar=avatar_var.get() if avatar_var.get() else self.alliance_default_colors.get(rank_var.get(), "#000000")
+                )
+            except ValueError as e:
+                tk.messagebox.showerror("Error", str(e))
+                return
             self.alliance_members_changed = True
-            self.update_member_listbox()
-            self.update_alliance_members_submenu()
             edit_win.destroy()
         tk.Button(edit_win, text="Save Changes", command=on_edit).grid(row=3, column=0, columnspan=2, pady=10)
 
@@ -1707,14 +5638,61 @@ class GridApp:
         if not self.alliance_members:
             tk.messagebox.showerror("Error", "No members available to remove.")
             return
-        idxs = self.member_listbox.curselection()
-        if not idxs:
+        member_id = self.selected_member_id()
+        if member_id is None:
             tk.messagebox.showerror("Error", "No member selected.")
             return
-        idx = idxs[0]
-        del self.alliance_members[idx]
+        self.alliance_members.remove(member_id)
         self.alliance_members_changed = True
-        self.update_member_listbox()
+
+    def import_alliance_roster(self):
+        """Imports many members at once from a CSV or JSON roster, after showing a report."""
+        path = filedialog.askopenfilename(title="Import Roster",
+                                          filetypes=[("Roster Files", "*.csv;*.json"), ("All Files", "*.*")])
+        if not path:
+            return
+        try:
+            rows = read_roster_file(path)
+        except Exception as e:
+            messagebox.showerror("Import Roster", f"Could not read roster: {e}")
+            return
+        new_members, updates, problems = plan_roster_import(self.alliance_members, rows, self.avatar_index)
+
+        report_win = tk.Toplevel(self.root)
+        report_win.title("Import Roster")
+        tk.Label(report_win, text=f"{len(new_members)} new member(s), {len(updates)} existing member(s) to update.").pack(padx=10, pady=5)
+        report = tk.Text(report_win, width=70, height=15)
+        report.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        report.insert(tk.END, "\n".join(problems) if problems else "No conflicts found.")
+        report.config(state=tk.DISABLED)
+
+        def apply_import():
+            # One batch so menus and the listbox are rebuilt once, not per member.
+            with self.alliance_members.batch():
+                for member_id, changes in updates.items():
+                    self.alliance_members.update(member_id, **changes)
+                for member in new_members:
+                    member.setdefault("Avatar", self.alliance_default_colors.get(member["Rank"], "#000000"))
+                    self.alliance_members.add(member)
+            self.alliance_members_changed = True
+            report_win.destroy()
+
+        btn_frame = tk.Frame(report_win)
+        btn_frame.pack(pady=5)
+        tk.Button(btn_frame, text="Apply", command=apply_import).pack(side=tk.LEFT, padx=5)
+        tk.Button(btn_frame, text="Cancel", command=report_win.destroy).pack(side=tk.LEFT, padx=5)
+
+    def export_alliance_roster(self):
+        path = filedialog.asksaveasfilename(title="Export Roster", defaultextension=".csv",
+                                            filetypes=[("CSV", "*.csv"), ("JSON", "*.json")])
+        if not path:
+            return
+        try:
+            write_roster_file(path, self.alliance_members.to_list())
+        except OSError as e:
+            messagebox.showerror("Export Roster", f"Could not write roster: {e}")
+            return
+        messagebox.showinfo("Export Roster", f"Exported {len(self.alliance_members)} members.")
 
     def close_alliance_win(self):
         if self.alliance_members_changed:
@@ -1727,7 +5705,8 @@ class GridApp:
 
     def save_alliance_members(self):
         with open("alliance_members.txt", "w") as f:
-            json.dump(self.alliance_members, f, indent=4)
+            json.dump(self.alliance_members.to_list(), f, indent=4)
+        self.remember_file(ALLIANCE_MEMBERS_FILE)
         self.alliance_members_changed = False
         tk.messagebox.showinfo("Save Alliance Members", "Alliance members saved successfully.")
 
@@ -1745,25 +5724,28 @@ class GridApp:
         # Alliance submenu (if desired)
         self.create_object_submenu(place_menu, "Alliance", {
             "R1": "#2C3E50", "R2": "#34495E", "R3": "#5D6D7E", "R4": "#2874A6", "R5": "#1F618D"
-        })
+        }, category="alliance")
         
         # Friendly submenu using stored objects:
         self.friendly_submenu = tk.Menu(place_menu, tearoff=0)
         place_menu.add_cascade(label="Friendly", menu=self.friendly_submenu)
         for name, color in self.friendly_objects.items():
-            self.friendly_submenu.add_command(label=name, command=lambda n=name, c=color: self.activate_preset_object(n, c))
+            self.friendly_submenu.add_command(
+                label=name, command=lambda n=name, c=color: self.activate_preset_object(n, c, category="friendly"))
         
         # Enemy submenu:
         self.enemy_submenu = tk.Menu(place_menu, tearoff=0)
         place_menu.add_cascade(label="Enemy", menu=self.enemy_submenu)
         for name, color in self.enemy_objects.items():
-            self.enemy_submenu.add_command(label=name, command=lambda n=name, c=color: self.activate_preset_object(n, c))
+            self.enemy_submenu.add_command(
+                label=name, command=lambda n=name, c=color: self.activate_preset_object(n, c, category="enemy"))
         
         # Other submenu:
         self.other_submenu = tk.Menu(place_menu, tearoff=0)
         place_menu.add_cascade(label="Other", menu=self.other_submenu)
         for name, color in self.other_objects.items():
-            self.other_submenu.add_command(label=name, command=lambda n=name, c=color: self.activate_preset_object(n, c))
+            self.other_submenu.add_command(
+                label=name, command=lambda n=name, c=color: self.activate_preset_object(n, c, category="other"))
         
         self.custom_objects = {}
         self.custom_submenu = tk.Menu(place_menu, tearoff=0)
@@ -1777,6 +5759,28 @@ class GridApp:
         settings_menu = tk.Menu(menu_bar, tearoff=0)
         menu_bar.add_cascade(label="Settings", menu=settings_menu)
         settings_menu.add_command(label="Grid Properties", command=self.edit_grid_properties)
+        self.hud_var = tk.BooleanVar(value=False)
+        settings_menu.add_checkbutton(label="Performance Overlay", variable=self.hud_var,
+                                      command=self.toggle_perf_hud, accelerator="F3")
+        self.root.bind("<F3>", self.toggle_perf_hud)
+        self.trace_var = tk.BooleanVar(value=self.tracer.enabled)
+        settings_menu.add_checkbutton(label="Enable Tracing", variable=self.trace_var, command=self.toggle_tracing)
+        settings_menu.add_command(label="Dump Trace...", command=self.dump_trace)
+        self.record_var = tk.BooleanVar(value=False)
+        settings_menu.add_checkbutton(label="Record Interaction", variable=self.record_var,
+                                      command=self.toggle_recording)
+        settings_menu.add_command(label="Replay Interaction...", command=self.replay_interaction)
+        settings_menu.add_command(label="Export Map Image...", command=self.save_map_image)
+        self.minimap_var = tk.BooleanVar(value=True)
+        settings_menu.add_checkbutton(label="Show Minimap", variable=self.minimap_var, command=self.toggle_minimap)
+        layers_menu = tk.Menu(settings_menu, tearoff=0)
+        settings_menu.add_cascade(label="Layers", menu=layers_menu)
+        self.layer_vars = {}
+        for layer in MAP_LAYERS:
+            if layer in LAYER_LABELS:
+                self.layer_vars[layer] = tk.BooleanVar(value=self.layer_visible[layer])
+                layers_menu.add_checkbutton(label=LAYER_LABELS[layer], variable=self.layer_vars[layer],
+                                            command=lambda l=layer: self.toggle_layer(l))
         
         delete_menu = tk.Menu(menu_bar, tearoff=0)
         
@@ -1804,12 +5808,47 @@ class GridApp:
         markers_menu.add_command(label="Edit Marker", command=self.edit_marker_prompt)
         markers_menu.add_command(label="Remove Marker", command=self.remove_marker_prompt)
 
+        edit_menu = tk.Menu(menu_bar, tearoff=0)
+        menu_bar.add_cascade(label="Edit", menu=edit_menu)
+        edit_menu.add_command(label="Undo", command=self.undo_edit, accelerator="Ctrl+Z")
+        edit_menu.add_command(label="Redo", command=self.redo_edit, accelerator="Ctrl+Y")
+        edit_menu.add_separator()
+        edit_menu.add_command(label="Cut", command=self.cut_selection, accelerator="Ctrl+X")
+        edit_menu.add_command(label="Copy", command=self.copy_selection, accelerator="Ctrl+C")
+        edit_menu.add_command(label="Paste", command=self.start_paste, accelerator="Ctrl+V")
+        edit_menu.add_separator()
+        edit_menu.add_command(label="Save Selection as Stamp...", command=self.save_selection_as_stamp)
+        self.stamps_submenu = tk.Menu(edit_menu, tearoff=0)
+        edit_menu.add_cascade(label="Formation Stamps", menu=self.stamps_submenu)
+        self.update_stamps_submenu()
+        self.root.bind("<Control-z>", self.undo_edit)
+        self.root.bind("<Control-y>", self.redo_edit)
+        self.root.bind("<Control-x>", self.cut_selection)
+        self.root.bind("<Control-c>", self.copy_selection)
+        self.root.bind("<Control-v>", self.start_paste)
+        self.root.bind("<Escape>", self.deselect_tool, add="+")
+
+        tools_menu = tk.Menu(menu_bar, tearoff=0)
+        menu_bar.add_cascade(label="Tools", menu=tools_menu)
+        tools_menu.add_command(label="Validate Map...", command=self.validate_map)
+        tools_menu.add_command(label="Auto Layout Members...", command=self.auto_layout_members)
+        tools_menu.add_command(label="Proximity...", command=self.open_proximity_window)
+        self.influence_var = tk.BooleanVar(value=False)
+        tools_menu.add_checkbutton(label="Influence Heatmap", variable=self.influence_var,
+                                   command=self.toggle_influence)
+        tools_menu.add_command(label="Heatmap Settings...", command=self.edit_influence_settings)
+        tools_menu.add_separator()
+        tools_menu.add_command(label="Host Collaboration...", command=self.host_collaboration)
+        tools_menu.add_command(label="Join Collaboration...", command=self.join_collaboration)
+        tools_menu.add_command(label="Leave Collaboration", command=self.leave_collaboration)
+
         
         
         alliance_menu = tk.Menu(menu_bar, tearoff=0)
         menu_bar.add_cascade(label="Alliance Management", menu=alliance_menu)
         alliance_menu.add_command(label="Manage Members", command=self.manage_alliance_members)
         alliance_menu.add_command(label="Weekly Schedule", command=self.manage_weekly_schedule)
+        alliance_menu.add_command(label="Export Schedule...", command=self.export_schedule)
         tk.Button(self.root, text="Manage Predefined Tasks", command=self.manage_predefined_vs_tasks).pack(padx=10, pady=5)
         
         alliance_menu.add_command(label="Create Recurring Task", command=self.create_recurring_task)
@@ -1901,49 +5940,43 @@ class GridApp:
         """Rebuilds the Friendly submenu based on self.friendly_objects."""
         self.friendly_submenu.delete(0, tk.END)
         for name, color in self.friendly_objects.items():
-            self.friendly_submenu.add_command(label=name, command=lambda n=name, c=color: self.activate_preset_object(n, c))
+            self.friendly_submenu.add_command(
+                label=name, command=lambda n=name, c=color: self.activate_preset_object(n, c, category="friendly"))
 
     def update_enemy_submenu(self):
         """Rebuilds the Enemy submenu based on self.enemy_objects."""
         self.enemy_submenu.delete(0, tk.END)
         for name, color in self.enemy_objects.items():
-            self.enemy_submenu.add_command(label=name, command=lambda n=name, c=color: self.activate_preset_object(n, c))
+            self.enemy_submenu.add_command(
+                label=name, command=lambda n=name, c=color: self.activate_preset_object(n, c, category="enemy"))
 
     def on_left_button_press(self, event):
         if self.current_tool == "marker_draw":
             self.marker_draw_press(event)
         else:
+            if self.selected_tool and self.selected_tool.get("type") == "stamp":
+                self.place_element(event)
+                return
             if self.selected_tool and self.selected_tool.get("type") == "object":
                 self.place_element(event)
 
             # Otherwise, proceed with normal selection/move/rectangle selection:
             x = self.canvas.canvasx(event.x)
             y = self.canvas.canvasy(event.y)
+            if self.layer_visible["markers"] and self.on_marker_press(event):
+                return
             item_key = self.get_item_at(event)
             if item_key is not None:
-                # (Selection / movement code here.)
                 if item_key not in self.selected_objects:
-                    self.selected_objects.clear()
-                    self.selected_objects.add(item_key)
-                    self.original_positions = {}
-                    data = self.placed_objects[item_key]
-                    if data.get("is_marker"):
-                        self.original_positions[item_key] = data["bbox"]
-                    else:
-                        self.original_positions[item_key] = item_key
-                else:
-                    if not self.original_positions:
-                        self.original_positions = {}
-                        for key in self.selected_objects:
-                            data = self.placed_objects[key]
-                            if data.get("is_marker"):
-                                self.original_positions[key] = data["bbox"]
-                            else:
-                                self.original_positions[key] = key
+                    self.model.select([item_key])
+                self.original_positions = {}
+                for key in self.selected_objects:
+                    data = self.placed_objects[key]
+                    self.original_positions[key] = data["bbox"] if data.get("is_marker") else key
                 self.moving_start = (x, y)
             else:
                 # No object was clicked – start a rectangle selection.
-                self.selected_objects.clear()
+                self.model.clear_selection()
                 self.selection_start = (x, y)
                 self.selection_rect = self.canvas.create_rectangle(x, y, x, y,
                                                                    outline="red", dash=(2,2))
@@ -1954,6 +5987,9 @@ class GridApp:
         if self.current_tool == "marker_draw":
             self.marker_draw_motion(event)
             return  # Stop here so we don't also do selection/move code
+        if self.marker_resizing:
+            self.on_marker_motion(event)
+            return
         
         # Otherwise, do the normal selection/move code:
         x = self.canvas.canvasx(event.x)
@@ -1961,38 +5997,27 @@ class GridApp:
         
         # If we started moving an item...
         if self.moving_start is not None:
-            dx = x - self.moving_start[0]
-            dy = y - self.moving_start[1]
-            adjusted = CELL_SIZE * self.zoom_factor
-            grid_dx = dx / adjusted
-            grid_dy = dy / adjusted
-
-            for key in list(self.selected_objects):
-                data = self.placed_objects[key]
-                original = self.original_positions[key]
+            # Offsets are measured from the press point, so rounding never accumulates.
+            grid_dx = (x - self.moving_start[0]) / self.model.cell_px
+            grid_dy = (y - self.moving_start[1]) / self.model.cell_px
+
+            moves = {}
+            for key, original in self.original_positions.items():
+                data = self.placed_objects.get(key)
+                if data is None:
+                    continue
                 if data.get("is_marker"):
                     # For markers, update the bounding box
                     x1, y1, x2, y2 = original
-                    new_bbox = (x1 + grid_dx, y1 - grid_dy, x2 + grid_dx, y2 - grid_dy)
-                    data["bbox"] = new_bbox
+                    self.model.update_object(key, bbox=(x1 + grid_dx, y1 - grid_dy, x2 + grid_dx, y2 - grid_dy))
                 else:
-                    # For normal objects, update their center
+                    # For normal objects, move their center as one group
                     orig_x, orig_y = original
-                    new_x = orig_x + grid_dx
-                    new_y = orig_y - grid_dy
-                    new_center = (int(round(new_x)), int(round(new_y)))
-
-                    # Update placed_objects
-                    del self.placed_objects[key]
-                    self.placed_objects[new_center] = data
-                    
-                    # Update selection & original_positions
-                    self.selected_objects.remove(key)
-                    self.selected_objects.add(new_center)
-                    self.original_positions[new_center] = (new_x, new_y)
-
-            self.moving_start = (x, y)
-            self.draw_grid()
+                    moves[key] = (int(round(orig_x + grid_dx)), int(round(orig_y - grid_dy)))
+            done = self.model.move_objects(moves)
+            if done:
+                self.original_positions = {done.get(key, key): original
+                                           for key, original in self.original_positions.items()}
         
         # Else if we’re rubberbanding a rectangle for multi-selection,
         # just update the selection rectangle’s coords.
@@ -2003,92 +6028,35 @@ class GridApp:
                                x, y)
 
     def on_left_button_release(self, event):
-        if self.moving_start is not None:
+        if self.marker_resizing:
+            self.on_marker_release(event)
+        elif self.moving_start is not None:
             # Movement finished; clear moving variables.
             self.moving_start = None
             self.original_positions.clear()
         elif self.selection_rect is not None:
             # Finalize rectangle selection.
             x1, y1, x2, y2 = self.canvas.coords(self.selection_rect)
-            # Normalize coordinates.
-            if x1 > x2:
-                x1, x2 = x2, x1
-            if y1 > y2:
-                y1, y2 = y2, y1
-            adjusted = CELL_SIZE * self.zoom_factor
-            selected_keys = []
-            for key, data in self.placed_objects.items():
-                if data.get("is_marker"):
-                    # For markers, get canvas coordinates from the bounding box.
-                    bx1, by1, bx2, by2 = data["bbox"]
-                    c_bx1 = bx1 * adjusted + self.pan_x
-                    c_by1 = (GRID_SIZE - by1) * adjusted + self.pan_y
-                    c_bx2 = bx2 * adjusted + self.pan_x
-                    c_by2 = (GRID_SIZE - by2) * adjusted + self.pan_y
-                    # If the marker’s entire rectangle lies within the selection rectangle, select it.
-                    if c_bx1 >= x1 and c_by1 >= y1 and c_bx2 <= x2 and c_by2 <= y2:
-                        selected_keys.append(key)
-                else:
-                    # For normal objects, key is the center; compute the object's canvas bounding box.
-                    obj_x, obj_y = key
-                    w, h = data.get("size", (3, 3))
-                    x_start = obj_x - w // 2
-                    y_start = obj_y - h // 2
-                    c_x1 = x_start * adjusted + self.pan_x
-                    c_y1 = (GRID_SIZE - (y_start + h)) * adjusted + self.pan_y
-                    c_x2 = c_x1 + w * adjusted
-                    c_y2 = c_y1 + h * adjusted
-                    if c_x1 >= x1 and c_y1 >= y1 and c_x2 <= x2 and c_y2 <= y2:
-                        selected_keys.append(key)
-            self.selected_objects = set(selected_keys)
             self.canvas.delete(self.selection_rect)
             self.selection_rect = None
-            self.draw_grid()
+            self.model.select(self.model.keys_in_canvas_rect(x1, y1, x2, y2))
 
     def get_marker_nearby(self, event, tolerance=10):
-        """Return the marker dict if the mouse is within tolerance pixels of a marker's rectangle; otherwise None."""
-        adjusted = CELL_SIZE * self.zoom_factor
-        for marker in self.markers.values():
-            x1 = marker["x1"] * adjusted + self.pan_x
-            y1 = (GRID_SIZE - marker["y1"]) * adjusted + self.pan_y
-            x2 = marker["x2"] * adjusted + self.pan_x
-            y2 = (GRID_SIZE - marker["y2"]) * adjusted + self.pan_y
-            # Expand the rectangle by tolerance on all sides.
-            if (x1 - tolerance) <= event.x <= (x2 + tolerance) and (y1 - tolerance) <= event.y <= (y2 + tolerance):
-                return marker
-        return None
+        """Return the key of the marker within tolerance pixels of the mouse, or None."""
+        if not self.layer_visible["markers"]:
+            return None
+        return self.model.marker_near_canvas(self.canvas.canvasx(event.x), self.canvas.canvasy(event.y), tolerance)
 
-    def on_marker_press(self, event):
-        # Get the top item under the pointer using the "current" tag.
-        current_items = self.canvas.find_withtag("current")
-        for item in current_items:
-            tags = self.canvas.gettags(item)
-            for tag in tags:
-                if tag.startswith("marker_"):
-                    # Extract the marker's unique ID (its name)
-                    marker_id = tag.split("_", 1)[1]
-                    self.current_marker_id = marker_id
-                    self.marker_move_start = (event.x, event.y)
-                    adjusted = CELL_SIZE * self.zoom_factor
-                    marker = self.markers[self.current_marker_id]
-                    # Check if the click is near the bottom-right corner (for resizing)
-                    x2 = marker["x2"] * adjusted + self.pan_x
-                    y2 = (GRID_SIZE - marker["y2"]) * adjusted + self.pan_y
-                    if abs(event.x - x2) < 10 and abs(event.y - y2) < 10:
-                        self.marker_resizing = True
-                    else:
-                        self.marker_resizing = False
-                    self.marker_dragging = False  # Reset dragging flag on press.
-                    return "break"
-                    
     def get_object_info(self, event):
         """
         Returns a string with information about the object (or marker) under the cursor.
         Checks markers first, then placed objects.
         """
-        marker = self.get_marker_nearby(event, tolerance=10)
-        if marker:
-            return f"Marker: {marker['name']}\nCoords: {marker['x1']},{marker['y1']} - {marker['x2']},{marker['y2']}\nColor: {marker['color']}"
+        marker_key = self.get_marker_nearby(event, tolerance=10)
+        if marker_key:
+            marker = self.placed_objects[marker_key]
+            x1, y1, x2, y2 = marker["bbox"]
+            return f"Marker: {marker['tag']}\nCoords: {x1:g},{y1:g} - {x2:g},{y2:g}\nColor: {marker['color']}"
         obj_key = self.get_object_at(event)
         if obj_key:
             data = self.placed_objects.get(obj_key)
@@ -2152,25 +6120,11 @@ class GridApp:
 
         # If any objects are currently selected, clear the selection and redraw.
         if self.selected_objects:
-            self.selected_objects.clear()
-            self.draw_grid()
+            self.model.clear_selection()
             return "break"
 
         # Otherwise, check if a placed object was right-clicked.
-        adjusted = CELL_SIZE * self.zoom_factor
-        x = int((self.canvas.canvasx(event.x) - self.pan_x) / adjusted)
-        y = GRID_SIZE - int((self.canvas.canvasy(event.y) - self.pan_y) / adjusted) - 1
-
-        found_obj = None
-        for center, data in self.placed_objects.items():
-            w, h = data.get("size", (3, 3))
-            cx, cy = center
-            x_start = cx - w // 2
-            y_start = cy - h // 2
-            if x_start <= x < x_start + w and y_start <= y < y_start + h:
-                found_obj = center
-                break
-
+        found_obj = self.model.object_at_cell(*self.event_cell(event))
         if found_obj is not None:
             self.show_object_context_menu(event, found_obj)
             return "break"
@@ -2179,59 +6133,41 @@ class GridApp:
             return "break"
 
     def get_alliance_avatar(self, name):
-        """Checks the 'images' folder for an image file with the same name as the member.
-        Tries common image extensions. Returns the file path if found, or None otherwise."""
-        extensions = [".png", ".jpg", ".jpeg", ".gif"]
-        for ext in extensions:
-            path = os.path.join("images", name + ext)
-            if os.path.exists(path):
-                return path
-        return None
+        """Looks up an image file named after the member in the avatar folders.
+        Returns the file path if found, or None otherwise."""
+        return self.avatar_index.lookup(name)
 
 
     def get_object_at(self, event):
         """Return the key (x, y) of the object under the mouse, or None if none."""
-        adjusted = CELL_SIZE * self.zoom_factor
-        canvas_x = self.canvas.canvasx(event.x)
-        canvas_y = self.canvas.canvasy(event.y)
-        grid_x = int((canvas_x - self.pan_x) / adjusted)
-        grid_y = GRID_SIZE - int((canvas_y - self.pan_y) / adjusted) - 1
-        for (obj_x, obj_y), data in self.placed_objects.items():
-            w, h = data.get("size", (3,3))
-            x_start = obj_x - w // 2
-            y_start = obj_y - h // 2
-            if x_start <= grid_x < x_start + w and y_start <= grid_y < y_start + h:
-                return (obj_x, obj_y)
-        return None
+        return self.model.object_at_cell(*self.event_cell(event))
         
     def delete_selected_objects(self, event):
+        if isinstance(event.widget, tk.Entry):
+            return  # Delete pressed while typing (e.g. in the search box).
         # Delete placed objects.
         for key in list(self.selected_objects):
-            if key in self.placed_objects:
-                del self.placed_objects[key]
-        # Delete selected markers.
-        for marker_id in list(self.selected_markers):
-            if marker_id in self.markers:
-                del self.markers[marker_id]
-        self.selected_objects.clear()
-        self.selected_markers.clear()
-        self.draw_grid()
+            self.model.remove_object(key)
 
 
     def deselect_tool(self, event=None):
         self.selected_tool = None
         self.status_bar.config(text="Tool: None")
+        self.canvas.delete("shadow")
+        self.ghost_anchor = None
 
-    def create_object_submenu(self, parent_menu, label, items):
+    def create_object_submenu(self, parent_menu, label, items, category=None):
         submenu = tk.Menu(parent_menu, tearoff=0)
         parent_menu.add_cascade(label=label, menu=submenu)
         for name, color in items.items():
-            submenu.add_command(label=name, command=lambda n=name, c=color: self.activate_preset_object(n, c))
+            submenu.add_command(label=name,
+                                command=lambda n=name, c=color: self.activate_preset_object(n, c, category=category))
 
     def set_window_title(self, window, base_title):
         window.title(f"{base_title}   Powered by: MaztaPazta")
 
-    def activate_preset_object(self, name, color, size=(3, 3), unique=False, avatar=None):
+    def activate_preset_object(self, name, color, size=(3, 3), unique=False, avatar=None, member_id=None,
+                               category=None):
         # Instead of placing the object immediately,
         # set the selected tool so that the next click on the grid
         # will place the object.
@@ -2241,7 +6177,9 @@ class GridApp:
             "size": size,
             "avatar": avatar,
             "type": "object",
-            "unique": unique
+            "unique": unique,
+            "member_id": member_id,
+            "category": category
         }
         self.status_bar.config(text=f"Tool: {name}")
         
@@ -2250,17 +6188,1078 @@ class GridApp:
         self.status_bar.config(text=f"Tool: Terrain ({terrain_type})")
 
     def update_coordinates(self, event):
-        canvas_x = self.canvas.canvasx(event.x)
-        canvas_y = self.canvas.canvasy(event.y)
-        adjusted_cell_size = CELL_SIZE * self.zoom_factor
-        x = int((canvas_x - self.pan_x) / adjusted_cell_size)
-        y = GRID_SIZE - int((canvas_y - self.pan_y) / adjusted_cell_size) - 1
-        if 0 <= x < GRID_SIZE and 0 <= y < GRID_SIZE:
+        x, y = self.event_cell(event)
+        if self.model.in_bounds(x, y):
             self.coord_label.config(text=f"Coordinates: ({x}, {y})")
         else:
             self.coord_label.config(text="Coordinates: Out of Bounds")
 
+# ------------------------------
+# Map Image Export
+# ------------------------------
+def blend_hex(hex_color, opacity, dark_mode=False):
+    """Mixes a #RRGGBB color with the background (white, or black in dark mode) at
+    opacity percent. Anything that isn't #RRGGBB gives black."""
+    if not (hex_color.startswith("#") and len(hex_color) == 7):
+        return "#000000"
+    r = int(hex_color[1:3], 16)
+    g = int(hex_color[3:5], 16)
+    b = int(hex_color[5:7], 16)
+    a = opacity / 100.0
+    if dark_mode:
+        nr = int(a * r)
+        ng = int(a * g)
+        nb = int(a * b)
+    else:
+        nr = int(a * r + (1 - a) * 255)
+        ng = int(a * g + (1 - a) * 255)
+        nb = int(a * b + (1 - a) * 255)
+    return f"#{nr:02x}{ng:02x}{nb:02x}"
+
+
+def adler32_combine(adler1, adler2, length2):
+    """Adler-32 of two byte strings joined together, from their separate checksums
+    (the same arithmetic as zlib's adler32_combine, which Python does not expose)."""
+    base = 65521
+    rem = length2 % base
+    sum1 = adler1 & 0xFFFF
+    sum2 = (rem * sum1) % base
+    sum1 += (adler2 & 0xFFFF) + base - 1
+    sum2 += (adler1 >> 16) + (adler2 >> 16) + base - rem
+    if sum1 >= base:
+        sum1 -= base
+    if sum1 >= base:
+        sum1 -= base
+    if sum2 >= base << 1:
+        sum2 -= base << 1
+    if sum2 >= base:
+        sum2 -= base
+    return sum1 | (sum2 << 16)
+
+
+def deflate_band(image):
+    """Compresses an RGB band as PNG scanlines into a raw deflate block that can be
+    appended to the bands before it. Returns (data, adler32 of the scanlines, their length)."""
+    raw = image.tobytes()
+    stride = image.width * 3
+    scanlines = b"".join(b"\x00" + raw[i:i + stride] for i in range(0, len(raw), stride))
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    data = compressor.compress(scanlines) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data, zlib.adler32(scanlines), len(scanlines)
+
+
+class PNGStreamWriter:
+    """Writes an RGB PNG one horizontal band at a time, so the whole image is never in
+    memory. Each band is its own IDAT chunk holding a piece of one zlib stream."""
+
+    def __init__(self, path, width, height):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.file = open(self.tmp_path, "wb")
+        self.adler = 1   # Adler-32 of no data
+        self.started = False
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def _chunk(self, tag, data):
+        self.file.write(struct.pack(">I", len(data)) + tag + data)
+        self.file.write(struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF))
+
+    def _zlib_header(self):
+        if self.started:
+            return b""
+        self.started = True
+        return b"\x78\x9c"
+
+    def write_band(self, data, adler, length):
+        self._chunk(b"IDAT", self._zlib_header() + data)
+        self.adler = adler32_combine(self.adler, adler, length)
+
+    def close(self):
+        # An empty final deflate block, then the checksum of everything written.
+        self._chunk(b"IDAT", self._zlib_header() + b"\x03\x00" + struct.pack(">I", self.adler))
+        self._chunk(b"IEND", b"")
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.remove(self.tmp_path)
+
+
+class MapBandRenderer:
+    """Draws horizontal bands of the exported map image, following the same rules as
+    redraw_terrain, draw_grid and redraw_objects. Built from the plain-data job made by
+    build_render_job so it can run in a worker process."""
+
+    def __init__(self, job):
+        self.job = job
+        self.width, self.height = job["size"]
+        self.band_px = job["band_px"]
+        self.thumbnail_cache = ThumbnailCache(job["thumbnail_dir"])
+        self.fonts = {}
+        self.textures = None
+        # Items by the bands they touch, keeping the drawing order of the canvas.
+        self.bands = collections.defaultdict(list)
+        for item in job["items"]:
+            top, bottom = item[1][1], item[1][3]
+            pad = 4 if item[0] == "marker" else 0
+            first = max(0, int(top - pad) // self.band_px)
+            last = min(self.band_count() - 1, int(bottom + pad) // self.band_px)
+            for band in range(first, last + 1):
+                self.bands[band].append(item)
+
+    def band_count(self):
+        return (self.height + self.band_px - 1) // self.band_px
+
+    def font(self, size):
+        if size not in self.fonts:
+            try:
+                self.fonts[size] = ImageFont.truetype("arial.ttf", size)
+            except OSError:
+                self.fonts[size] = ImageFont.load_default()
+        return self.fonts[size]
+
+    def load_textures(self):
+        self.textures = []
+        for path, (left, top, w, h) in self.job["textures"]:
+            try:
+                with Image.open(path) as texture:
+                    self.textures.append((texture.convert("RGBA").resize((w, h), Image.Resampling.LANCZOS), left, top))
+            except OSError as e:
+                print("Error loading texture:", e)
+
+    def draw_text(self, draw, rect, text, fill):
+        size = int(self.job["cell_px"] / 3)
+        if not text or size < 4:
+            return
+        font = self.font(size)
+        x1, y1, x2, y2 = draw.textbbox((0, 0), str(text), font=font)
+        draw.text(((rect[0] + rect[2] - (x2 - x1)) / 2 - x1, (rect[1] + rect[3] - (y2 - y1)) / 2 - y1),
+                  str(text), fill=fill, font=font)
+
+    def render_band(self, band):
+        """Returns the band deflated and ready for PNGStreamWriter.write_band."""
+        job = self.job
+        style = job["grid_style"]
+        cell_px = job["cell_px"]
+        x1, y1, x2, y2 = job["region"]
+        top = band * self.band_px
+        height = min(self.band_px, self.height - top)
+        image = Image.new("RGB", (self.width, height), "black" if style["dark_mode"] else "white")
+        draw = ImageDraw.Draw(image)
+
+        if self.textures is None:
+            self.load_textures()
+        for texture, left, texture_top in self.textures:
+            if texture_top < top + height and texture_top + texture.height > top:
+                image.paste(texture, (left, texture_top - top), texture)
+
+        major = blend_hex(style["major_color"], style["major_opacity"], style["dark_mode"])
+        minor = blend_hex(style["minor_color"], style["minor_opacity"], style["dark_mode"])
+        show_minor = cell_px >= style["zoom_threshold"]
+        for i in range(x1, x2 + 2):
+            if i % 9 == 0 or show_minor:
+                px = (i - x1) * cell_px
+                draw.line([(px, 0), (px, height)], fill=major if i % 9 == 0 else minor)
+        for i in range(y1, y2 + 2):
+            py = (y2 + 1 - i) * cell_px - top
+            if 0 <= py < height and (i % 9 == 0 or show_minor):
+                draw.line([(0, py), (self.width, py)], fill=major if i % 9 == 0 else minor)
+
+        for item in self.bands.get(band, ()):
+            rect = (item[1][0], item[1][1] - top, item[1][2], item[1][3] - top)
+            if item[0] == "marker":
+                _, _, color, label = item
+                draw.rectangle(rect, outline=color, width=4)
+                if cell_px < style["zoom_threshold"]:
+                    self.draw_text(draw, rect, label, color)
+                continue
+            _, _, tag, color, avatar = item
+            size = (rect[2] - rect[0], rect[3] - rect[1])
+            avatar_image = None
+            if avatar and os.path.exists(avatar):
+                avatar_image = self.thumbnail_cache.get(avatar, size)
+            if avatar_image is not None:
+                image.paste(avatar_image, rect[:2], avatar_image if avatar_image.mode == "RGBA" else None)
+            else:
+                draw.rectangle([rect[0], rect[1], rect[2] - 1, rect[3] - 1], fill=color, outline="black")
+                self.draw_text(draw, rect, tag, "white")
+        return deflate_band(image)
+
+
+_render_worker = None
+
+
+def _init_render_worker(job):
+    global _render_worker
+    _render_worker = MapBandRenderer(job)
+
+
+def _render_band_task(band):
+    return _render_worker.render_band(band)
+
+
+def build_render_job(model, cell_px, region, grid_style, thumbnail_dir, band_px=EXPORT_BAND_PX):
+    """Everything a band renderer needs as plain data, with item rectangles already in
+    image pixels (grid y grows upwards, image y downwards)."""
+    x1, y1, x2, y2 = region
+
+    def to_px(x, y):
+        return (x - x1) * cell_px, (y2 + 1 - y) * cell_px
+
+    items = []
+    for key in model.items_in(x1, y1, x2 + 1, y2 + 1):
+        data = model.placed_objects[key]
+        if data.get("is_marker"):
+            left, top = to_px(data["bbox"][0], data["bbox"][1])
+            right, bottom = to_px(data["bbox"][2], data["bbox"][3])
+            rect = (min(left, right), min(top, bottom), max(left, right), max(top, bottom))
+            color = data.get("color", "red")
+            items.append(("marker", rect, color, data.get("tag") or data.get("name")))
+        else:
+            x_start, y_start, w, h = model.object_rect(key, data)
+            left, top = to_px(x_start, y_start + h)
+            rect = (left, top, left + w * cell_px, top + h * cell_px)
+            color = data.get("color", "#000000")
+            items.append(("object", rect, data.get("tag", ""), color, data.get("avatar")))
+    width = (x2 - x1 + 1) * cell_px
+    height = (y2 - y1 + 1) * cell_px
+    # Drop whatever lies completely outside the image.
+    items = [item for item in items
+             if item[1][2] > 0 and item[1][0] < width and item[1][3] > 0 and item[1][1] < height]
+    textures = []
+    for zone in model.zones:
+        if zone["terrain"] not in TERRAIN_TEXTURES:
+            continue
+        tx1, ty1, tx2, ty2 = zone["rect"]
+        left, top = to_px(tx1, ty2)
+        textures.append((TERRAIN_TEXTURES[zone["terrain"]], (left, top, (tx2 - tx1) * cell_px, (ty2 - ty1) * cell_px)))
+    return {
+        "size": (width, height),
+        "region": region,
+        "cell_px": cell_px,
+        "band_px": band_px,
+        "grid_style": grid_style,
+        "items": items,
+        "textures": textures,
+        "thumbnail_dir": thumbnail_dir,
+    }
+
+
+def export_map_image(model, path, cell_px=10, region=None, processes=None, grid_style=None,
+                     thumbnail_cache=None, progress=None):
+    """Renders the map, or the inclusive grid rectangle region (x1, y1, x2, y2), to a PNG
+    with cell_px pixels per cell. Bands are drawn by a pool of processes and streamed into
+    the file in order, so memory use stays bounded however large the image is.
+    Returns the image size."""
+    if not 1 <= cell_px <= MAX_EXPORT_CELL_PX:
+        raise ValueError(f"pixels per cell must be between 1 and {MAX_EXPORT_CELL_PX}")
+    x1, y1, x2, y2 = region or (0, 0, model.grid_size - 1, model.grid_size - 1)
+    x1, x2 = sorted((max(0, x1), min(model.grid_size - 1, x2)))
+    y1, y2 = sorted((max(0, y1), min(model.grid_size - 1, y2)))
+    style = {"minor_color": "#D3D3D3", "major_color": "black", "minor_opacity": 100,
+             "major_opacity": 100, "zoom_threshold": 2, "dark_mode": False}
+    style.update(grid_style or {})
+
+    # Resize every avatar once up front so the workers only ever read the thumbnail cache.
+    thumbnail_cache = thumbnail_cache or ThumbnailCache()
+    job = build_render_job(model, cell_px, (x1, y1, x2, y2), style, thumbnail_cache.directory)
+    for item in job["items"]:
+        if item[0] == "object" and item[4] and os.path.exists(item[4]):
+            thumbnail_cache.get(item[4], (item[1][2] - item[1][0], item[1][3] - item[1][1]))
+
+    width, height = job["size"]
+    bands = (height + EXPORT_BAND_PX - 1) // EXPORT_BAND_PX
+    processes = processes or os.cpu_count() or 1
+    with PNGStreamWriter(path, width, height) as writer:
+        if processes == 1 or bands == 1:
+            renderer = MapBandRenderer(job)
+            for band in range(bands):
+                writer.write_band(*renderer.render_band(band))
+                if progress:
+                    progress(band + 1, bands)
+            return width, height
+        with concurrent.futures.ProcessPoolExecutor(processes, initializer=_init_render_worker,
+                                                    initargs=(job,)) as pool:
+            # Only a few bands are in flight at once, so finished ones can't pile up in memory.
+            pending = collections.deque()
+            next_band = 0
+            done = 0
+            while next_band < bands or pending:
+                while next_band < bands and len(pending) < processes * 2:
+                    pending.append(pool.submit(_render_band_task, next_band))
+                    next_band += 1
+                writer.write_band(*pending.popleft().result())
+                done += 1
+                if progress:
+                    progress(done, bands)
+    return width, height
+
+
+# ------------------------------
+# Map Validation
+# ------------------------------
+def describe_object(key, data):
+    return f"'{data.get('tag', 'Unnamed')}' at {key[0]},{key[1]}"
+
+
+def terrain_rects(terrain_cells, kinds):
+    """Covers the cells of the given terrain kinds with few grid rectangles (x1, y1, x2, y2):
+    runs of cells in a row, merged with identical runs in the rows above."""
+    rows = collections.defaultdict(list)
+    for (x, y), terrain in terrain_cells.items():
+        if terrain in kinds:
+            rows[y].append(x)
+    rects = []
+    open_runs = {}   # (x1, x2) -> y where the run started, for runs present in the previous row
+    previous_y = None
+    for y in sorted(rows):
+        xs = sorted(rows[y])
+        runs = []
+        run_start = xs[0]
+        for prev_x, x in zip(xs, xs[1:]):
+            if x != prev_x + 1:
+                runs.append((run_start, prev_x + 1))
+                run_start = x
+        runs.append((run_start, xs[-1] + 1))
+        still_open = {}
+        for run in runs:
+            still_open[run] = open_runs.pop(run) if previous_y == y - 1 and run in open_runs else y
+        for (x1, x2), y1 in open_runs.items():
+            rects.append((x1, y1, x2, previous_y + 1))
+        open_runs, previous_y = still_open, y
+    for (x1, x2), y1 in open_runs.items():
+        rects.append((x1, y1, x2, previous_y + 1))
+    return rects
+
+
+def find_map_conflicts(model, restricted_terrain=RESTRICTED_TERRAIN):
+    """Every pair of overlapping objects, every object on restricted terrain and every object
+    sticking out of the grid, as dicts with the kind, the object keys involved, the grid
+    rectangle (x1, y1, x2, y2) to highlight and a readable message.
+
+    Overlaps are found with a sweep over x: rectangles enter in order of their left edge
+    and leave once the sweep passes their right edge. The rectangles still active are kept
+    sorted by bottom edge, so only those starting within one rectangle height below the new
+    one need comparing. With objects of bounded size this is O((n + k) log n) for k conflicts."""
+    grid_size = model.grid_size
+    rects = []   # (x1, y1, x2, y2, key); key is None for a block of restricted terrain
+    conflicts = []
+    for key, data in model.iter_objects():
+        x_start, y_start, w, h = model.object_rect(key, data)
+        rect = (x_start, y_start, x_start + w, y_start + h)
+        rects.append(rect + (key,))
+        if x_start < 0 or y_start < 0 or rect[2] > grid_size or rect[3] > grid_size:
+            conflicts.append({"kind": "out_of_bounds", "keys": (key,), "rect": rect,
+                              "message": f"{describe_object(key, data)} lies partly outside the grid."})
+    rects.extend(rect + (None,) for rect in terrain_rects(model.terrain_cells, restricted_terrain))
+    if not rects:
+        return conflicts
+    rects.sort(key=lambda rect: rect[0])
+    max_height = max(rect[3] - rect[1] for rect in rects)
+
+    active = []    # (y1, index into rects), sorted
+    leaving = []   # heap of (x2, index into rects)
+    overlaps = []
+    on_restricted = {}   # object key -> bounding box of the restricted terrain it covers
+    for index, (x1, y1, x2, y2, key) in enumerate(rects):
+        while leaving and leaving[0][0] <= x1:
+            _, gone = heapq.heappop(leaving)
+            del active[bisect.bisect_left(active, (rects[gone][1], gone))]
+        low = bisect.bisect_right(active, (y1 - max_height, len(rects)))
+        high = bisect.bisect_left(active, (y2, -1))
+        for _, other in active[low:high]:
+            o_x1, o_y1, o_x2, o_y2, other_key = rects[other]
+            if o_y2 <= y1 or (key is None and other_key is None):
+                continue
+            overlap = (max(x1, o_x1), max(y1, o_y1), min(x2, o_x2), min(y2, o_y2))
+            if key is not None and other_key is not None:
+                overlaps.append((min(key, other_key), max(key, other_key), overlap))
+                continue
+            obj_key = key if key is not None else other_key
+            box = on_restricted.get(obj_key)
+            on_restricted[obj_key] = overlap if box is None else (
+                min(box[0], overlap[0]), min(box[1], overlap[1]), max(box[2], overlap[2]), max(box[3], overlap[3]))
+        bisect.insort(active, (y1, index))
+        heapq.heappush(leaving, (x2, index))
+
+    placed = model.placed_objects
+    for first, second, overlap in sorted(overlaps):
+        conflicts.append({"kind": "overlap", "keys": (first, second), "rect": overlap,
+                          "message": f"{describe_object(first, placed[first])} overlaps "
+                                     f"{describe_object(second, placed[second])}."})
+    terrain_names = " / ".join(restricted_terrain)
+    for key in sorted(on_restricted):
+        conflicts.append({"kind": "restricted", "keys": (key,), "rect": on_restricted[key],
+                          "message": f"{describe_object(key, placed[key])} sits on {terrain_names} terrain."})
+    return conflicts
+
+
+# ------------------------------
+# Collaboration
+# ------------------------------
+# Edits travel as small JSON ops, one per line:
+#   {"kind": "place", "key": [x, y], "data": {...}}          {"kind": "remove", "key": [x, y]}
+#   {"kind": "update", "key": [x, y], "fields": {...}}       {"kind": "move", "moves": [[old, new], ...]}
+#   {"kind": "terrain", "cells": [[x, y, terrain], ...]}     {"kind": "schedule", "changes": {field: {key: value or null}}}
+# Keys are JSON lists, so a placed marker's key is ["marker", name].
+def collab_op_from_event(model, event, payload):
+    """The op a local model event stands for and the op that undoes it. Terrain and
+    schedule ops simply overwrite, so they have no undo. Returns (None, None) for events that
+    stay local (view, selection, reset)."""
+    if event == "object_added":
+        key = list(payload["key"])
+        return {"kind": "place", "key": key, "data": dict(payload["data"])}, {"kind": "remove", "key": key}
+    if event == "object_removed":
+        key = list(payload["key"])
+        return {"kind": "remove", "key": key}, {"kind": "place", "key": key, "data": dict(payload["data"])}
+    if event == "object_changed":
+        key = list(payload["key"])
+        data, previous = payload["data"], payload["previous"]
+        fields = {name: value for name, value in data.items() if previous.get(name) != value}
+        if not fields:
+            return None, None
+        return ({"kind": "update", "key": key, "fields": fields},
+                {"kind": "update", "key": key, "fields": {name: previous.get(name) for name in fields}})
+    if event == "objects_moved":
+        moves = [[list(old), list(new)] for old, new in payload["moves"].items()]
+        return {"kind": "move", "moves": moves}, {"kind": "move", "moves": [[new, old] for old, new in moves]}
+    if event == "terrain_changed":
+        return {"kind": "terrain", "cells": [[x, y, terrain] for (x, y), terrain in payload["cells"].items()]}, None
+    return None, None
+
+
+def collab_undo(model, op):
+    """The op that undoes op on the model as it is now (before op is applied)."""
+    kind = op["kind"]
+    if kind == "place":
+        return {"kind": "remove", "key": op["key"]}
+    key = tuple(op["key"]) if "key" in op else None
+    if kind == "remove" and key in model.placed_objects:
+        return {"kind": "place", "key": op["key"], "data": dict(model.placed_objects[key])}
+    if kind == "update" and key in model.placed_objects:
+        data = model.placed_objects[key]
+        return {"kind": "update", "key": op["key"], "fields": {name: data.get(name) for name in op["fields"]}}
+    if kind == "move":
+        return {"kind": "move", "moves": [[new, old] for old, new in op["moves"]]}
+    return None
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _is_collab_key(value):
+    return (isinstance(value, list) and len(value) == 2 and
+            all(isinstance(part, (int, str)) and not isinstance(part, bool) for part in value))
+
+
+def collab_object_problem(key, data):
+    """Why data can't be placed at key (a tuple), or None."""
+    if data.get("is_marker"):
+        bbox = data.get("bbox")
+        if not (isinstance(bbox, (list, tuple)) and len(bbox) == 4 and all(map(_is_number, bbox))):
+            return "malformed marker bbox"
+        return None
+    if not all(isinstance(part, int) for part in key):
+        return "malformed object key"
+    size = data.get("size", (3, 3))
+    if not (isinstance(size, (list, tuple)) and len(size) == 2 and
+            all(isinstance(v, int) and not isinstance(v, bool) and v > 0 for v in size)):
+        return "malformed object size"
+    return None
+
+
+def collab_op_problem(op):
+    """Why op is not shaped like an op, or None. Ops come from other instances over the
+    network, so they are checked before any part of them is applied."""
+    if not isinstance(op, dict):
+        return "malformed op"
+    kind = op.get("kind")
+    if kind in ("place", "remove", "update") and not _is_collab_key(op.get("key")):
+        return "malformed key"
+    if kind == "place" and not isinstance(op.get("data"), dict):
+        return "malformed data"
+    if kind == "update" and not isinstance(op.get("fields"), dict):
+        return "malformed fields"
+    if kind == "move":
+        moves = op.get("moves")
+        if not (isinstance(moves, list) and
+                all(isinstance(move, list) and len(move) == 2 and all(map(_is_collab_key, move)) for move in moves)):
+            return "malformed moves"
+    if kind == "terrain":
+        cells = op.get("cells")
+        if not (isinstance(cells, list) and
+                all(isinstance(cell, list) and len(cell) == 3 and isinstance(cell[0], int) and
+                    isinstance(cell[1], int) and isinstance(cell[2], str) for cell in cells)):
+            return "malformed cells"
+    if kind == "schedule":
+        changes = op.get("changes")
+        if not (isinstance(changes, dict) and all(isinstance(values, dict) for values in changes.values())):
+            return "malformed changes"
+    return None
+
+
+def apply_collab_op(model, schedule, op):
+    """Applies an op to a model and a schedule dict ({field: {key: value}}). Returns None, or
+    the reason it does not apply to this state, in which case nothing was changed."""
+    problem = collab_op_problem(op)
+    if problem:
+        return problem
+    kind = op.get("kind")
+    if kind == "place":
+        key = tuple(op["key"])
+        if key in model.placed_objects:
+            return "occupied"
+        problem = collab_object_problem(key, op["data"])
+        if problem:
+            return problem
+        model.place_object(key, op["data"])
+    elif kind == "remove":
+        if model.remove_object(tuple(op["key"])) is None:
+            return "gone"
+    elif kind == "update":
+        key = tuple(op["key"])
+        if key not in model.placed_objects:
+            return "gone"
+        problem = collab_object_problem(key, {**model.placed_objects[key], **op["fields"]})
+        if problem:
+            return problem
+        model.update_object(key, **op["fields"])
+    elif kind == "move":
+        moves = {tuple(old): tuple(new) for old, new in op["moves"]}
+        if any(old not in model.placed_objects for old in moves):
+            return "gone"
+        if any(collab_object_problem(new, model.placed_objects[old]) for old, new in moves.items()):
+            return "malformed moves"
+        if any(new in model.placed_objects and new not in moves for new in moves.values()):
+            return "occupied"
+        model.move_objects(moves)
+    elif kind == "terrain":
+        model.set_terrain({(x, y): terrain for x, y, terrain in op["cells"]})
+    elif kind == "schedule":
+        for field, changes in op["changes"].items():
+            if field not in SCHEDULE_SYNC_FIELDS:
+                return f"unknown schedule field '{field}'"
+            values = schedule.setdefault(field, {})
+            for name, value in changes.items():
+                if value is None:
+                    values.pop(name, None)
+                else:
+                    values[name] = value
+    else:
+        return f"unknown op '{kind}'"
+    return None
+
+
+def send_json_line(sock, message):
+    sock.sendall((json.dumps(message, separators=(",", ":")) + "\n").encode("utf-8"))
+
+
+class CollabHub:
+    """Relays edits between the officers' instances over TCP. Every op a client sends is
+    checked against the hub's own copy of the map, then either broadcast to all clients
+    (the sender included) with the next sequence number, or rejected back to its sender,
+    so every instance applies the same ops in the same order. A client receives the whole
+    map once, when it joins; after that only ops travel."""
+
+    def __init__(self, state=None, schedule=None, host="127.0.0.1", port=COLLAB_PORT, grid_size=GRID_SIZE):
+        self.model = MapModel(grid_size)
+        if state:
+            self.model.load_state(state)
+        self.schedule = {field: dict((schedule or {}).get(field, {})) for field in SCHEDULE_SYNC_FIELDS}
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.clients = {}   # client id -> socket
+        self.names = {}
+        self.next_client = 1
+        self.server = socket.create_server((host, port))
+        self.address = self.server.getsockname()[:2]
+        self.running = False
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self._accept_loop, name="collab-hub", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.server.close()
+        with self.lock:
+            for conn in self.clients.values():
+                with contextlib.suppress(OSError):
+                    conn.shutdown(socket.SHUT_RDWR)
+            self.clients.clear()
+
+    def snapshot(self):
+        """The shared map state and schedule, e.g. for saving when the hub shuts down."""
+        with self.lock:
+            return self.model.to_state(), json.loads(json.dumps(self.schedule))
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client_id = None
+        try:
+            with conn.makefile("r", encoding="utf-8") as reader:
+                for line in reader:
+                    message = json.loads(line)
+                    if not isinstance(message, dict):
+                        continue
+                    if message.get("type") == "hello" and client_id is None:
+                        client_id = self._join(conn, message)
+                    elif message.get("type") == "op" and client_id is not None:
+                        self._handle_op(client_id, conn, message)
+        except (OSError, ValueError) as e:
+            if self.running:
+                print("Collaboration client dropped:", e)
+        finally:
+            with self.lock:
+                self.clients.pop(client_id, None)
+                self.names.pop(client_id, None)
+            conn.close()
+
+    def _join(self, conn, message):
+        with self.lock:
+            client_id = self.next_client
+            self.next_client += 1
+            state = self.model.to_state()
+            for view_key in ("pan_x", "pan_y", "zoom_factor"):
+                del state[view_key]   # every officer keeps their own view
+            send_json_line(conn, {"type": "snapshot", "client": client_id, "seq": self.seq,
+                                  "state": state, "schedule": self.schedule})
+            self.clients[client_id] = conn
+            self.names[client_id] = str(message.get("name") or f"Officer {client_id}")
+        return client_id
+
+    def _handle_op(self, client_id, conn, message):
+        with self.lock:
+            if not isinstance(message.get("op_id"), int):
+                reason = "missing op_id"
+            else:
+                reason = apply_collab_op(self.model, self.schedule, message.get("op"))
+            if reason is not None:
+                send_json_line(conn, {"type": "reject", "op_id": message.get("op_id"), "reason": reason})
+                return
+            self.seq += 1
+            delta = {"type": "delta", "seq": self.seq, "origin": client_id,
+                     "op_id": message["op_id"], "op": message["op"]}
+            for other_id, other in list(self.clients.items()):
+                try:
+                    send_json_line(other, delta)
+                except OSError:
+                    # The client's own thread notices the closed socket and cleans up.
+                    self.clients.pop(other_id, None)
+
+
+class CollabClient:
+    """An instance's connection to a CollabHub. Local model edits become ops that show at
+    once and are sent on the next flush(); ops from the hub are read on a background thread
+    and applied by process_incoming() on the caller's thread (the Tk loop).
+
+    Local ops the hub has not confirmed yet are undone before each op from another officer
+    and then redone on top of it, so the map always equals the hub's order of events. Ops
+    the hub rejects (e.g. a move of an object someone just deleted) are dropped the same way."""
+
+    def __init__(self, model, host="127.0.0.1", port=COLLAB_PORT, name="", on_schedule=None, timeout=5.0):
+        self.model = model
+        self.on_schedule = on_schedule
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile("r", encoding="utf-8")
+        send_json_line(self.sock, {"type": "hello", "name": name})
+        snapshot = json.loads(self.reader.readline() or "{}")
+        if snapshot.get("type") != "snapshot":
+            self.sock.close()
+            raise ConnectionError("The hub did not send the map.")
+        self.sock.settimeout(None)
+        self.client_id = snapshot["client"]
+        self.seq = snapshot["seq"]
+        self.schedule = snapshot["schedule"]
+        self.pending = []    # [op id, op, undo, applied locally, sent], oldest first
+        self.next_op = 1
+        self.rejected = []   # (op, reason) of local ops the hub refused, for the caller to report
+        self.incoming = queue.Queue()
+        self.connected = True
+        self.applying = True
+        try:
+            model.load_state(snapshot["state"])
+        finally:
+            self.applying = False
+        if self.on_schedule:
+            self.on_schedule(self.schedule)
+        model.subscribe(self.on_model_event)
+        threading.Thread(target=self._read_loop, name="collab-client", daemon=True).start()
+
+    def close(self):
+        self.connected = False
+        self.model.unsubscribe(self.on_model_event)
+        with contextlib.suppress(OSError):
+            self.sock.shutdown(socket.SHUT_RDWR)
+        self.sock.close()
+
+    def _read_loop(self):
+        try:
+            for line in self.reader:
+                self.incoming.put(json.loads(line))
+        except (OSError, ValueError):
+            pass
+        self.incoming.put(None)
+
+    # ------------------------------
+    # Outgoing
+    # ------------------------------
+    def on_model_event(self, event, payload):
+        if self.applying or not self.connected:
+            return
+        if event == "reset":
+            print("Collaboration: a reloaded map is not shared; leave and host again to share it.")
+            return
+        op, undo = collab_op_from_event(self.model, event, payload)
+        if op is not None:
+            self._queue(op, undo)
+
+    def send_schedule(self, schedule):
+        """Queues the differences between schedule and the shared schedule as one op."""
+        changes = {}
+        for field in SCHEDULE_SYNC_FIELDS:
+            old, new = self.schedule.get(field, {}), schedule.get(field, {})
+            diff = {name: value for name, value in new.items() if old.get(name) != value}
+            diff.update({name: None for name in old if name not in new})
+            if diff:
+                changes[field] = json.loads(json.dumps(diff))
+        if changes:
+            op = {"kind": "schedule", "changes": changes}
+            apply_collab_op(self.model, self.schedule, op)
+            self._queue(op, None)
+
+    def _queue(self, op, undo):
+        last = self.pending[-1] if self.pending else None
+        if last is not None and not last[4] and self._merge(last, op, undo):
+            return
+        self.pending.append([self.next_op, op, undo, True, False])
+        self.next_op += 1
+
+    @staticmethod
+    def _merge(entry, op, undo):
+        """Folds op into the unsent op before it when both touch the same objects, so a drag
+        sends one move instead of one per mouse event."""
+        last = entry[1]
+        if last["kind"] == op["kind"] == "move":
+            targets = {tuple(new): tuple(old) for old, new in last["moves"]}
+            if not all(tuple(old) in targets for old, _ in op["moves"]) or len(op["moves"]) != len(targets):
+                return False
+            moves = [[list(targets[tuple(old)]), new] for old, new in op["moves"]]
+            last["moves"] = [move for move in moves if move[0] != move[1]]
+            entry[2] = {"kind": "move", "moves": [[new, old] for old, new in last["moves"]]}
+            return True
+        if last["kind"] == op["kind"] == "update" and last["key"] == op["key"]:
+            last["fields"].update(op["fields"])
+            entry[2]["fields"] = {**undo["fields"], **entry[2]["fields"]}
+            return True
+        return False
+
+    def flush(self):
+        for entry in self.pending:
+            if not entry[4]:
+                send_json_line(self.sock, {"type": "op", "op_id": entry[0], "op": entry[1]})
+                entry[4] = True
+
+    # ------------------------------
+    # Incoming
+    # ------------------------------
+    def process_incoming(self):
+        """Sends queued ops and applies everything the hub has sent. Returns False once the
+        connection is gone."""
+        if self.connected:
+            try:
+                self.flush()
+            except OSError:
+                self.connected = False
+        while True:
+            try:
+                message = self.incoming.get_nowait()
+            except queue.Empty:
+                break
+            if message is None:
+                self.connected = False
+                break
+            if message["type"] == "delta":
+                self._on_delta(message)
+            elif message["type"] == "reject":
+                self._on_reject(message)
+        return self.connected
+
+    def _on_delta(self, message):
+        if message["seq"] != self.seq + 1:
+            print(f"Collaboration: expected update {self.seq + 1}, got {message['seq']}.")
+        self.seq = message["seq"]
+        if message["origin"] == self.client_id and self.pending and self.pending[0][0] == message["op_id"]:
+            _, op, _, applied, _ = self.pending.pop(0)
+            if not applied:
+                # It did not apply locally but the hub's state allowed it.
+                self._rebase(op)
+            return
+        self._rebase(message["op"])
+
+    def _on_reject(self, message):
+        if self.pending and self.pending[0][0] == message["op_id"]:
+            self.rejected.append((self.pending[0][1], message.get("reason")))
+            self._rebase(None, drop_first=True)
+
+    def _rebase(self, remote_op, drop_first=False):
+        self.applying = True
+        try:
+            for entry in reversed(self.pending):
+                if entry[3] and entry[2] is not None:
+                    apply_collab_op(self.model, self.schedule, entry[2])
+            if drop_first:
+                self.pending.pop(0)
+            if remote_op is not None:
+                reason = apply_collab_op(self.model, self.schedule, remote_op)
+                if reason is not None:
+                    print(f"Collaboration: could not apply an update ({reason}).")
+            for entry in self.pending:
+                undo = collab_undo(self.model, entry[1])
+                entry[3] = apply_collab_op(self.model, self.schedule, entry[1]) is None
+                entry[2] = undo
+        finally:
+            self.applying = False
+        if self.on_schedule and (remote_op or {}).get("kind") == "schedule":
+            self.on_schedule(self.schedule)
+
+
+# ------------------------------
+# Command Line
+# ------------------------------
+
+
+def matching_objects(model, pattern):
+    """Keys of the placed objects whose tag matches a shell-style pattern (e.g. "Enemy*")."""
+    return [key for key, data in model.iter_objects() if fnmatch.fnmatchcase(str(data.get("tag", "")), pattern)]
+
+
+def read_json_file(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def write_json_file(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        prog="CoNa_assistant.py",
+        description="Batch operations on the alliance map. Run without arguments to open the app.")
+    parser.add_argument("--state", default=STATE_FILE, help="map state file (default: %(default)s)")
+    parser.add_argument("--map-config", default=MAP_CONFIG_FILE,
+                        help="grid size and preset zones of the map (default: %(default)s)")
+    parser.add_argument("--members", default=ALLIANCE_MEMBERS_FILE, help="alliance members file (default: %(default)s)")
+    parser.add_argument("--schedule", default=WEEKLY_SCHEDULE_FILE, help="weekly schedule file (default: %(default)s)")
+    parser.add_argument("--dry-run", action="store_true", help="report what would change without writing files")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("validate", help="report overlapping, out-of-bounds and restricted-terrain objects")
+
+    move = commands.add_parser("move", help="move every object whose tag matches a pattern")
+    move.add_argument("--tag", required=True, help='shell-style tag pattern, e.g. "Enemy*"')
+    move.add_argument("--dx", type=int, default=0)
+    move.add_argument("--dy", type=int, default=0)
+
+    recolor = commands.add_parser("recolor", help="recolor every object whose tag matches a pattern")
+    recolor.add_argument("--tag", required=True, help='shell-style tag pattern, e.g. "Enemy*"')
+    recolor.add_argument("--color", required=True, help="new color as #RRGGBB")
+
+    roster = commands.add_parser("import-roster", help="import members from a CSV or JSON roster")
+    roster.add_argument("file")
+
+    layout = commands.add_parser("layout", help="place member bases around an anchor cell, highest ranks closest")
+    layout.add_argument("--anchor", type=int, nargs=2, metavar=("X", "Y"), required=True)
+    layout.add_argument("--ranks", nargs="+", choices=ALLIANCE_RANKS, default=ALLIANCE_RANKS,
+                        help="only lay out members of these ranks")
+    layout.add_argument("--region", type=int, nargs=4, metavar=("X1", "Y1", "X2", "Y2"),
+                        help="grid corners of the area the bases must stay in")
+    layout.add_argument("--spacing", type=int, default=0, help="free cells between bases (default: %(default)s)")
+
+    serve = commands.add_parser("serve", help="run a collaboration hub that officers can join from the app")
+    serve.add_argument("--host", default="127.0.0.1", help="address to listen on (default: %(default)s)")
+    serve.add_argument("--port", type=int, default=COLLAB_PORT, help="port to listen on (default: %(default)s)")
+
+    render = commands.add_parser("render", help="render the map (or a region) to PNG")
+    render.add_argument("output")
+    render.add_argument("--cell-px", type=int, default=10,
+                        help=f"pixels per grid cell, 1-{MAX_EXPORT_CELL_PX} (default: %(default)s)")
+    render.add_argument("--region", type=int, nargs=4, metavar=("X1", "Y1", "X2", "Y2"),
+                        help="inclusive grid rectangle to render")
+    render.add_argument("--processes", type=int, default=None, help="worker processes (default: one per CPU)")
+
+    export = commands.add_parser("export-schedule", help="export the schedule as text, CSV and iCalendar")
+    export.add_argument("folder")
+    export.add_argument("--format", dest="formats", nargs="+", choices=ScheduleExporter.FORMATS,
+                        default=list(ScheduleExporter.FORMATS))
+    return parser
+
+
+def run_cli(argv=None):
+    """Runs one batch command without creating any window. Returns the exit status."""
+    args = build_arg_parser().parse_args(argv)
+    map_config = load_map_config(args.map_config)
+    model = MapModel(map_config["grid_size"], zones=map_config["zones"])
+    if os.path.exists(args.state) and not model.load(args.state):
+        print(f"Could not load {args.state}.", file=sys.stderr)
+        return 2
+
+    if args.command == "validate":
+        problems = find_map_conflicts(model)
+        for conflict in problems:
+            print(conflict["message"])
+        print(f"{len(problems)} problem(s) found." if problems else "No problems found.")
+        return 1 if problems else 0
+
+    if args.command == "move":
+        keys = matching_objects(model, args.tag)
+        moves = {key: (key[0] + args.dx, key[1] + args.dy) for key in keys
+                 if model.in_bounds(key[0] + args.dx, key[1] + args.dy)}
+        done = model.move_objects(moves)
+        print(f"Moved {len(done)} of {len(keys)} matching object(s).")
+        if len(done) < len(keys):
+            print("Some were skipped because they would leave the grid or land on another object.")
+        if done and not args.dry_run:
+            model.save(args.state)
+        return 0
+
+    if args.command == "recolor":
+        if not (args.color.startswith("#") and len(args.color) == 7):
+            print("Color must look like #RRGGBB.", file=sys.stderr)
+            return 2
+        keys = matching_objects(model, args.tag)
+        for key in keys:
+            model.update_object(key, color=args.color.upper())
+        print(f"Recolored {len(keys)} object(s).")
+        if keys and not args.dry_run:
+            model.save(args.state)
+        return 0
+
+    if args.command == "import-roster":
+        registry = AllianceRegistry(read_json_file(args.members, []))
+        try:
+            rows = read_roster_file(args.file)
+        except (OSError, ValueError) as e:
+            print(f"Could not read {args.file}: {e}", file=sys.stderr)
+            return 2
+        new_members, updates, problems = plan_roster_import(registry, rows, AvatarIndex())
+        for line in problems:
+            print(line)
+        print(f"{len(new_members)} new member(s), {len(updates)} existing member(s) to update.")
+        if args.dry_run:
+            return 0
+        for member_id, changes in updates.items():
+            registry.update(member_id, **changes)
+        for member in new_members:
+            member.setdefault("Avatar", ALLIANCE_RANK_COLORS.get(member["Rank"], "#000000"))
+            registry.add(member)
+        write_json_file(args.members, registry.to_list())
+        if sync_member_objects(model, registry):
+            model.save(args.state)
+        return 0
+
+    if args.command == "layout":
+        if not model.in_bounds(*args.anchor):
+            print("The anchor lies outside the grid.", file=sys.stderr)
+            return 2
+        registry = AllianceRegistry(read_json_file(args.members, []))
+        members = [member for member in registry if member.get("Rank", "R1") in args.ranks]
+        added, removed, unplaced = plan_member_layout(model, members, tuple(args.anchor), args.region,
+                                                      max(0, args.spacing))
+        for member in unplaced:
+            print(f"No room for '{member.get('Name', 'Unnamed')}'.")
+        print(f"Placed {len(added)} of {len(members)} member(s).")
+        if added and not args.dry_run:
+            model.apply_edit({**removed, **added}, label="Auto Layout")
+            model.save(args.state)
+        return 0
+
+    if args.command == "serve":
+        schedule = read_json_file(args.schedule, {})
+        try:
+            hub = CollabHub(model.to_state(), schedule, args.host, args.port, grid_size=model.grid_size).start()
+        except OSError as e:
+            print(f"Could not listen on {args.host}:{args.port}: {e}", file=sys.stderr)
+            return 2
+        print(f"Collaboration hub listening on {hub.address[0]}:{hub.address[1]}. Press Ctrl+C to stop.")
+        # Stop the same way when the hub runs as a service and gets SIGTERM.
+        signal.signal(signal.SIGTERM, lambda signum, frame: signal.default_int_handler(signum, frame))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        hub.stop()
+        state, shared_schedule = hub.snapshot()
+        if not args.dry_run:
+            model.load_state(state)
+            model.save(args.state)
+            schedule.update(shared_schedule)
+            write_json_file(args.schedule, schedule)
+            print(f"Saved the shared map to {args.state} and the schedule to {args.schedule}.")
+        return 0
+
+    if args.command == "render":
+        try:
+            size = export_map_image(model, args.output, args.cell_px, args.region, processes=args.processes)
+        except (ValueError, OSError) as e:
+            print(f"Could not render: {e}", file=sys.stderr)
+            return 2
+        print(f"Wrote {args.output} ({size[0]}x{size[1]}).")
+        return 0
+
+    if args.command == "export-schedule":
+        data = read_json_file(args.schedule, {})
+        schedule = {
+            "conductor_assignments": data.get("conductor_assignments", {}),
+            "vs_tasks_by_weekday": data.get("vs_tasks_by_weekday", {}),
+            "vs_tasks": {},
+            "vs_task_exceptions": {},
+        }
+        os.makedirs(args.folder, exist_ok=True)
+        exporter = ScheduleExporter()
+        for fmt in args.formats:
+            path = os.path.join(args.folder, SCHEDULE_EXPORT_FILES[fmt])
+            if args.dry_run:
+                print(f"Would write {path}.")
+            elif exporter.export(fmt, path, schedule):
+                print(f"Wrote {path}.")
+            else:
+                print(f"{path} is up to date.")
+        return 0
+    return 2
+
+
 # Run the Application
-root = tk.Tk()
-app = GridApp(root)
-root.mainloop()
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(run_cli())
+    root = tk.Tk()
+    app = GridApp(root)
+    root.mainloop()
+    app.avatar_loader.shutdown()
@@ -0,0 +1,404 @@
+"""Synthetic-load benchmarks for the map.
+
+Builds maps with 1k, 10k and 100k objects of mixed sizes (plus markers and
+terrain) and times hit-testing, rectangle selection, saving/loading and the
+schedule export. When a display is available (a real one or a virtual
+framebuffer, e.g. `xvfb-run python bench_map.py`) it also times draw_grid and
+redraw_objects, counts the canvas items they create, and replays any recorded
+interaction sessions given with --session.
+
+Results are written as JSON. Pass --baseline to compare them with an earlier
+run, and --save-baseline to record the current run as the new baseline.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import types
+
+import CoNa_assistant as cona
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+DEFAULT_OUTPUT = "bench_results.json"
+DEFAULT_BASELINE = "bench_baseline.json"
+OBJECT_SIZES = [(1, 1), (2, 2), (3, 3), (3, 3), (4, 4), (5, 5)]
+MARKER_COLORS = ["#FF0000", "#00AA00", "#0000FF", "#FFA500"]
+TEXTURE_FILES = ("Mud.png", "Darkmud.png")
+
+
+# ------------------------------
+# Synthetic maps
+# ------------------------------
+def make_synthetic_state(object_count, seed=0, grid_size=cona.GRID_SIZE):
+    """Returns a saved-state dict (the autosave.json shape) with object_count objects,
+    one marker per hundred objects and a few square patches of terrain."""
+    rng = random.Random(seed)
+    placed_objects = {}
+    while len(placed_objects) < object_count:
+        x = rng.randrange(3, grid_size - 3)
+        y = rng.randrange(3, grid_size - 3)
+        key = f"{x},{y}"
+        if key in placed_objects:
+            continue
+        n = len(placed_objects)
+        placed_objects[key] = {
+            "tag": f"Obj {n}",
+            "color": "#%06X" % rng.randrange(0x1000000),
+            "size": list(rng.choice(OBJECT_SIZES)),
+            "avatar": None,
+        }
+    for n in range(max(1, object_count // 100)):
+        x1 = rng.randrange(0, grid_size - 40)
+        y1 = rng.randrange(0, grid_size - 40)
+        name = f"Marker {n}"
+        placed_objects[f"marker,{name}"] = {
+            "is_marker": True,
+            "tag": name,
+            "bbox": [x1, y1, x1 + rng.randrange(5, 40), y1 + rng.randrange(5, 40)],
+            "color": rng.choice(MARKER_COLORS),
+        }
+    terrain_cells = {}
+    for _ in range(max(1, object_count // 2000)):
+        x0 = rng.randrange(0, grid_size - 30)
+        y0 = rng.randrange(0, grid_size - 30)
+        terrain = rng.choice(["mud", "dark_mud"])
+        for x in range(x0, x0 + 30):
+            for y in range(y0, y0 + 30):
+                terrain_cells[f"{x},{y}"] = terrain
+    return {
+        "placed_objects": placed_objects,
+        "terrain_cells": terrain_cells,
+        "pan_x": 0,
+        "pan_y": 0,
+        "zoom_factor": 1.0,
+    }
+
+
+def make_synthetic_schedule(days=365, seed=0):
+    """A year of conductor assignments with recurring and one-off VS tasks."""
+    rng = random.Random(seed)
+    start = datetime.date(2025, 1, 1)
+    conductors = [f"Member {n}" for n in range(100)]
+    weekdays = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+    schedule = {
+        "conductor_assignments": {},
+        "vs_tasks_by_weekday": {day: [f"{day} task {n}" for n in range(3)] for day in weekdays},
+        "vs_tasks": {},
+        "vs_task_exceptions": {},
+    }
+    for offset in range(days):
+        date_str = (start + datetime.timedelta(days=offset)).strftime("%Y-%m-%d")
+        schedule["conductor_assignments"][date_str] = rng.choice(conductors)
+        if rng.random() < 0.3:
+            schedule["vs_tasks"][date_str] = [f"Extra task {offset}"]
+        if rng.random() < 0.1:
+            weekday = weekdays[(start + datetime.timedelta(days=offset)).weekday()]
+            schedule["vs_task_exceptions"][date_str] = [f"{weekday} task 0"]
+    return schedule
+
+
+# ------------------------------
+# Timing
+# ------------------------------
+def measure(func, repeat):
+    """Runs func repeat times and returns min/median wall time in seconds."""
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times), "repeat": repeat}, result
+
+
+def sample_canvas_points(model, keys, count, rng):
+    """Canvas points half on objects and half at random cells, so hits and misses are both timed."""
+    points = []
+    cell_px = model.cell_px
+    for n in range(count):
+        if n % 2 == 0 and keys:
+            x, y = rng.choice(keys)
+        else:
+            x, y = rng.randrange(model.grid_size), rng.randrange(model.grid_size)
+        c_x, c_y = model.corner_to_canvas(x, y + 1)
+        points.append((c_x + cell_px / 2, c_y + cell_px / 2))
+    return points
+
+
+# ------------------------------
+# Headless benchmarks
+# ------------------------------
+def bench_model(state, workdir, repeat, queries, seed):
+    results = {}
+    model = cona.MapModel()
+    timing, _ = measure(lambda: model.load_state(state), repeat)
+    results["load_state_dict"] = timing
+
+    rng = random.Random(seed)
+    keys = [key for key, _ in model.iter_objects()]
+    points = sample_canvas_points(model, keys, queries, rng)
+    cells = [model.canvas_to_cell(c_x, c_y) for c_x, c_y in points]
+
+    timing, hits = measure(lambda: sum(model.object_at_cell(x, y) is not None for x, y in cells), repeat)
+    timing["per_query"] = timing["min"] / len(cells)
+    timing["hits"] = hits
+    results["get_object_at"] = timing
+
+    timing, hits = measure(lambda: sum(model.item_at_canvas(c_x, c_y) is not None for c_x, c_y in points), repeat)
+    timing["per_query"] = timing["min"] / len(points)
+    timing["hits"] = hits
+    results["get_item_at"] = timing
+
+    # A selection rectangle covering a tenth of the grid in each direction.
+    span = model.grid_size // 10
+    x0 = rng.randrange(model.grid_size - span)
+    y0 = rng.randrange(model.grid_size - span)
+    c_x1, c_y1 = model.corner_to_canvas(x0, y0 + span)
+    c_x2, c_y2 = model.corner_to_canvas(x0 + span, y0)
+    timing, selected = measure(lambda: model.keys_in_canvas_rect(c_x1, c_y1, c_x2, c_y2), repeat)
+    timing["selected"] = len(selected)
+    results["rect_select"] = timing
+
+    path = os.path.join(workdir, "autosave.json")
+    timing, _ = measure(lambda: model.save(path), repeat)
+    timing["bytes"] = os.path.getsize(path)
+    results["save_state"] = timing
+    loaded = cona.MapModel()
+    timing, _ = measure(lambda: loaded.load(path), repeat)
+    results["load_state"] = timing
+
+    timing, _ = measure(model.content_hash, repeat)
+    results["content_hash"] = timing
+    return results
+
+
+def bench_schedule(workdir, repeat, seed):
+    results = {}
+    schedule = make_synthetic_schedule(seed=seed)
+    exporter = cona.ScheduleExporter(hash_file=os.path.join(workdir, "schedule_export_hashes.json"))
+    for fmt in exporter.FORMATS:
+        timing, lines = measure(lambda: sum(1 for _ in exporter.iter_format(fmt, schedule)), repeat)
+        timing["lines"] = lines
+        results[f"schedule_{fmt}"] = timing
+    # The first export writes the file; later ones only hash and find it unchanged.
+    path = os.path.join(workdir, "train_conductor_list.txt")
+    timing, _ = measure(lambda: exporter.export("text", path, schedule), repeat)
+    results["schedule_refresh"] = timing
+    return results
+
+
+# ------------------------------
+# Tk benchmarks
+# ------------------------------
+def open_display():
+    """Returns a Tk root, or None when no display (real or virtual) is available."""
+    try:
+        root = cona.tk.Tk()
+    except cona.tk.TclError:
+        return None
+    root.withdraw()
+    return root
+
+
+def bench_canvas(root, state, repeat, queries, seed):
+    """Times drawing on a real GridApp. Runs with the cwd set to a scratch folder, so the
+    app's own autosave and schedule files are never touched."""
+    results = {}
+    app = cona.GridApp(root)
+    root.update()
+    app.model.load_state(state)
+    app.model.set_start_position(*app.start_coordinate)
+
+    def draw():
+        app.draw_grid()
+        root.update_idletasks()
+        return len(app.canvas.find_all())
+
+    timing, items = measure(draw, repeat)
+    timing["items"] = items
+    results["draw_grid"] = timing
+
+    # redraw_objects adds to whatever is on the canvas, so the items of each run are
+    # removed again outside the timed section.
+    times = []
+    for _ in range(repeat):
+        before = set(app.canvas.find_all())
+        start = time.perf_counter()
+        app.redraw_objects()
+        root.update_idletasks()
+        times.append(time.perf_counter() - start)
+        created = set(app.canvas.find_all()) - before
+        for item in created:
+            app.canvas.delete(item)
+    results["redraw_objects"] = {"min": min(times), "median": statistics.median(times),
+                                 "repeat": repeat, "items": len(created)}
+
+    rng = random.Random(seed)
+    keys = [key for key, _ in app.model.iter_objects()]
+    events = [types.SimpleNamespace(x=c_x - app.canvas.canvasx(0), y=c_y - app.canvas.canvasy(0))
+              for c_x, c_y in sample_canvas_points(app.model, keys, queries, rng)]
+    timing, _ = measure(lambda: [app.get_object_at(event) for event in events], repeat)
+    timing["per_query"] = timing["min"] / len(events)
+    results["app_get_object_at"] = timing
+    timing, _ = measure(lambda: [app.get_item_at(event) for event in events], repeat)
+    timing["per_query"] = timing["min"] / len(events)
+    results["app_get_item_at"] = timing
+
+    app.canvas.destroy()
+    return results
+
+
+def bench_session(root, path, repeat):
+    """Replays a recorded interaction session (see InteractionRecorder) at full speed."""
+    app = cona.GridApp(root)
+    root.update()
+    replayer = cona.InteractionReplayer(root, app.canvas, app.model)
+    reports = [replayer.replay(path, speed="max") for _ in range(repeat)]
+    app.canvas.destroy()
+    walls = [report["wall_time"] for report in reports]
+    fastest = min(reports, key=lambda report: report["wall_time"])
+    latency = fastest["latency_ms"]
+    return {
+        "replay": {"min": min(walls), "median": statistics.median(walls), "repeat": repeat,
+                   "events": fastest["events"], "hash_matches": all(r["hash_matches"] for r in reports)},
+        "latency_p95": {"min": latency.get("p95", 0) / 1000},
+        "latency_max": {"min": latency.get("max", 0) / 1000},
+    }
+
+
+# ------------------------------
+# Baseline comparison
+# ------------------------------
+def flatten(results):
+    """{"10000/get_object_at": seconds, ...} from the nested per-size results."""
+    flat = {}
+    for size, metrics in results.items():
+        for name, timing in metrics.items():
+            flat[f"{size}/{name}"] = timing["min"]
+    return flat
+
+
+def compare(results, baseline, tolerance):
+    """Compares min times with the baseline. A metric counts as a regression when it is more
+    than tolerance (a fraction) slower, and as an improvement when it is that much faster.
+    Only metrics measured in this run are compared, so skipped benchmarks are left out."""
+    current = flatten(results)
+    previous = flatten(baseline.get("results", {}))
+    rows = []
+    for metric in sorted(current):
+        if metric not in previous or previous[metric] <= 0:
+            continue
+        ratio = current[metric] / previous[metric]
+        if ratio > 1 + tolerance:
+            status = "regression"
+        elif ratio < 1 - tolerance:
+            status = "improvement"
+        else:
+            status = "same"
+        rows.append({"metric": metric, "baseline": previous[metric], "current": current[metric],
+                     "ratio": ratio, "status": status})
+    return rows
+
+
+def print_report(results, comparison):
+    for size, metrics in results.items():
+        print(f"== {size} objects ==" if size.isdigit() else f"== {size} ==")
+        for name, timing in metrics.items():
+            extra = ", ".join(f"{k}={v}" for k, v in timing.items() if k not in ("min", "median", "repeat"))
+            print(f"  {name:<20} {timing['min'] * 1000:10.2f} ms  {extra}")
+    if comparison:
+        print("== against baseline ==")
+        for row in comparison:
+            print(f"  {row['metric']:<32} x{row['ratio']:.2f}  {row['status']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark map operations on synthetic maps.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES),
+                        help="object counts to benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement (the fastest is kept)")
+    parser.add_argument("--queries", type=int, default=200, help="hit-test queries per run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="fractional slowdown allowed before a metric counts as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    parser.add_argument("--no-tk", action="store_true", help="skip the canvas benchmarks")
+    parser.add_argument("--session", action="append", default=[],
+                        help="recorded interaction session to replay (may be given several times)")
+    args = parser.parse_args(argv)
+
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    workdir = tempfile.mkdtemp(prefix="bench_map_")
+    cwd = os.getcwd()
+    sessions = [os.path.abspath(path) for path in args.session]
+    root = None if args.no_tk else open_display()
+    skipped = []   # benchmarks left out of this run, and so out of the baseline comparison
+    if args.no_tk:
+        skipped.append("canvas")
+    elif root is None:
+        print("No display available; skipping canvas benchmarks.")
+        skipped.append("canvas")
+    results = {}
+    try:
+        # The app reads textures from and writes its autosave to the cwd.
+        for name in TEXTURE_FILES:
+            shutil.copy(os.path.join(repo_dir, name), workdir)
+        os.chdir(workdir)
+        results["schedule"] = bench_schedule(workdir, args.repeat, args.seed)
+        for size in args.sizes:
+            state = make_synthetic_state(size, seed=args.seed)
+            metrics = bench_model(state, workdir, args.repeat, args.queries, args.seed)
+            if root is not None:
+                metrics.update(bench_canvas(root, state, args.repeat, args.queries, args.seed))
+            results[str(size)] = metrics
+        if root is not None:
+            for path in sessions:
+                results[f"session:{os.path.basename(path)}"] = bench_session(root, path, args.repeat)
+        elif sessions:
+            print("No display available; skipping recorded sessions.")
+            skipped.append("sessions")
+    finally:
+        os.chdir(cwd)
+        if root is not None:
+            root.destroy()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    comparison = []
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            comparison = compare(results, json.load(f), args.tolerance)
+
+    report = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "tk": root is not None,
+        "skipped": skipped,
+        "args": vars(args),
+        "results": results,
+        "comparison": comparison,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=4)
+
+    print_report(results, comparison)
+    if args.fail_on_regression and any(row["status"] == "regression" for row in comparison):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
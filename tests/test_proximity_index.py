@@ -0,0 +1,73 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import CoNa_assistant as cona
+
+
+def brute_nearest(model, x, y, category, k, exclude=()):
+    found = sorted(((kx - x) ** 2 + (ky - y) ** 2, (kx, ky))
+                   for (kx, ky), data in model.iter_objects()
+                   if cona.object_category(data) == category and (kx, ky) not in exclude)
+    return [(d2 ** 0.5, key) for d2, key in found[:k]]
+
+
+def brute_within(model, x, y, radius, category):
+    found = sorted(((kx - x) ** 2 + (ky - y) ** 2, (kx, ky))
+                   for (kx, ky), data in model.iter_objects()
+                   if cona.object_category(data) == category)
+    return [(d2 ** 0.5, key) for d2, key in found if d2 <= radius * radius]
+
+
+class ProximityIndexTest(unittest.TestCase):
+    def test_matches_brute_force_through_edits(self):
+        rng = random.Random(41)
+        model = cona.MapModel()
+        categories = ("enemy", "friendly")
+        for _ in range(300):
+            key = (rng.randrange(200), rng.randrange(200))
+            model.place_object(key, {"tag": "base", "size": (3, 3), "category": rng.choice(categories)})
+        index = cona.ProximityIndex(model)
+        model.subscribe(index.apply)
+
+        for step in range(2000):
+            keys = list(model.placed_objects)
+            action = rng.random()
+            if action < 0.2:
+                key = (rng.randrange(200), rng.randrange(200))
+                if key not in model.placed_objects:
+                    model.place_object(key, {"tag": "base", "size": (3, 3), "category": rng.choice(categories)})
+            elif action < 0.35 and keys:
+                model.remove_object(rng.choice(keys))
+            elif action < 0.65 and keys:
+                # Renames, recolors and category changes all arrive as object_changed.
+                model.update_object(rng.choice(keys), tag=f"renamed {step}", category=rng.choice(categories))
+            elif action < 0.8 and keys:
+                key = rng.choice(keys)
+                model.move_objects({key: (key[0] + rng.randint(-3, 3), key[1] + rng.randint(-3, 3))})
+
+            x, y = rng.randrange(200), rng.randrange(200)
+            category = rng.choice(categories)
+            k = rng.randint(1, 5)
+            exclude = tuple(rng.sample(list(model.placed_objects), 2)) if len(model.placed_objects) > 2 else ()
+            self.assertEqual([d for d, _ in index.nearest(x, y, category, k, exclude)],
+                             [d for d, _ in brute_nearest(model, x, y, category, k, exclude)])
+            self.assertEqual(sorted(key for _, key in index.within(x, y, 15, category)),
+                             sorted(key for _, key in brute_within(model, x, y, 15, category)))
+
+    def test_nearest_finds_renamed_object(self):
+        model = cona.MapModel()
+        model.place_object((10, 10), {"tag": "near", "size": (3, 3), "category": "enemy"})
+        model.place_object((300, 10), {"tag": "far", "size": (3, 3), "category": "enemy"})
+        index = cona.ProximityIndex(model)
+        model.subscribe(index.apply)
+        index.nearest(0, 0, "enemy")   # builds the tree
+        model.update_object((10, 10), tag="renamed")
+        self.assertEqual(index.nearest(11, 11, "enemy")[0][1], (10, 10))
+
+
+if __name__ == "__main__":
+    unittest.main()